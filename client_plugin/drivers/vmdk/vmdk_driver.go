@@ -71,7 +71,8 @@ func NewVolumeDriver(cfg config.Config, mountDir string) *VolumeDriver {
 			useMockEsx: false,
 			ops: vmdkops.VmdkOps{
 				Cmd: vmdkops.EsxVmdkCmd{
-					Mtx: &sync.Mutex{},
+					Mtx:      &sync.Mutex{},
+					Attaches: &vmdkops.AttachQueue{},
 				},
 			},
 		}
@@ -0,0 +1,147 @@
+// Copyright 2017 VMware, Inc. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//    http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+// +build linux windows
+
+// Batching of "attach" requests (protocol version 3).
+// Docker mounts the volumes of a container one by one, and each attach is a
+// reconfigure of the VM on ESX. Attaches waiting for the connection to ESX are
+// queued, and whoever gets the connection sends all of them in one "batch"
+// request, which ESX executes with a single reconfigure.
+
+package vmdkops
+
+import (
+	"encoding/json"
+	"errors"
+	"sync"
+)
+
+const (
+	// Max size of a request ESX accepts, see MAX_JSON_SIZE in vmdk_ops.py
+	maxRequestSize = 4096
+	// Room for the batch envelope and the terminating NUL
+	batchEnvelopeSize = 64
+)
+
+// AttachQueue collects attach requests to be sent to ESX in one batch.
+// The zero value is an empty queue.
+type AttachQueue struct {
+	mtx     sync.Mutex
+	pending []*queuedAttach
+}
+
+type queuedAttach struct {
+	details VolumeInfo
+	size    int
+	taken   bool
+	done    chan attachResult
+}
+
+type attachResult struct {
+	reply []byte
+	err   error
+}
+
+// A command in a "batch" request
+type batchCommand struct {
+	Ops     string     `json:"cmd"`
+	Details VolumeInfo `json:"details"`
+}
+
+type batchDetails struct {
+	Commands []batchCommand `json:"Commands"`
+}
+
+// A "batch" request, replied to with one result per command, in order
+type batchRequest struct {
+	Ops     string       `json:"cmd"`
+	Details batchDetails `json:"details"`
+	Version string       `json:"version,omitempty"`
+}
+
+type batchReply struct {
+	Results []json.RawMessage `json:"Results"`
+}
+
+// add queues an attach of the volume
+func (q *AttachQueue) add(details VolumeInfo) (*queuedAttach, error) {
+	cmd, err := json.Marshal(&batchCommand{Ops: "attach", Details: details})
+	if err != nil {
+		return nil, err
+	}
+	a := &queuedAttach{details: details, size: len(cmd) + 1, done: make(chan attachResult, 1)}
+	q.mtx.Lock()
+	q.pending = append(q.pending, a)
+	q.mtx.Unlock()
+	return a, nil
+}
+
+// take removes and returns the oldest queued attaches which fit in one request,
+// at least one if the queue is not empty
+func (q *AttachQueue) take() []*queuedAttach {
+	q.mtx.Lock()
+	defer q.mtx.Unlock()
+	size := batchEnvelopeSize
+	count := 0
+	for _, a := range q.pending {
+		if count > 0 && size+a.size > maxRequestSize {
+			break
+		}
+		size += a.size
+		a.taken = true
+		count++
+	}
+	batch := q.pending[:count:count]
+	q.pending = q.pending[count:]
+	return batch
+}
+
+// isTaken returns true if the attach was taken to be sent to ESX
+func (q *AttachQueue) isTaken(a *queuedAttach) bool {
+	q.mtx.Lock()
+	defer q.mtx.Unlock()
+	return a.taken
+}
+
+// newBatchRequest returns the "batch" request for the attaches
+func newBatchRequest(batch []*queuedAttach, version string) *batchRequest {
+	req := &batchRequest{Ops: "batch", Version: version}
+	for _, a := range batch {
+		req.Details.Commands = append(req.Details.Commands, batchCommand{Ops: "attach", Details: a.details})
+	}
+	return req
+}
+
+// deliverBatchReply passes the result of each attach in the batch to its caller
+func deliverBatchReply(batch []*queuedAttach, reply []byte, err error) {
+	var results batchReply
+	if err == nil {
+		if json.Unmarshal(reply, &results) != nil || len(results.Results) != len(batch) {
+			err = errors.New("Invalid reply to batch request: " + string(reply))
+		}
+	}
+	for i, a := range batch {
+		if err != nil {
+			a.done <- attachResult{err: err}
+			continue
+		}
+		errStruct := unmarshalReply(results.Results[i])
+		if len(errStruct.Error) != 0 {
+			a.done <- attachResult{err: errors.New(errStruct.Error)}
+		} else {
+			a.done <- attachResult{reply: []byte(results.Results[i])}
+		}
+	}
+}
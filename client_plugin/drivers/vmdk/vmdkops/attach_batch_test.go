@@ -0,0 +1,82 @@
+// Copyright 2017 VMware, Inc. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//    http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+// +build linux
+
+package vmdkops
+
+// Test queueing of attaches and parsing of batch replies
+// Does not communicate over VMCI
+
+import (
+	"encoding/json"
+	"fmt"
+	"strings"
+	"testing"
+
+	"github.com/stretchr/testify/assert"
+)
+
+func TestAttachQueue(t *testing.T) {
+	q := &AttachQueue{}
+	first, err := q.add(VolumeInfo{Name: "vol1"})
+	assert.Nil(t, err)
+	second, _ := q.add(VolumeInfo{Name: "vol2", Options: map[string]string{"fstype": "ext4"}})
+
+	batch := q.take()
+	assert.Equal(t, []*queuedAttach{first, second}, batch)
+	assert.True(t, q.isTaken(second))
+	assert.Empty(t, q.take())
+
+	req, err := json.Marshal(newBatchRequest(batch, clientProtocolVersion))
+	assert.Nil(t, err)
+	assert.Equal(t, `{"cmd":"batch","details":{"Commands":[{"cmd":"attach","details":{"Name":"vol1"}},`+
+		`{"cmd":"attach","details":{"Name":"vol2","Opts":{"fstype":"ext4"}}}]},"version":"3"}`, string(req))
+}
+
+func TestAttachQueueSizeLimit(t *testing.T) {
+	q := &AttachQueue{}
+	name := strings.Repeat("v", 200)
+	for i := 0; i < 40; i++ {
+		q.add(VolumeInfo{Name: fmt.Sprintf("%s%d", name, i)})
+	}
+	total := 0
+	for batch := q.take(); len(batch) > 0; batch = q.take() {
+		req, _ := json.Marshal(newBatchRequest(batch, clientProtocolVersion))
+		assert.True(t, len(req) < maxRequestSize, "request of %d bytes", len(req))
+		assert.Equal(t, fmt.Sprintf("%s%d", name, total), batch[0].details.Name)
+		total += len(batch)
+	}
+	assert.Equal(t, 40, total)
+}
+
+func TestDeliverBatchReply(t *testing.T) {
+	q := &AttachQueue{}
+	first, _ := q.add(VolumeInfo{Name: "vol1"})
+	second, _ := q.add(VolumeInfo{Name: "vol2"})
+	batch := q.take()
+
+	deliverBatchReply(batch, []byte(`{"Results": [{"ControllerPciSlotNumber": "160", "Unit": "0"},`+
+		` {"Error": "Volume vol2 not found"}]}`), nil)
+	result := <-first.done
+	assert.Nil(t, result.err)
+	assert.Equal(t, `{"ControllerPciSlotNumber": "160", "Unit": "0"}`, string(result.reply))
+	result = <-second.done
+	assert.EqualError(t, result.err, "Volume vol2 not found")
+
+	// a reply without a result for each attach fails all of them
+	deliverBatchReply(batch, []byte(`{"Results": [null]}`), nil)
+	assert.NotNil(t, (<-first.done).err)
+	assert.NotNil(t, (<-second.done).err)
+}
@@ -42,15 +42,22 @@ import "C"
 
 // EsxVmdkCmd struct - empty , we use it only to implement VmdkCmdRunner interface
 type EsxVmdkCmd struct {
-	Mtx *sync.Mutex // For serialization of Run comand/response
+	Mtx      *sync.Mutex  // For serialization of Run comand/response
+	Attaches *AttachQueue // Attaches waiting for Mtx, sent in one batch. No batching if nil
 }
 
 const (
 	commBackendName string = "vsocket"
 	maxRetryCount          = 5
+	// Max number of retries when ESX declines a request as retryable (e.g. service is busy)
+	maxBusyRetryCount = 10
+	// Max total time to keep retrying a declined request, well below the timeout
+	// of Docker requests to the plugin
+	maxBusyRetryTime = 20 * time.Second
 	// Server side understand protocol version. If you are changing client/server protocol we use
 	// over VMCI, PLEASE DO NOT FORGET TO CHANGE IT FOR SERVER in file <vmdk_ops.py> !
-	clientProtocolVersion = "2"
+	// Version 3 adds the "batch" command, see attach_batch.go
+	clientProtocolVersion = "3"
 )
 
 // A request to be passed to ESX service
@@ -67,7 +74,9 @@ type VolumeInfo struct {
 }
 
 type vmciError struct {
-	Error string `json:",omitempty"`
+	Error      string `json:",omitempty"`
+	Retryable  bool   `json:",omitempty"`
+	RetryAfter int    `json:",omitempty"`
 }
 
 // EsxPort used to connect to ESX, passed in as command line param
@@ -80,17 +89,57 @@ var EsxPort int
 // *   - Sends json string up to ESX
 // *   - waits for reply and returns resulting JSON or an error
 func (vmdkCmd EsxVmdkCmd) Run(cmd string, name string, opts map[string]string) ([]byte, error) {
-	vmdkCmd.Mtx.Lock()
-	defer vmdkCmd.Mtx.Unlock()
 	protocolVersion := os.Getenv("VDVS_TEST_PROTOCOL_VERSION")
 	log.Debugf("Run get request: version=%s", protocolVersion)
 	if protocolVersion == "" {
 		protocolVersion = clientProtocolVersion
 	}
-	jsonStr, err := json.Marshal(&requestToVmci{
+	details := VolumeInfo{Name: name, Options: opts}
+	if cmd == "attach" && vmdkCmd.Attaches != nil && protocolVersion == clientProtocolVersion {
+		return vmdkCmd.runAttach(details, protocolVersion)
+	}
+	return vmdkCmd.send(cmd, &requestToVmci{
 		Ops:     cmd,
-		Details: VolumeInfo{Name: name, Options: opts},
+		Details: details,
 		Version: protocolVersion})
+}
+
+// runAttach queues the attach, and sends queued attaches to ESX until it is sent.
+// Attaches queued while we wait for the connection to ESX go in the same batch,
+// and if another caller took ours, its reply comes from that caller.
+func (vmdkCmd EsxVmdkCmd) runAttach(details VolumeInfo, protocolVersion string) ([]byte, error) {
+	own, err := vmdkCmd.Attaches.add(details)
+	if err != nil {
+		return nil, fmt.Errorf("Failed to marshal json: %v", err)
+	}
+	for !vmdkCmd.Attaches.isTaken(own) {
+		vmdkCmd.Mtx.Lock()
+		batch := vmdkCmd.Attaches.take()
+		vmdkCmd.Mtx.Unlock()
+		vmdkCmd.sendAttaches(batch, protocolVersion)
+	}
+	result := <-own.done
+	return result.reply, result.err
+}
+
+// sendAttaches sends the attaches to ESX, in a batch if there is more than one
+func (vmdkCmd EsxVmdkCmd) sendAttaches(batch []*queuedAttach, protocolVersion string) {
+	if len(batch) == 1 {
+		reply, err := vmdkCmd.send("attach", &requestToVmci{
+			Ops:     "attach",
+			Details: batch[0].details,
+			Version: protocolVersion})
+		batch[0].done <- attachResult{reply: reply, err: err}
+		return
+	}
+	log.Debugf("Sending %d attaches in one batch", len(batch))
+	reply, err := vmdkCmd.send("batch", newBatchRequest(batch, protocolVersion))
+	deliverBatchReply(batch, reply, err)
+}
+
+// send sends the request to ESX and returns the reply, retrying while ESX declines it
+func (vmdkCmd EsxVmdkCmd) send(cmd string, request interface{}) ([]byte, error) {
+	jsonStr, err := json.Marshal(request)
 	if err != nil {
 		return nil, fmt.Errorf("Failed to marshal json: %v", err)
 	}
@@ -101,11 +150,41 @@ func (vmdkCmd EsxVmdkCmd) Run(cmd string, name string, opts map[string]string) (
 	beS := C.CString(commBackendName)
 	defer C.free(unsafe.Pointer(beS))
 
+	deadline := time.Now().Add(maxBusyRetryTime)
+	for busyRetry := 0; ; busyRetry++ {
+		vmdkCmd.Mtx.Lock()
+		response, err := getReply(cmd, cmdS, beS)
+		vmdkCmd.Mtx.Unlock()
+		if err != nil {
+			return nil, err
+		}
+
+		errStruct := unmarshalReply(response)
+		retryAfter := time.Second * time.Duration(errStruct.RetryAfter)
+		if errStruct.Retryable && busyRetry < maxBusyRetryCount && time.Now().Add(retryAfter).Before(deadline) {
+			// ESX asked us to come back later, e.g. its request queue is full.
+			// Other requests can go to ESX while we wait.
+			log.Warnf("Run '%s' declined by ESX: %s. Retrying in %d seconds...",
+				cmd, errStruct.Error, errStruct.RetryAfter)
+			time.Sleep(retryAfter)
+			continue
+		}
+		if len(errStruct.Error) != 0 {
+			return nil, errors.New(errStruct.Error)
+		}
+		// There was no error, so return the slice containing the json response
+		return response, nil
+	}
+}
+
+// getReply sends the request to ESX over vSocket and returns the raw reply
+func getReply(cmd string, cmdS *C.char, beS *C.char) ([]byte, error) {
 	// Get the response data in json
 	ans := (*C.be_answer)(C.calloc(1, C.sizeof_struct_be_answer))
 	defer C.free(unsafe.Pointer(ans))
 
 	var ret C.be_sock_status
+	var err error
 	for i := 0; i <= maxRetryCount; i++ {
 		ret, err = C.Vmci_GetReply(C.int(EsxPort), cmdS, beS, ans)
 		if ret == 0 {
@@ -141,26 +220,19 @@ func (vmdkCmd EsxVmdkCmd) Run(cmd string, name string, opts map[string]string) (
 
 	response := []byte(C.GoString(ans.buf))
 	C.Vmci_FreeBuf(ans)
-
-	err = unmarshalError(response)
-	if err != nil && len(err.Error()) != 0 {
-		return nil, err
-	}
-	// There was no error, so return the slice containing the json response
 	return response, nil
 }
 
-func unmarshalError(str []byte) error {
+func unmarshalReply(str []byte) vmciError {
+	errStruct := vmciError{}
 	// Unmarshalling null always succeeds
 	if string(str) == "null" {
-		return nil
+		return errStruct
 	}
-	errStruct := vmciError{}
 	err := json.Unmarshal(str, &errStruct)
 	if err != nil {
 		// We didn't unmarshal an error, so there is no error ;)
-		return nil
+		return vmciError{}
 	}
-	// Return the unmarshaled error string as an `error`
-	return errors.New(errStruct.Error)
+	return errStruct
 }
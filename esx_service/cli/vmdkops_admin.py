@@ -41,6 +41,7 @@ import auth_data_const
 import convert
 import auth_api
 import auth_data
+import service_stats
 from auth_data import DB_REF
 from error_code import ErrorCode
 from error_code import error_code_to_message
@@ -264,6 +265,11 @@ def commands():
                         '--default-datastore': {
                             'help': 'Datastore to be used by default for volumes placement',
                             'required': True
+                        },
+                        '--weight': {
+                            'help': 'Share of request processing given to VMs of the vmgroup when '
+                                    'the service is busy (1-100, default 1)',
+                            'type': int
                         }
                     }
                 },
@@ -283,6 +289,11 @@ def commands():
                         },
                         '--default-datastore': {
                             'help': 'Datastore to be used by default for volumes placement',
+                        },
+                        '--weight': {
+                            'help': 'Share of request processing given to VMs of the vmgroup when '
+                                    'the service is busy (1-100)',
+                            'type': int
                         }
                     }
                 },
@@ -517,6 +528,16 @@ def commands():
                 'status': {
                     'func': config_status,
                     'help': 'Show the status of the Config DB'
+                },
+                'reconcile': {
+                    'func': config_reconcile,
+                    'help': 'Check storage usage counters used for quotas against volumes and VMDK sizes',
+                    'args': {
+                        '--fix': {
+                            'help': 'Recompute usage counters from volumes recorded in ' + DB_REF,
+                            'action': 'store_true'
+                        }
+                    }
                 }
             }
         },
@@ -527,6 +548,10 @@ def commands():
                 '--fast': {
                     'help': 'Skip some of the data collection (port, version)',
                     'action': 'store_true'
+                },
+                '--locks': {
+                    'help': 'Show the most contended and the longest held locks',
+                    'action': 'store_true'
                 }
             }
         }
@@ -863,12 +888,17 @@ def status(args):
     result.append({"LogLevel": log_config.get_log_level()})
     result.append({"=== Authorization Config DB": ""})
     result += config_db_get_status()
+    if pid:
+        result.append({"=== Service Statistics": ""})
+        result += service_stats_get_status(pid)
 
     output_list = []
     for r in result:
         output_list.append("{}: {}".format(list(r.keys())[0], list(r.values())[0]))
 
     printMessage(args.output_format,"\n".join(output_list))
+    if args.locks and pid:
+        print_lock_stats(args.output_format, pid)
     return None
 
 
@@ -885,6 +915,47 @@ def set_vol_opts(args):
                                                            str(ex)))
 
 
+def service_stats_get_status(pid):
+    """Return stats last published by the running service as an array of 1 element dicts"""
+    data = service_stats.load()
+    if not data or str(data["pid"]) != str(pid):
+        return [{"Stats": NOT_AVAILABLE}]
+    result = [{"StatsUpdated": time.ctime(data["timestamp"])}]
+    # per lock stats are too many to list here, see print_lock_stats()
+    stats = dict((k, v) for k, v in data["stats"].items() if k != "locks")
+    for name, value in service_stats.flatten(stats):
+        result.append({name: value})
+    return result
+
+
+# Number of locks listed by "status --locks"
+LOCK_STATS_TOP = 10
+
+def print_lock_stats(output_format, pid):
+    """Print the most contended and the longest held locks, as last published by the running service"""
+    data = service_stats.load()
+    if not data or str(data["pid"]) != str(pid) or "locks" not in data["stats"]:
+        printMessage(output_format, "Locks: {0}".format(NOT_AVAILABLE))
+        return
+    locks = data["stats"]["locks"]
+
+    hottest = sorted(locks.items(), key=lambda l: l[1]["total_wait"], reverse=True)[:LOCK_STATS_TOP]
+    header = ['Lock', 'Acquisitions', 'Contended', 'Waiters', 'Total Wait (s)', 'Max Wait (s)', 'Holder']
+    rows = [[name, str(l["acquisitions"]), str(l["contended"]), str(l["waiters"]),
+             str(l["total_wait"]), str(l["max_wait"]), l["holder"] or ""]
+            for name, l in hottest]
+    printMessage(output_format, "=== Most Contended Locks")
+    printList(output_format, header, rows)
+
+    longest = sorted(locks.items(), key=lambda l: max(l[1]["max_hold"], l[1]["held_for"]),
+                     reverse=True)[:LOCK_STATS_TOP]
+    header = ['Lock', 'Max Hold (s)', 'Total Hold (s)', 'Holder', 'Held For (s)']
+    rows = [[name, str(l["max_hold"]), str(l["total_hold"]), l["holder"] or "", str(l["held_for"])]
+            for name, l in longest]
+    printMessage(output_format, "=== Longest Held Locks")
+    printList(output_format, header, rows)
+
+
 VMDK_OPSD = '/etc/init.d/vmdk-opsd'
 PS = 'ps -c | grep '
 GREP_V_GREP = ' | grep -v grep'
@@ -974,7 +1045,8 @@ def tenant_create(args):
                                                  default_datastore=args.default_datastore,
                                                  description=desc,
                                                  vm_list=args.vm_list,
-                                                 privileges=[])
+                                                 privileges=[],
+                                                 weight=args.weight)
 
     if error_info:
         return err_out(error_info.msg)
@@ -991,7 +1063,8 @@ def tenant_update(args):
     error_info = auth_api._tenant_update(name=args.name,
                                          new_name=args.new_name,
                                          description=desc,
-                                         default_datastore=args.default_datastore)
+                                         default_datastore=args.default_datastore,
+                                         weight=args.weight)
 
     if error_info:
         return err_out(error_info.msg)
@@ -1200,6 +1273,10 @@ def db_move_to_backup(path):
     target = "{}.bak_{}".format(path, time.asctime().replace(" ", "_"))
     # since we generate unique file name, no need to check if it exists
     shutil.move(path, target)
+    # drop WAL files left by the DB, so they are not applied to a new DB at path
+    for suffix in ["-wal", "-shm"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
     return target
 
 
@@ -1371,6 +1448,9 @@ def config_rm(args):
             auth.connect()
             info = auth.get_info()
             mode = auth.mode # for usage outside of the 'with'
+            # local DB may be in WAL mode, get all changes into the DB file before backup
+            if mode == auth_data.DBMode.SingleNode:
+                auth.checkpoint()
         except auth_data.DbAccessError as ex:
             # the DB is broken and is being asked to be removed, so let's oblige
             printMessage(args.output_format, "Received error - removing comfiguration anyways. Err: \"{}\"".format(str(ex)))
@@ -1468,6 +1548,63 @@ def config_status(args):
     return None
 
 
+def get_vmdk_usage():
+    """
+    Return {(vmgroup name, datastore url): capacity of its VMDKs in MB}
+    for volumes in vmgroups
+    """
+    usage = {}
+    for v in vmdk_utils.get_volumes('*'):
+        tenant = v.get('tenant')
+        if not tenant or tenant == auth_data_const.ORPHAN_TENANT:
+            continue
+        size = kv.get_vol_size(os.path.join(v['path'], v['filename']))
+        if not size:
+            continue
+        key = (tenant, vmdk_utils.get_datastore_url(v['datastore']))
+        usage[key] = usage.get(key, 0) + size[0] // MB
+    return usage
+
+
+def config_reconcile_headers():
+    return ['VMGroup', 'Datastore', 'Counter (MB)', 'Volumes (MB)', 'VMDKs (MB)', 'Status']
+
+
+def config_reconcile(args):
+    """
+    Compare usage counters used for quota checks with the volumes recorded in
+    Config DB and the actual VMDK capacity, and report drift.
+    With --fix, counters are recomputed from the volumes recorded in Config DB.
+    """
+    error_info, drift = auth_api._usage_reconcile(fix=args.fix)
+    if error_info:
+        return err_out(error_info.msg)
+
+    vmdk_usage = get_vmdk_usage()
+    rows = []
+    for tenant_uuid, datastore_url, counter, volumes in sorted(drift):
+        error_info, tenant_name = auth_api.get_tenant_name(tenant_uuid)
+        if error_info or not tenant_name:
+            tenant_name = tenant_uuid
+        vmdks = vmdk_usage.pop((tenant_name, datastore_url), 0)
+        rows.append([tenant_name, datastore_url, counter, volumes, vmdks])
+    for (tenant_name, datastore_url), vmdks in sorted(vmdk_usage.items()):
+        rows.append([tenant_name, datastore_url, 0, 0, vmdks])
+
+    for row in rows:
+        tenant_name, datastore_url, counter, volumes, vmdks = row
+        row[1] = vmdk_utils.get_datastore_name(datastore_url) or datastore_url
+        status = []
+        if counter != volumes:
+            status.append("counter " + ("fixed" if args.fix else "drift"))
+        if volumes != vmdks:
+            status.append("VMDK drift")
+        row.append(", ".join(status) or "OK")
+
+    printList(args.output_format, config_reconcile_headers(), rows)
+    return None
+
+
 # ==== Run it now ====
 
 if __name__ == "__main__":
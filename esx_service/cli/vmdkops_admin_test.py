@@ -269,6 +269,13 @@ class TestParsing(unittest.TestCase):
         args = self.parser.parse_args(['status'])
         self.assertEqual(args.func, vmdkops_admin.status)
 
+    def test_config_reconcile(self):
+        args = self.parser.parse_args('config reconcile'.split())
+        self.assertEqual(args.func, vmdkops_admin.config_reconcile)
+        self.assertFalse(args.fix)
+        args = self.parser.parse_args('config reconcile --fix'.split())
+        self.assertTrue(args.fix)
+
     def test_set_no_args(self):
         self.assert_parse_error('set')
 
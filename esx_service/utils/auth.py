@@ -16,7 +16,11 @@
 
 """
 import logging
+import os
+import stat
+import time
 import auth_data
+import auth_snapshot
 import sqlite3
 import convert
 import auth_data_const
@@ -37,23 +41,144 @@ CMD_GET    = 'get'
 
 SIZE = 'size'
 
-# thread local storage in this module namespace
-thread_local = threadutils.get_local_storage()
+# How often (seconds) to check whether auth DB was created, removed or relinked
+# (e.g. by 'config init' or 'config rm')
+DB_PATH_CHECK_INTERVAL = 1
+
+# Max number of idle connections kept in AuthMgrPool
+MAX_IDLE_AUTH_MGRS = 32
+
+def get_db_path_signature(db_path):
+    """
+        Return a value which changes when DB at db_path is created, removed or
+        relinked, but not when the DB content changes.
+    """
+    try:
+        st = os.lstat(db_path)
+    except OSError:
+        return None
+    if stat.S_ISLNK(st.st_mode):
+        return st.st_ino, os.readlink(db_path), os.path.exists(db_path)
+    return st.st_ino, st.st_mode
+
+class AuthMgrLease(object):
+    """ AuthorizationDataManager taken from AuthMgrPool by a thread, returned when the thread exits """
+    def __init__(self, pool, auth_mgr, generation):
+        self.pool = pool
+        self.auth_mgr = auth_mgr
+        self.generation = generation
+
+    def __del__(self):
+        self.pool.release(self.auth_mgr, self.generation)
+
+class AuthMgrPool(object):
+    """
+        Process wide pool of connected AuthorizationDataManager objects for auth DB.
+        A thread keeps the AuthorizationDataManager it got until it exits, so
+        a worker thread connects once. DB mode discovery and upgrade check are done
+        by the first connection only, and again after the DB path changed; other
+        connections reuse the mode found.
+    """
+    def __init__(self, db_path=None, check_interval=DB_PATH_CHECK_INTERVAL, max_idle=MAX_IDLE_AUTH_MGRS):
+        self.db_path = db_path or auth_data.AUTH_DB_PATH
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self._lock = threadutils.get_lock()
+        self._local = threadutils.get_local_storage()
+        self._idle = []
+        self._mode = None
+        self._signature = None
+        self._checked_at = 0
+        # bumped when DB path changes, connections of older generations are dropped
+        self._generation = 0
+        self._connects = 0
+        self._discoveries = 0
+
+    def get(self):
+        """ Return (error_msg, AuthorizationDataManager) for the calling thread """
+        self.check_db_path()
+        lease = getattr(self._local, 'lease', None)
+        if lease and lease.generation == self._generation:
+            return None, lease.auth_mgr
+
+        with self._lock:
+            generation = self._generation
+            if self._idle:
+                auth_mgr = self._idle.pop()
+            else:
+                auth_mgr = auth_data.AuthorizationDataManager(self.db_path)
+                try:
+                    if self._mode is None:
+                        auth_mgr.connect()
+                        self._mode = auth_mgr.mode.value
+                        self._discoveries += 1
+                        logging.info("Auth DB %s mode: %s", self.db_path, auth_mgr.mode)
+                    else:
+                        auth_mgr.connect(self._mode)
+                except (auth_data.DbConnectionError, auth_data.DbAccessError, auth_data.DbUpgradeError) as err:
+                    return str(err), None
+                self._connects += 1
+
+        # the previous lease, if any, is released here
+        self._local.lease = AuthMgrLease(self, auth_mgr, generation)
+        return None, auth_mgr
+
+    def release(self, auth_mgr, generation):
+        """ Return auth_mgr to the pool, it is dropped (and closed) if DB path changed since it was taken """
+        with self._lock:
+            if generation == self._generation and len(self._idle) < self.max_idle:
+                self._idle.append(auth_mgr)
+
+    def check_db_path(self):
+        """ Drop connections and cached DB mode if the DB path changed. Checked every check_interval seconds """
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = get_db_path_signature(self.db_path)
+            if signature == self._signature:
+                return
+            if self._signature is not None or self._mode is not None:
+                logging.info("Auth DB %s changed, reconnecting", self.db_path)
+            self._signature = signature
+            self._generation += 1
+            self._mode = None
+            self._idle = []
+        auth_snapshot.invalidate(reconnect=True)
+
+    def stats(self):
+        """ Return a dict with DB mode and connection counters """
+        with self._lock:
+            return {"mode": str(auth_data.DBMode(self._mode)) if self._mode is not None else None,
+                    "generation": self._generation,
+                    "connects": self._connects,
+                    "discoveries": self._discoveries,
+                    "idle": len(self._idle)}
+
+_auth_mgr_pool = AuthMgrPool()
 
 def get_auth_mgr():
-    """ Get a connection to auth DB. """
-    global thread_local
-    if not hasattr(thread_local, '_auth_mgr'):
-        try:
-            thread_local._auth_mgr = auth_data.AuthorizationDataManager()
-            thread_local._auth_mgr.connect()
-        except (auth_data.DbConnectionError, auth_data.DbAccessError, auth_data.DbUpgradeError) as err:
-            return str(err), None
-    return None, thread_local._auth_mgr
+    """ Get a connection to auth DB, kept by the calling thread (see AuthMgrPool). """
+    return _auth_mgr_pool.get()
+
+def get_auth_mgr_stats():
+    return _auth_mgr_pool.stats()
+
+def get_auth_snapshot(_auth_mgr):
+    """
+        Get in-memory snapshot of authorization data in auth DB of _auth_mgr.
+        Return: error_msg, snapshot
+    """
+    try:
+        return None, auth_snapshot.get(_auth_mgr.db_path)
+    except sqlite3.Error as e:
+        logging.error("Error %s when loading authorization data from %s", e, _auth_mgr.db_path)
+        return str(e), None
 
 def get_default_tenant():
     """
-        Get DEFAULT tenant by querying the auth DB or from hardcoded defaults.
+        Get DEFAULT tenant from authorization data snapshot or from hardcoded defaults.
         VM which does not belong to any tenant explicitly will
         be assigned to DEFAULT tenant if DEFAULT tenant exists
         Returns: (err, uuid, name)
@@ -63,7 +188,6 @@ def get_default_tenant():
         -- tenant_name: return DEFAULT tenant name on success,
            return None on failure or DEFAULT tenant does not exist
     """
-    tenant_uuid = None
     err_msg, _auth_mgr = get_auth_mgr()
     if err_msg:
         return err_msg, None, None
@@ -71,19 +195,13 @@ def get_default_tenant():
     if _auth_mgr.allow_all_access():
         return None, auth_data_const.DEFAULT_TENANT_UUID, auth_data_const.DEFAULT_TENANT
 
-    try:
-        cur = _auth_mgr.conn.execute(
-            "SELECT id FROM tenants WHERE name = ?",
-            (auth_data_const.DEFAULT_TENANT, )
-            )
-        result = cur.fetchone()
-    except sqlite3.Error as e:
-        error_msg = "Error {0} when querying from tenants table for tenant {1}".format(e, auth_data_const.DEFAULT_TENANT)
-        logging.error(error_msg)
-        return str(e), None, None
-    if result:
+    err_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if err_msg:
+        return err_msg, None, None
+    tenant = snapshot.get_tenant_by_name(auth_data_const.DEFAULT_TENANT)
+    if tenant:
         # found DEFAULT tenant
-        tenant_uuid = result[0]
+        tenant_uuid = tenant.id
         logging.debug("Found DEFAULT tenant, tenant_uuid %s, tenant_name %s", tenant_uuid, auth_data_const.DEFAULT_TENANT)
         return None, tenant_uuid, auth_data_const.DEFAULT_TENANT
     else:
@@ -94,7 +212,7 @@ def get_default_tenant():
 
 def get_tenant(vm_uuid):
     """
-        Get tenant which owns this VM by querying the auth DB.
+        Get tenant which owns this VM from authorization data snapshot.
         Return: error_msg, tenant_uuid, tenant_name
         -- error_msg: return None on success or error info on failure
         -- tenant_uuid: return tenant uuid which the VM with given vm_uuid is associated to,
@@ -110,35 +228,17 @@ def get_tenant(vm_uuid):
         logging.debug("returning default info")
         return None, auth_data_const.DEFAULT_TENANT_UUID, auth_data_const.DEFAULT_TENANT
 
-    try:
-        cur = _auth_mgr.conn.execute(
-            "SELECT tenant_id FROM vms WHERE vm_id = ?",
-            (vm_uuid, )
-        )
-        result = cur.fetchone()
-    except sqlite3.Error as e:
-        logging.error("Error %s when querying from vms table for vm_id %s", e, vm_uuid)
-        return str(e), None, None
-
-    if result:
-        logging.debug("get tenant vm_uuid=%s tenant_id=%s", vm_uuid, result[0])
-
-    tenant_uuid = None
-    tenant_name = None
-    if result:
-        tenant_uuid = result[0]
-        try:
-            cur = _auth_mgr.conn.execute(
-                "SELECT name FROM tenants WHERE id = ?",
-                (tenant_uuid, )
-                )
-            result = cur.fetchone()
-        except sqlite3.Error as e:
-            logging.error("Error %s when querying from tenants table for tenant_id %s",
-                          e, tenant_uuid)
-            return str(e), None, None
-        if result:
-            tenant_name = result[0]
+    err_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if err_msg:
+        return err_msg, None, None
+
+    tenant_uuid = snapshot.vm_tenants.get(vm_uuid)
+    if tenant_uuid:
+        logging.debug("get tenant vm_uuid=%s tenant_id=%s", vm_uuid, tenant_uuid)
+        tenant_name = None
+        tenant = snapshot.get_tenant(tenant_uuid)
+        if tenant:
+            tenant_name = tenant.name
             logging.debug("Found tenant_uuid %s, tenant_name %s", tenant_uuid, tenant_name)
 
         return None, tenant_uuid, tenant_name
@@ -158,8 +258,8 @@ def get_tenant(vm_uuid):
 
 
 def get_privileges(tenant_uuid, datastore_url):
-    """ Return privileges for given (tenant_uuid, datastore_url) pair by
-        querying the auth DB.
+    """ Return privileges for given (tenant_uuid, datastore_url) pair from
+        authorization data snapshot.
         Return value:
         -- error_msg: return None on success or error info on failure
         -- privilegs: return a list of privileges for given (tenant_uuid, datastore_url)
@@ -175,19 +275,34 @@ def get_privileges(tenant_uuid, datastore_url):
         if datastore_url == auth_data_const.VM_DS_URL:
             return None, _auth_mgr.get_vm_ds_privileges_dict()
 
-    privileges = []
-    try:
-        cur = _auth_mgr.conn.execute(
-            "SELECT * FROM privileges WHERE tenant_id = ? and datastore_url = ?",
-            (tenant_uuid, datastore_url)
-            )
-        privileges = cur.fetchone()
-    except sqlite3.Error as e:
-        logging.error("Error %s when querying privileges table for tenant_id %s and datastore_url %s",
-                      e, tenant_uuid, datastore_url)
-        return str(e), None
+    err_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if err_msg:
+        return err_msg, None
 
-    return None, privileges
+    return None, snapshot.get_privileges(tenant_uuid, datastore_url)
+
+def get_tenant_weight(tenant_uuid):
+    """ Return scheduling weight for given tenant from authorization data snapshot.
+        Return value:
+        -- error_msg: return None on success or error info on failure
+        -- weight: return the weight of the tenant, or the default weight
+           if the tenant is not found or access control is not configured
+    """
+    err_msg, _auth_mgr = get_auth_mgr()
+    if err_msg:
+        return err_msg, None
+
+    if _auth_mgr.allow_all_access():
+        return None, auth_data_const.DEFAULT_TENANT_WEIGHT
+
+    err_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if err_msg:
+        return err_msg, None
+    tenant = snapshot.get_tenant(tenant_uuid)
+    if not tenant:
+        return None, auth_data_const.DEFAULT_TENANT_WEIGHT
+
+    return None, tenant.weight
 
 def has_privilege(privileges, type=None):
     """ Check whether the param "privileges" has the specific type of privilege set.
@@ -239,7 +354,7 @@ def check_max_volume_size(vol_size_in_MB, privileges):
 
 def get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url):
     """ Return total storage used by (tenant_uuid, datastore_url)
-        by querying auth DB.
+        from the usage counters in authorization data snapshot.
 
         Return value:
         -- error_msg: return None on success or error info on failure
@@ -252,35 +367,35 @@ def get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url):
     if err_msg:
         return err_msg, total_storage_used
 
+    if _auth_mgr.allow_all_access():
+        # volumes are not traced in auth DB
+        return None, total_storage_used
+
     if (datastore_url == auth_data_const.VM_DS_URL):
         # datastore_url need to be set to the url of a real datastore
         datastore_url = vm_datastore_url
 
-    try:
-        cur = _auth_mgr.conn.execute(
-            "SELECT SUM(volume_size) FROM volumes WHERE tenant_id = ? and datastore_url = ?",
-            (tenant_uuid, datastore_url)
-            )
-    except sqlite3.Error as e:
-        logging.error("Error %s when querying storage table for tenant_id %s and datastore_url %s",
-                      e, tenant_uuid, datastore_url)
-        return str(e), total_storage_used
-    result = cur.fetchone()
-    if result:
-        if result[0]:
-            total_storage_used = result[0]
-            logging.debug("total storage used for (tenant %s datastore_url %s) is %s MB", tenant_uuid,
-                          datastore_url, total_storage_used)
+    err_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if err_msg:
+        return err_msg, total_storage_used
+
+    total_storage_used = snapshot.get_usage(tenant_uuid, datastore_url)
+    logging.debug("total storage used for (tenant %s datastore_url %s) is %s MB", tenant_uuid,
+                  datastore_url, total_storage_used)
 
     return None, total_storage_used
 
-def check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm_datastore_url):
-    """ Check if the volume can be created without violating the quota. """
+def check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm_datastore_url,
+                      total_storage_used=None):
+    """ Check if the volume can be created without violating the quota.
+        total_storage_used is queried from auth DB unless passed in by the caller.
+    """
     if privileges:
-        error_msg, total_storage_used = get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url)
-        if error_msg:
-            # cannot get the total_storage_used, to be safe, return False
-            return False
+        if total_storage_used is None:
+            error_msg, total_storage_used = get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url)
+            if error_msg:
+                # cannot get the total_storage_used, to be safe, return False
+                return False
         usage_quota = privileges[auth_data_const.COL_USAGE_QUOTA]
         logging.debug("total_storage_used=%d, usage_quota=%d", total_storage_used, usage_quota)
         # if usage_quota which read from DB is 0, which means
@@ -292,7 +407,8 @@ def check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm
         # no privileges
         return True
 
-def check_privileges_for_command(cmd, opts, tenant_uuid, datastore_url, privileges, vm_datastore_url):
+def check_privileges_for_command(cmd, opts, tenant_uuid, datastore_url, privileges, vm_datastore_url,
+                                 total_storage_used=None):
     """
         Check whether the (tenant_uuid, datastore) has the privileges to run
         the given command.
@@ -320,7 +436,8 @@ def check_privileges_for_command(cmd, opts, tenant_uuid, datastore_url, privileg
         if not check_max_volume_size(vol_size_in_MB, privileges):
             result = error_code_to_message[ErrorCode.PRIVILEGE_MAX_VOL_EXCEED]
             return result
-        if not check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm_datastore_url):
+        if not check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm_datastore_url,
+                                 total_storage_used):
             result = error_code_to_message[ErrorCode.PRIVILEGE_USAGE_QUOTA_EXCEED]
             return result
 
@@ -449,9 +566,112 @@ def authorize(vm_uuid, datastore_url, cmd, opts, privilege_ds_url, vm_datastore_
 
         return result, tenant_uuid, tenant_name
 
+class AuthorizationPlan(object):
+    """
+        Authorization data of a VM for requests on one datastore, taken by
+        get_authorization_plan() from the authorization data snapshot: the VM's tenant,
+        the tenant's privileges for the datastore, "_VM_DS" and "_ALL_DS", and the storage
+        the tenant uses on the datastore. check() then authorizes any command with
+        the data as of plan creation, so a plan can be reused within a request
+        (e.g. to re-check quota of a clone once the source size is known).
+    """
+    def __init__(self, datastore_url, vm_datastore_url, tenant_uuid=None, tenant_name=None,
+                 privileges=None, total_storage_used=0, allow_all=False, mode=None):
+        self.datastore_url = datastore_url
+        self.vm_datastore_url = vm_datastore_url
+        self.tenant_uuid = tenant_uuid
+        self.tenant_name = tenant_name
+        # {datastore_url: privileges dict}
+        self.privileges = privileges or {}
+        self.total_storage_used = total_storage_used
+        self.allow_all = allow_all
+        self.mode = mode
+
+    def covers(self, datastore_url):
+        """ Return True if the plan can authorize requests on datastore_url """
+        return datastore_url == self.datastore_url
+
+    def authorize(self, cmd, opts, privilege_ds_url):
+        """ Same as authorize(), with privileges of privilege_ds_url from the plan. Returns error or None """
+        if self.allow_all:
+            return None
+        privileges = self.privileges.get(privilege_ds_url)
+        result = check_privileges_for_command(cmd, opts, self.tenant_uuid, self.datastore_url, privileges,
+                                              self.vm_datastore_url, self.total_storage_used)
+        logging.debug("authorize: vmgroup_name=%s, datastore_url=%s, vm_datastore_url=%s, privileges=%s, result=%s",
+                      self.tenant_name, self.datastore_url, self.vm_datastore_url, privileges, result)
+        if result is None:
+            logging.info("db_mode='%s' cmd=%s opts=%s vmgroup=%s datastore_url=%s is allowed to execute",
+                         self.mode, cmd, opts, self.tenant_name, self.datastore_url)
+        return result
+
+    def check(self, cmd, opts, datastore, vm_datastore, use_default_ds):
+        """
+            Check command can be executed on the datastore, falling back from the
+            datastore privileges to "_VM_DS" (if datastore is the VM datastore), then
+            to "_ALL_DS". Returns None on success or error message.
+        """
+        no_privilege = error_code_to_message[ErrorCode.PRIVILEGE_NO_PRIVILEGE]
+        result = self.authorize(cmd, opts, self.datastore_url)
+        if use_default_ds or result != no_privilege:
+            return result
+        if datastore == vm_datastore:
+            result = self.authorize(cmd, opts, auth_data_const.VM_DS_URL)
+            if result != no_privilege:
+                return result
+        return self.authorize(cmd, opts, auth_data_const.ALL_DS_URL)
+
+
+def get_authorization_plan(vm_uuid, datastore_url, vm_datastore_url=None):
+    """ Get AuthorizationPlan for VM and datastore from authorization data snapshot.
+        Caller need to pass the url of real datastore name where VM lives as param "vm_datastore_url" if
+        param "datastore_url" is the url of datastore "_VM_DS"
+        Return value: error_msg, plan
+    """
+    error_msg, _auth_mgr = get_auth_mgr()
+    if error_msg:
+        return error_msg, None
+
+    if _auth_mgr.allow_all_access():
+        return None, AuthorizationPlan(datastore_url, vm_datastore_url,
+                                       tenant_uuid=auth_data_const.DEFAULT_TENANT_UUID,
+                                       tenant_name=auth_data_const.DEFAULT_TENANT,
+                                       allow_all=True, mode=_auth_mgr.mode)
+
+    error_msg, snapshot = get_auth_snapshot(_auth_mgr)
+    if error_msg:
+        return error_msg, None
+
+    # The VM's tenant is the one from "vms" table, or DEFAULT tenant if the VM is not in any
+    tenant = snapshot.get_vm_tenant(vm_uuid)
+    if not tenant:
+        # This VM does not associate any tenant(including DEFAULT tenant),
+        # need reject the request
+        vm_name = vmdk_utils.get_vm_name_by_uuid(vm_uuid)
+        err_msg = error_code_to_message[ErrorCode.VM_NOT_BELONG_TO_TENANT].format(vm_name or vm_uuid)
+        logging.debug(err_msg)
+        return err_msg, None
+
+    privileges = {}
+    for url in (datastore_url, auth_data_const.VM_DS_URL, auth_data_const.ALL_DS_URL):
+        privilege = snapshot.get_privileges(tenant.id, url)
+        if privilege:
+            privileges[url] = privilege
+    usage_ds_url = vm_datastore_url if datastore_url == auth_data_const.VM_DS_URL else datastore_url
+    plan = AuthorizationPlan(datastore_url, vm_datastore_url,
+                             tenant_uuid=tenant.id,
+                             tenant_name=tenant.name,
+                             privileges=privileges,
+                             total_storage_used=snapshot.get_usage(tenant.id, usage_ds_url),
+                             mode=_auth_mgr.mode)
+    logging.debug("get_authorization_plan: vm_uuid=%s tenant=%s datastore_url=%s privileges=%s used=%s",
+                  vm_uuid, plan.tenant_name, datastore_url, privileges, plan.total_storage_used)
+    return None, plan
+
 def add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_in_MB):
     """
-        Insert volume to volumes table.
+        Insert volume to volumes table. Usage counter of the tenant on the datastore
+        is updated by a trigger, in the same transaction.
         Return None on success or error string.
     """
     err_msg, _auth_mgr = get_auth_mgr()
@@ -475,6 +695,7 @@ def add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_i
             (tenant_uuid, datastore_url, vol_name, vol_size_in_MB)
             )
         _auth_mgr.conn.commit()
+        auth_snapshot.invalidate()
     except sqlite3.Error as e:
         logging.error("Error %s when insert into volumes table for tenant_id %s and datastore_url %s",
                       e, tenant_uuid, datastore_url)
@@ -504,6 +725,7 @@ def remove_volume_from_volumes_table(tenant_uuid, datastore_url, vol_name):
                     [tenant_uuid, datastore_url, vol_name]
             )
         _auth_mgr.conn.commit()
+        auth_snapshot.invalidate()
     except sqlite3.Error as e:
         logging.error("Error %s when remove from volumes table for tenant_id %s and datastore_url %s",
                       e, tenant_uuid, datastore_url)
@@ -94,9 +94,11 @@ def only_when_configured(ret_obj=False):
     return real_decorator
 
 
-def get_tenant_from_db(name):
+def get_tenant_from_db(name, with_vms=True, with_privileges=True):
     """
         Get a tenant object with given name
+        If "with_vms" or "with_privileges" is False, tenant.vms or tenant.privileges
+        is not loaded and is left empty
         Return value:
         -- error_code: return None on success or error info on failure
         -- tenant: return tenant object on success or None on failure
@@ -106,7 +108,7 @@ def get_tenant_from_db(name):
         return error_info, None
 
     logging.debug("auth_api.get_tenant_from_db name=%s", name)
-    error_msg, tenant = auth_mgr.get_tenant(name)
+    error_msg, tenant = auth_mgr.get_tenant(name, with_vms, with_privileges)
     if error_msg:
         error_info = generate_error_info(error_msg)
         return error_info, None
@@ -174,12 +176,14 @@ def create_tenant_in_db(name, description, vms, privileges):
 
     return error_info, tenant
 
-def get_tenant_list_from_db(name=None):
+def get_tenant_list_from_db(name=None, with_vms=True, with_privileges=True):
     """
         List all tenants or tenant with the name specified
         Params:
         -- name: if "name" is specified, return a list of one tenant with name specified
         if "name" is not specified, return a list of all tenants
+        -- with_vms, with_privileges: if False, VMs or privileges of the tenants
+        are not loaded and are left empty
         Return value:
         -- error_info: return None on success or error info on failure
         -- tenant_list: return a list of tenant objects on success or None on failure
@@ -189,11 +193,11 @@ def get_tenant_list_from_db(name=None):
         return error_info, None
 
     if not name:
-        error_msg, tenant_list = auth_mgr.list_tenants()
+        error_msg, tenant_list = auth_mgr.list_tenants(with_vms, with_privileges)
         if error_msg:
             error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
     else:
-        error_msg, tenant = auth_mgr.get_tenant(name)
+        error_msg, tenant = auth_mgr.get_tenant(name, with_vms, with_privileges)
         if error_msg:
             error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
         if error_msg or not tenant:
@@ -203,15 +207,24 @@ def get_tenant_list_from_db(name=None):
 
     return error_info, tenant_list
 
-def generate_tuple_from_vm_list(vm_list):
-    """ Generate a list of (vm_uuid, vm_name) pair """
+def generate_tuple_from_vm_list(vm_list, host_vms=None):
+    """
+        Generate a list of (vm_uuid, vm_name) pair
+        If "host_vms" (as returned by vmdk_utils.get_host_vms()) is passed, VM names are
+        resolved with it instead of querying hostd for each VM
+    """
     if not vm_list:
         return None, [], []
+    if host_vms is not None:
+        uuids_by_name = dict((vm_name, vm_uuid) for vm_uuid, (vm_name, _) in host_vms.items())
     vms = []
     error_msg = ""
     not_found_vms = []
     for vm_name in vm_list:
-        vm_uuid = vmdk_utils.get_vm_uuid_by_name(vm_name)
+        if host_vms is not None:
+            vm_uuid = uuids_by_name.get(vm_name)
+        else:
+            vm_uuid = vmdk_utils.get_vm_uuid_by_name(vm_name)
         if not vm_uuid:
             err = "Cannot find vm_uuid for vm {0} ".format(vm_name)
             if err:
@@ -224,6 +237,40 @@ def generate_tuple_from_vm_list(vm_list):
 
     return None, vms, not_found_vms
 
+def get_vms_from_host(vm_list):
+    """
+        Resolve VM names in "vm_list" with a single query to hostd
+        Return value:
+        -- error_info: return None on success or error info on failure
+        -- vms: a list of (vm_uuid, vm_name) pair
+        -- host_vms: {vm_uuid: (vm_name, devices)} for all VMs on the host, to be passed
+           to vmdk_utils.check_volumes_mounted(). None if VMs could not be retrieved
+           in one query, and were looked up one by one
+    """
+    host_vms = vmdk_utils.get_host_vms()
+    error_msg, vms, not_found_vms = generate_tuple_from_vm_list(vm_list, host_vms)
+    if error_msg:
+        not_found_vm_list = ",".join(not_found_vms)
+        error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, not_found_vm_list)
+        return error_info, None, None
+    return None, vms, host_vms
+
+def get_vm_tenants(vms):
+    """
+        Get tenants of all vms in @param "vms" with one DB query
+        Return value:
+        -- error_info: return None on success or error info on failure
+        -- vm_tenants: {vm_uuid: (tenant_uuid, tenant_name)} for vms which belong to a tenant
+    """
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    error_msg, vm_tenants = auth_mgr.get_vm_tenants([vm_id for vm_id, _ in vms])
+    if error_msg:
+        return generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg), None
+    return None, vm_tenants
+
 def default_privileges():
     """ Return a privilege object with default value """
     privileges = [{'datastore': '',
@@ -335,20 +382,19 @@ def get_default_datastore_url(name):
         else:
             return generate_error_info(ErrorCode.INIT_NEEDED), None
 
-    error_info, tenant = get_tenant_from_db(name)
-    if error_info:
-        return error_info, None
+    error_msg, snapshot = auth.get_auth_snapshot(auth_mgr)
+    if error_msg:
+        return generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg), None
 
+    tenant = snapshot.get_tenant_by_name(name)
     if not tenant:
         error_info = generate_error_info(ErrorCode.TENANT_NOT_EXIST, name)
         return error_info, None
 
     # if default_datastore is not set for this tenant, default_datastore will be None
-    error_msg, default_datastore_url = tenant.get_default_datastore(auth_mgr.conn)
-    if error_msg:
-        error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+    default_datastore_url = tenant.default_datastore_url or None
     logging.debug("returning url %s", default_datastore_url)
-    return error_info, default_datastore_url
+    return None, default_datastore_url
 
 def is_tenant_name_valid(name):
     """ Check given tenant name is valid or not """
@@ -357,6 +403,16 @@ def is_tenant_name_valid(name):
     else:
         return False
 
+def check_tenant_weight(weight):
+    """ Check given tenant weight is valid or not. Returns None or error_info """
+    if not isinstance(weight, int) or \
+       weight < auth_data_const.MIN_TENANT_WEIGHT or \
+       weight > auth_data_const.MAX_TENANT_WEIGHT:
+        return generate_error_info(ErrorCode.TENANT_WEIGHT_INVALID, weight,
+                                   auth_data_const.MIN_TENANT_WEIGHT,
+                                   auth_data_const.MAX_TENANT_WEIGHT)
+    return None
+
 def is_vm_duplicate(vm_list):
     """
     Check if vm names in vm_list contain duplicates
@@ -442,10 +498,10 @@ def set_default_ds(tenant, default_datastore, check_existing):
     return error_info
 
 @only_when_configured(ret_obj=True)
-def _tenant_create(name, default_datastore, description="", vm_list=None, privileges=None):
+def _tenant_create(name, default_datastore, description="", vm_list=None, privileges=None, weight=None):
     """ API to create a tenant . Returns (ErrInfo, Tenant) """
-    logging.debug("_tenant_create: name=%s description=%s vm_list=%s privileges=%s default_ds=%s",
-                  name, description, vm_list, privileges, default_datastore)
+    logging.debug("_tenant_create: name=%s description=%s vm_list=%s privileges=%s default_ds=%s weight=%s",
+                  name, description, vm_list, privileges, default_datastore, weight)
 
     if not is_tenant_name_valid(name):
         error_info = generate_error_info(ErrorCode.TENANT_NAME_INVALID, name, VALID_TENANT_NAME_REGEXP)
@@ -466,17 +522,15 @@ def _tenant_create(name, default_datastore, description="", vm_list=None, privil
         if error_info:
             return error_info, None
 
-        error_msg, vms, not_found_vms = generate_tuple_from_vm_list(vm_list)
-        if error_msg:
-            not_found_vm_list = ",".join(not_found_vms)
-            error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, not_found_vm_list)
+        error_info, vms, host_vms = get_vms_from_host(vm_list)
+        if error_info:
             return error_info, None
 
         error_info = vm_in_any_tenant(vms)
         if error_info:
             return error_info, None
 
-        error_info = vmdk_utils.check_volumes_mounted(vms)
+        error_info = vmdk_utils.check_volumes_mounted(vms, host_vms)
         if error_info:
             error_info.msg = "Cannot add VM to vmgroup " + error_info.msg
             logging.error(error_info.msg)
@@ -488,6 +542,11 @@ def _tenant_create(name, default_datastore, description="", vm_list=None, privil
     if error_info:
         return error_info, None
 
+    if weight is not None:
+        error_info = check_tenant_weight(weight)
+        if error_info:
+            return error_info, None
+
     error_info, tenant = create_tenant_in_db(
         name=name,
         description=description,
@@ -501,15 +560,24 @@ def _tenant_create(name, default_datastore, description="", vm_list=None, privil
                                 check_existing=False)
     if error_info:
         return error_info, None
+
+    if weight is not None:
+        error_info, auth_mgr = get_auth_mgr_object()
+        if error_info:
+            return error_info, None
+        error_msg = tenant.set_weight(auth_mgr.conn, weight)
+        if error_msg:
+            error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+            return error_info, None
     return None, tenant
 
 
 @only_when_configured()
-def _tenant_update(name, new_name=None, description=None, default_datastore=None):
+def _tenant_update(name, new_name=None, description=None, default_datastore=None, weight=None):
     """ API to update a tenant """
-    logging.debug("_tenant_update: name=%s, new_name=%s, descrption=%s, default_datastore=%s",
-                  name, new_name, description, default_datastore)
-    error_info, tenant = get_tenant_from_db(name)
+    logging.debug("_tenant_update: name=%s, new_name=%s, descrption=%s, default_datastore=%s, weight=%s",
+                  name, new_name, description, default_datastore, weight)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -531,6 +599,15 @@ def _tenant_update(name, new_name=None, description=None, default_datastore=None
         if error_info:
             return error_info
 
+    if weight is not None:
+        error_info = check_tenant_weight(weight)
+        if error_info:
+            return error_info
+        error_msg = tenant.set_weight(auth_mgr.conn, weight)
+        if error_msg:
+            error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+            return error_info
+
     if new_name:
         if name == auth_data_const.DEFAULT_TENANT:
             error_info = generate_error_info(ErrorCode.TENANT_NAME_INVALID, name, VALID_TENANT_NAMES)
@@ -595,16 +672,18 @@ def _tenant_ls(name=None):
     error_info, tenant_list = get_tenant_list_from_db(name)
     return error_info, tenant_list
 
-def vm_already_in_tenant(name, vms):
+def vm_already_in_tenant(name, vms, vm_tenants=None):
     """
         Check whether any vm in @param "vms" already exists in tenant @param "name"
+        @param "vm_tenants" is get_vm_tenants(vms) result, it is queried if not passed
     """
-    error_info, existing_vms = _tenant_vm_ls(name)
-    if error_info:
-        return error_info
+    if vm_tenants is None:
+        error_info, vm_tenants = get_vm_tenants(vms)
+        if error_info:
+            return error_info
 
     for vm_id, vm_name in vms:
-        if vm_id in existing_vms:
+        if vm_id in vm_tenants and vm_tenants[vm_id][1] == name:
             error_info = generate_error_info(ErrorCode.VM_ALREADY_IN_TENANT,
                                                         vm_name, name)
             logging.error(error_info.msg)
@@ -612,18 +691,18 @@ def vm_already_in_tenant(name, vms):
 
     return None
 
-def vm_not_exist(name, vms):
+def vm_not_exist(name, vms, vm_tenants=None):
     """
         Check whether any vm in @param "vms" does not exist in tenant @param "name"
+        @param "vm_tenants" is get_vm_tenants(vms) result, it is queried if not passed
     """
-    error_info, existing_vms = _tenant_vm_ls(name)
-    if error_info:
-        return error_info
-
-    existing_vm_uuids = [vm_id for (vm_id, _) in existing_vms]
+    if vm_tenants is None:
+        error_info, vm_tenants = get_vm_tenants(vms)
+        if error_info:
+            return error_info
 
     for vm_id, vm_name in vms:
-        if not vm_id in existing_vm_uuids:
+        if vm_id not in vm_tenants or vm_tenants[vm_id][1] != name:
             error_info = error_code.generate_error_info(ErrorCode.VM_NOT_IN_TENANT, vm_name, name)
             logging.error(error_info.msg)
             return error_info
@@ -631,21 +710,22 @@ def vm_not_exist(name, vms):
     return None
 
 
-def vm_in_any_tenant(vms):
+def vm_in_any_tenant(vms, vm_tenants=None):
     """
         Check if any vm in @param "vms" is a part of another tenant
+        @param "vm_tenants" is get_vm_tenants(vms) result, it is queried if not passed
     """
-    error_info, tenant_list = get_tenant_list_from_db()
-    if error_info:
-        return error_info
+    if vm_tenants is None:
+        error_info, vm_tenants = get_vm_tenants(vms)
+        if error_info:
+            return error_info
 
-    for tenant in tenant_list:
-        for vm_id, vm_name in vms:
-            if vm_id in dict(tenant.vms):
-                error_info = error_code.generate_error_info(ErrorCode.VM_IN_ANOTHER_TENANT,
-                                                            vm_name, tenant.name)
-                logging.error(error_info.msg)
-                return error_info
+    for vm_id, vm_name in vms:
+        if vm_id in vm_tenants:
+            error_info = error_code.generate_error_info(ErrorCode.VM_IN_ANOTHER_TENANT,
+                                                        vm_name, vm_tenants[vm_id][1])
+            logging.error(error_info.msg)
+            return error_info
 
     return None
 
@@ -671,7 +751,7 @@ def _tenant_vm_add(name, vm_list):
     """ API to add vms for a tenant """
     logging.debug("_tenant_vm_add: name=%s vm_list=%s", name, vm_list)
 
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -687,21 +767,23 @@ def _tenant_vm_add(name, vm_list):
     if error_info:
         return error_info
 
-    error_msg, vms, not_found_vms = generate_tuple_from_vm_list(vm_list)
-    if error_msg:
-        not_found_vm_list = ",".join(not_found_vms)
-        error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, not_found_vm_list)
+    error_info, vms, host_vms = get_vms_from_host(vm_list)
+    if error_info:
         return error_info
 
-    error_info = vm_already_in_tenant(name, vms)
+    error_info, vm_tenants = get_vm_tenants(vms)
     if error_info:
         return error_info
 
-    error_info = vm_in_any_tenant(vms)
+    error_info = vm_already_in_tenant(name, vms, vm_tenants)
     if error_info:
         return error_info
 
-    error_info = vmdk_utils.check_volumes_mounted(vms)
+    error_info = vm_in_any_tenant(vms, vm_tenants)
+    if error_info:
+        return error_info
+
+    error_info = vmdk_utils.check_volumes_mounted(vms, host_vms)
     if error_info:
         error_info.msg = "Cannot add VM to vmgroup " + error_info.msg
         logging.error(error_info.msg)
@@ -725,7 +807,7 @@ def _tenant_vm_rm(name, vm_list):
     """ API to remove vms for a tenant """
     logging.debug("_tenant_vm_rm: name=%s vm_list=%s", name, vm_list)
 
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -741,14 +823,12 @@ def _tenant_vm_rm(name, vm_list):
     if error_info:
         return error_info
 
-    error_msg, vms, not_found_vms = generate_tuple_from_vm_list(vm_list)
-    if error_msg:
-        not_found_vm_list = ",".join(not_found_vms)
-        error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, not_found_vm_list)
+    error_info, vms, host_vms = get_vms_from_host(vm_list)
+    if error_info:
         return error_info
 
     # check if vms to be removed have any volumes mounted.
-    error_info = vmdk_utils.check_volumes_mounted(vms)
+    error_info = vmdk_utils.check_volumes_mounted(vms, host_vms)
 
     if error_info:
         error_info.msg = "Cannot complete vmgroup vm rm. " + error_info.msg
@@ -774,7 +854,7 @@ def _tenant_vm_rm(name, vm_list):
 def _tenant_vm_ls(name):
     """ API to get vms for a tenant """
     logging.debug("_tenant_vm_ls: name=%s", name)
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_privileges=False)
     if error_info:
         return error_info, None
 
@@ -791,7 +871,7 @@ def _tenant_vm_replace(name, vm_list):
     """ API to replace vms for a tenant """
     logging.debug("_tenant_vm_replace: name=%s vm_list=%s", name, vm_list)
 
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -807,18 +887,19 @@ def _tenant_vm_replace(name, vm_list):
     if error_info:
         return error_info
 
-    error_msg, vms, not_found_vms = generate_tuple_from_vm_list(vm_list)
+    error_info, vms, host_vms = get_vms_from_host(vm_list)
+    if error_info:
+        return error_info
 
-    if error_msg:
-        not_found_vm_list = ",".join(not_found_vms)
-        error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, not_found_vm_list)
+    error_info, vm_tenants = get_vm_tenants(vms)
+    if error_info:
         return error_info
 
-    error_info = vm_already_in_tenant(name, vms)
+    error_info = vm_already_in_tenant(name, vms, vm_tenants)
     if error_info:
         return error_info
 
-    error_info = vm_in_any_tenant(vms)
+    error_info = vm_in_any_tenant(vms, vm_tenants)
     if error_info:
         return error_info
 
@@ -827,7 +908,7 @@ def _tenant_vm_replace(name, vm_list):
     if error_info:
         return error_info
 
-    error_info = vmdk_utils.check_volumes_mounted(existing_vms)
+    error_info = vmdk_utils.check_volumes_mounted(existing_vms, host_vms)
 
     if error_info:
         error_info.msg = "Cannot complete vmgroup vm replace. " + error_info.msg
@@ -894,7 +975,7 @@ def _tenant_access_add(name, datastore, allow_create=None,
                   "volume_maxsize(MB)=%s volume_totalsize(MB)=%s", name, datastore, allow_create,
                   volume_maxsize_in_MB, volume_totalsize_in_MB)
 
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -1028,7 +1109,7 @@ def _tenant_access_set(name, datastore, allow_create=None, volume_maxsize_in_MB=
 def _tenant_access_rm(name, datastore):
     """ API to remove datastore access for a tenant """
     logging.debug("_tenant_access_rm: name=%s datastore=%s", name, datastore)
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False, with_privileges=False)
     if error_info:
         return error_info
 
@@ -1080,7 +1161,7 @@ def _tenant_access_rm(name, datastore):
 def _tenant_access_ls(name):
     """ Handle tenant access ls command. Returns (ErrInfo, [list of privileges]) """
     logging.debug("_tenant_access_ls: name=%s", name)
-    error_info, tenant = get_tenant_from_db(name)
+    error_info, tenant = get_tenant_from_db(name, with_vms=False)
     if error_info:
         return error_info, None
 
@@ -1089,3 +1170,28 @@ def _tenant_access_ls(name):
         return error_info, None
 
     return None, tenant.privileges
+
+
+@only_when_configured(ret_obj=True)
+def _usage_reconcile(fix=False):
+    """
+    Handle config reconcile command: compare usage counters used for quota checks
+    with volumes table, and recompute the counters if fix is True.
+    Returns (ErrInfo, [list of (tenant_uuid, datastore_url, counter, volumes total)])
+    as before the fix, sizes in MB.
+    """
+    logging.debug("_usage_reconcile: fix=%s", fix)
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    error_msg, drift = auth_mgr.get_usage_drift()
+    if error_msg:
+        return generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg), None
+
+    if fix:
+        error_msg = auth_mgr.recompute_usage()
+        if error_msg:
+            return generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg), None
+
+    return None, drift
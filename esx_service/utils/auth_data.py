@@ -29,20 +29,26 @@ import auth_data_const
 import threadutils
 import log_config
 import auth
+import auth_snapshot
 from error_code import ErrorCode
 from error_code import error_code_to_message
 
 AUTH_DB_PATH = '/etc/vmware/vmdkops/auth-db' # location of auth.db symlink
 CONFIG_DB_NAME = "vmdkops_config.db"         # name of the configuration DB file
 DB_STATE_CHECK_SEC = 300 # interval to check for DB state, in seconds
+DB_BUSY_TIMEOUT_SEC = 10 # how long to wait for a lock held by another connection, in seconds
+MAX_QUERY_PARAMS = 500   # sqlite allows up to 999 parameters per statement
 DB_REF = "Config DB "  # we will use it in logging
 
 # DB schema and VMODL version
 # Bump the DB_MINOR_VER to 1.2
 # in DB version 1.1, _DEFAULT_TENANT will be created using a constant UUID
 # in DB version 1.2, VM name is persisted along with VM uuid in the vms table
+# in DB version 1.3, tenants table has a "weight" column used for request scheduling
+# in DB version 1.4, "usage" table keeps storage used per tenant and datastore (for quota checks)
+# in DB version 1.5, vms table has an index on tenant_id
 DB_MAJOR_VER = 1
-DB_MINOR_VER = 2
+DB_MINOR_VER = 5
 VMODL_MAJOR_VER = 1
 VMODL_MINOR_VER = 0
 
@@ -93,6 +99,56 @@ def all_columns_set(privileges):
 
     return True
 
+# Storage used by volumes of each (tenant, datastore), kept up to date with the
+# volumes table by triggers, so quota checks don't need to sum up the volumes
+USAGE_SCHEMA = """
+    CREATE TABLE usage(
+        -- id in tenants table
+        tenant_id TEXT NOT NULL,
+        -- datastore url
+        datastore_url TEXT NOT NULL,
+        -- The unit of "used_size" is "MB"
+        used_size INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, datastore_url)
+        );
+
+    CREATE TRIGGER volumes_insert_usage AFTER INSERT ON volumes
+    BEGIN
+        INSERT OR IGNORE INTO usage(tenant_id, datastore_url) VALUES (NEW.tenant_id, NEW.datastore_url);
+        UPDATE usage SET used_size = used_size + IFNULL(NEW.volume_size, 0)
+            WHERE tenant_id = NEW.tenant_id AND datastore_url = NEW.datastore_url;
+    END;
+
+    CREATE TRIGGER volumes_delete_usage AFTER DELETE ON volumes
+    BEGIN
+        UPDATE usage SET used_size = used_size - IFNULL(OLD.volume_size, 0)
+            WHERE tenant_id = OLD.tenant_id AND datastore_url = OLD.datastore_url;
+    END;
+
+    CREATE TRIGGER volumes_update_usage AFTER UPDATE OF tenant_id, datastore_url, volume_size ON volumes
+    BEGIN
+        UPDATE usage SET used_size = used_size - IFNULL(OLD.volume_size, 0)
+            WHERE tenant_id = OLD.tenant_id AND datastore_url = OLD.datastore_url;
+        INSERT OR IGNORE INTO usage(tenant_id, datastore_url) VALUES (NEW.tenant_id, NEW.datastore_url);
+        UPDATE usage SET used_size = used_size + IFNULL(NEW.volume_size, 0)
+            WHERE tenant_id = NEW.tenant_id AND datastore_url = NEW.datastore_url;
+    END;
+    """
+
+# Indexes for lookups by tenant. privileges, volumes and usage tables don't need
+# one, as tenant_id is the first column of their primary key
+INDEX_SCHEMA = """
+    CREATE INDEX IF NOT EXISTS vms_tenant_id ON vms(tenant_id);
+    """
+
+# (Re)compute "usage" table from volumes table
+USAGE_RECOMPUTE_SQL = """
+    DELETE FROM usage;
+    INSERT INTO usage(tenant_id, datastore_url, used_size)
+        SELECT tenant_id, datastore_url, IFNULL(SUM(volume_size), 0) FROM volumes
+        GROUP BY tenant_id, datastore_url;
+    """
+
 def get_version_str(major_ver, minor_ver):
     res = str(major_ver) + "." + str(minor_ver)
     return res
@@ -172,13 +228,15 @@ class DockerVolumeTenant:
 
     """
 
-    def __init__(self, name, description, vms, privileges, id=None, default_datastore_url=None):
+    def __init__(self, name, description, vms, privileges, id=None, default_datastore_url=None,
+                 weight=auth_data_const.DEFAULT_TENANT_WEIGHT):
         """ Construct a DockerVolumeTenant object. """
         self.name = name
         self.description = description
         self.vms = vms
         self.privileges = privileges
         self.default_datastore_url = default_datastore_url
+        self.weight = weight
         if not id:
             self.id = str(uuid.uuid4())
         else:
@@ -195,8 +253,9 @@ class DockerVolumeTenant:
                     vms
                 )
                 conn.commit()
+                auth_snapshot.invalidate()
             except sqlite3.Error as e:
-
+                conn.rollback()
                 logging.error("Error %s when inserting into vms table with vms %s",
                               e, vms)
                 return str(e)
@@ -214,7 +273,9 @@ class DockerVolumeTenant:
                 vms
             )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
+            conn.rollback()
             logging.error("Error %s when removing from vms table with vms %s",
                           e, vms)
             return str(e)
@@ -237,7 +298,10 @@ class DockerVolumeTenant:
                 vms
             )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
+            # drop the DELETE too, so the tenant keeps its old VMs
+            conn.rollback()
             logging.error("Error %s when replace vms table with vms %s",
                           e, vms)
             return str(e)
@@ -254,6 +318,7 @@ class DockerVolumeTenant:
                 (new_name, tenant_id)
             )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when updating tenants table with tenant_id"
                           "tenant_id %s", e, tenant_id)
@@ -293,6 +358,7 @@ class DockerVolumeTenant:
                 (description, tenant_id)
                 )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when updating tenants table with tenant_id"
                           "tenant_id %s", e, tenant_id)
@@ -310,12 +376,31 @@ class DockerVolumeTenant:
                 (datastore_url, tenant_id)
                 )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when setting default datastore for tenant_id %s",
                           e, tenant_id)
             return str(e)
         return None
 
+    def set_weight(self, conn, weight):
+        """ Set scheduling weight for this tenant."""
+        logging.debug("set_weight: for tenant=%s to weight=%d", self.id, weight)
+        tenant_id = self.id
+        try:
+            conn.execute(
+                "UPDATE tenants SET weight = ? WHERE id = ?",
+                (weight, tenant_id)
+                )
+            conn.commit()
+            auth_snapshot.invalidate()
+        except sqlite3.Error as e:
+            logging.error("Error %s when setting weight for tenant_id %s",
+                          e, tenant_id)
+            return str(e)
+        self.weight = weight
+        return None
+
     def get_default_datastore(self, conn):
         """
         Get default_datastore url for this tenant
@@ -398,6 +483,7 @@ class DockerVolumeTenant:
                     update_list
                 )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when setting datastore and privileges for tenant_id %s",
                           e, tenant_id)
@@ -414,6 +500,7 @@ class DockerVolumeTenant:
                 [tenant_id, datastore_url]
             )
             conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when removing from privileges table with tenant_id%s and "
                           "datastore %s", e, tenant_id, datastore_url)
@@ -566,7 +653,7 @@ class AuthorizationDataManager:
                         UPDATE vms SET vm_name=name_from_uuid(vm_id);
                         UPDATE versions SET major_ver = {}, minor_ver = {};
                      """
-            sql_script = script.format(DB_MAJOR_VER, DB_MINOR_VER)
+            sql_script = script.format(1, 2)
             self.conn.executescript(sql_script)
 
             logging.info("handle_upgrade_1_1_to_1_2: update vms table Done")
@@ -608,6 +695,68 @@ class AuthorizationDataManager:
             logging.error("handle_upgrade_1_1_to_1_2. %s", error_msg)
             raise DbUpgradeError(self.db_path, error_msg)
 
+    def handle_upgrade_1_2_to_1_3(self):
+        """
+        Upgrade the db from version 1.2 to 1.3
+        In 1.3 the tenants table has a new column "weight", which is the share of
+        the service request processing given to VMs of the tenant when the service is busy.
+        Existing tenants get the default weight.
+        """
+        try:
+            logging.info("handle_upgrade_1_2_to_1_3: Start")
+            script = """ALTER TABLE tenants ADD COLUMN weight INTEGER NOT NULL DEFAULT {};
+                        UPDATE versions SET major_ver = {}, minor_ver = {};
+                     """
+            sql_script = script.format(auth_data_const.DEFAULT_TENANT_WEIGHT, 1, 3)
+            self.conn.executescript(sql_script)
+            self.conn.commit()
+            logging.info("handle_upgrade_1_2_to_1_3: add weight column to tenants table Done")
+            return None
+        except sqlite3.Error as e:
+            error_msg = "Error when upgrading auth DB table({})".format(str(e))
+            logging.error("handle_upgrade_1_2_to_1_3. %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
+
+    def handle_upgrade_1_3_to_1_4(self):
+        """
+        Upgrade the db from version 1.3 to 1.4
+        In 1.4 the new "usage" table keeps the storage used by each tenant on each
+        datastore, maintained by triggers on volumes table. It is filled from
+        the existing volumes.
+        """
+        try:
+            logging.info("handle_upgrade_1_3_to_1_4: Start")
+            script = USAGE_SCHEMA + USAGE_RECOMPUTE_SQL + """
+                        UPDATE versions SET major_ver = {}, minor_ver = {};
+                     """.format(1, 4)
+            self.conn.executescript(script)
+            self.conn.commit()
+            logging.info("handle_upgrade_1_3_to_1_4: create usage table Done")
+            return None
+        except sqlite3.Error as e:
+            error_msg = "Error when upgrading auth DB table({})".format(str(e))
+            logging.error("handle_upgrade_1_3_to_1_4. %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
+
+    def handle_upgrade_1_4_to_1_5(self):
+        """
+        Upgrade the db from version 1.4 to 1.5
+        In 1.5 vms table has an index on tenant_id, used to get VMs of a tenant.
+        """
+        try:
+            logging.info("handle_upgrade_1_4_to_1_5: Start")
+            script = INDEX_SCHEMA + """
+                        UPDATE versions SET major_ver = {}, minor_ver = {};
+                     """.format(1, 5)
+            self.conn.executescript(script)
+            self.conn.commit()
+            logging.info("handle_upgrade_1_4_to_1_5: create indexes Done")
+            return None
+        except sqlite3.Error as e:
+            error_msg = "Error when upgrading auth DB table({})".format(str(e))
+            logging.error("handle_upgrade_1_4_to_1_5. %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
+
     def __handle_upgrade(self):
         error_msg, major_ver, minor_ver = self.__get_db_version()
         if error_msg:
@@ -619,13 +768,24 @@ class AuthorizationDataManager:
         if major_ver == DB_MAJOR_VER and minor_ver == DB_MINOR_VER:
             return
 
-        if DB_MAJOR_VER == 1 and DB_MINOR_VER == 2:
-            if major_ver == 1 and minor_ver == 1:
-                self.handle_upgrade_1_1_to_1_2()
-            else:
-                error_msg = "Upgrade is not supported for auth-db schema version {}.{} to {}.{}. Refer to VDVS release versions".format(major_ver, minor_ver, DB_MAJOR_VER, DB_MINOR_VER)
-                logging.error("__handle_upgrade: %s", error_msg)
-                raise DbUpgradeError(self.db_path, error_msg)
+        # upgrade step by step, each step bumps the version in DB
+        if major_ver == 1 and minor_ver == 1:
+            self.handle_upgrade_1_1_to_1_2()
+            minor_ver = 2
+        if major_ver == 1 and minor_ver == 2:
+            self.handle_upgrade_1_2_to_1_3()
+            minor_ver = 3
+        if major_ver == 1 and minor_ver == 3:
+            self.handle_upgrade_1_3_to_1_4()
+            minor_ver = 4
+        if major_ver == 1 and minor_ver == 4:
+            self.handle_upgrade_1_4_to_1_5()
+            minor_ver = 5
+
+        if major_ver != DB_MAJOR_VER or minor_ver != DB_MINOR_VER:
+            error_msg = "Upgrade is not supported for auth-db schema version {}.{} to {}.{}. Refer to VDVS release versions".format(major_ver, minor_ver, DB_MAJOR_VER, DB_MINOR_VER)
+            logging.error("__handle_upgrade: %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
 
     def __connect(self):
         """
@@ -637,7 +797,9 @@ class AuthorizationDataManager:
             self.__close()
 
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # connections are pooled (see auth.AuthMgrPool), and may be used by
+            # another thread once the thread which opened it is done with it
+            self.conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT_SEC, check_same_thread=False)
         except sqlite3.Error as e:
             logging.error("Failed to connect to DB (%s): %s", self.db_path, e)
             raise DbConnectionError(self.db_path)
@@ -645,12 +807,22 @@ class AuthorizationDataManager:
         # Use return rows as Row instances instead of tuples
         self.conn.row_factory = sqlite3.Row
 
-    def connect(self):
+    def connect(self, mode=None):
         """
         Connect to a sqlite database at `db_path`. Validates mode, checks for upgrades.
         If the DB does not exist, simply exists leving self.__mode as NotConfigured
+        If 'mode' (a DBMode value) is passed, it is the mode found by connect() of another
+        instance for the same `db_path`, and mode discovery and upgrade are skipped.
         """
 
+        if mode is not None:
+            self.__mode = mode
+            if self.__mode == DBMode.BrokenLink:
+                raise DbAccessError(self.db_path, DBMode(self.__mode))
+            if self.__mode != DBMode.NotConfigured:
+                self.__connect()
+            return
+
         self.__mode = self.__discover_mode_and_connect()
 
         if self.__mode == DBMode.BrokenLink:
@@ -661,6 +833,39 @@ class AuthorizationDataManager:
             return
 
         self.__handle_upgrade()
+        self.__set_journal_mode()
+
+    def __set_journal_mode(self):
+        """
+        Use WAL journal for a local (SingleNode) DB, so readers don't block on writers
+        and the other way around. WAL needs shared memory between all users of the DB, which
+        is not available across ESX hosts, so a DB on a shared datastore (MultiNode) keeps
+        the rollback journal. Failures are not fatal, the DB stays in its current mode.
+        """
+        journal_mode = "wal" if self.__mode == DBMode.SingleNode else "delete"
+        try:
+            cur = self.conn.execute("PRAGMA journal_mode = {}".format(journal_mode))
+            result = cur.fetchone()[0]
+        except sqlite3.Error as e:
+            logging.warning("Failed to set journal mode %s for %s: %s", journal_mode, self.db_path, e)
+            return
+        if result != journal_mode:
+            logging.warning("Failed to set journal mode %s for %s, using %s",
+                            journal_mode, self.db_path, result)
+        else:
+            logging.debug("Journal mode for %s: %s", self.db_path, result)
+
+    def checkpoint(self):
+        """
+        Copy WAL content (if any) to the DB file, so the DB file can be copied or moved on its own.
+        Returns None for success, error string for errors.
+        """
+        try:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logging.error("Error %s when checkpointing %s", e, self.db_path)
+            return str(e)
+        return None
 
     @property
     def mode(self):
@@ -785,8 +990,10 @@ class AuthorizationDataManager:
                     -- this field can be changed laster by using set_description API
                     description TEXT,
                     -- default_datastore url
-                    default_datastore_url TEXT
-                    )''')
+                    default_datastore_url TEXT,
+                    -- share of request processing for VMs in this tenant when the service is busy
+                    weight INTEGER NOT NULL DEFAULT {0}
+                    )'''.format(auth_data_const.DEFAULT_TENANT_WEIGHT))
 
             self.conn.execute('''
             CREATE TABLE vms(
@@ -832,6 +1039,9 @@ class AuthorizationDataManager:
                 FOREIGN KEY(tenant_id) REFERENCES tenants(id)
                 );''')
 
+            self.conn.executescript(USAGE_SCHEMA)
+            self.conn.executescript(INDEX_SCHEMA)
+
             self.conn.execute('''
             CREATE TABLE versions (
                 id INTEGER PRIMARY KEY NOT NULL,
@@ -916,6 +1126,7 @@ class AuthorizationDataManager:
                     privileges
                 )
             self.conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when creating tenant for tenant_name %s tenant_id %s",
                           e, tenant.name, tenant.id)
@@ -1017,124 +1228,102 @@ class AuthorizationDataManager:
 
 
 
-    def get_tenant(self, tenant_name):
+    def __load_tenants(self, tenant_name=None, with_vms=True, with_privileges=True):
+        """
+        Return a list of DockerVolumeTenant objects for all tenants, or for the tenant
+        with 'tenant_name' only. VMs and privileges of all the tenants are read with one
+        query each and matched to tenants in memory.
+        If 'with_vms' or 'with_privileges' is False, the corresponding list is not read
+        from DB and is left empty in the returned objects.
+        Raises sqlite3.Error on failures.
+        """
+        if tenant_name is None:
+            tenant_filter, params = "", ()
+        else:
+            tenant_filter, params = " WHERE tenants.name = ?", (tenant_name,)
+
+        tenant_rows = self.conn.execute("SELECT * FROM tenants" + tenant_filter, params).fetchall()
+        if not tenant_rows:
+            return []
+
+        # {tenant_id: list of rows}
+        vms = {}
+        if with_vms:
+            cur = self.conn.execute("SELECT vms.* FROM vms JOIN tenants ON vms.tenant_id = tenants.id" +
+                                    tenant_filter, params)
+            for r in cur:
+                vms.setdefault(r[auth_data_const.COL_TENANT_ID], []).append(r)
+
+        privileges = {}
+        if with_privileges:
+            cur = self.conn.execute("SELECT privileges.* FROM privileges "
+                                    "JOIN tenants ON privileges.tenant_id = tenants.id" +
+                                    tenant_filter, params)
+            for r in cur:
+                privileges.setdefault(r[auth_data_const.COL_TENANT_ID], []).append(r)
+
+        tenant_list = []
+        for r in tenant_rows:
+            id = r[auth_data_const.COL_ID]
+            tenant = DockerVolumeTenant(name=r[auth_data_const.COL_NAME],
+                                        description=r[auth_data_const.COL_DESCRIPTION],
+                                        vms=create_vm_list(vms.get(id, [])),
+                                        privileges=create_datastore_access_privileges(privileges.get(id, [])),
+                                        id=id,
+                                        default_datastore_url=r[auth_data_const.COL_DEFAULT_DATASTORE_URL],
+                                        weight=r[auth_data_const.COL_WEIGHT])
+            tenant_list.append(tenant)
+
+        return tenant_list
+
+    def __get_default_tenant_for_all_access(self, with_privileges=True):
+        """ Return DockerVolumeTenant object for _DEFAULT tenant when DB is not configured """
+        return DockerVolumeTenant(name=auth_data_const.DEFAULT_TENANT,
+                                  description=auth_data_const.DEFAULT_TENANT_DESCR,
+                                  vms=[],
+                                  privileges=self.get_default_privileges_dict() if with_privileges else [],
+                                  id=auth_data_const.DEFAULT_TENANT_UUID,
+                                  default_datastore_url=auth_data_const.VM_DS_URL)
+
+    def get_tenant(self, tenant_name, with_vms=True, with_privileges=True):
         """
         Return an (err, obj) where err is None or error code,
         and obj is an object which match the given tenant_name or None
+        If 'with_vms' or 'with_privileges' is False, obj.vms or obj.privileges
+        is not read from DB and is left empty.
         """
         logging.debug("auth_data.get_tenant: tenant_name=%s", tenant_name)
 
         if self.allow_all_access():
             if tenant_name == auth_data_const.DEFAULT_TENANT:
-                return None, DockerVolumeTenant(name=tenant_name,
-                                                description=auth_data_const.DEFAULT_TENANT_DESCR,
-                                                vms=[],
-                                                privileges=self.get_default_privileges_dict(),
-                                                id=auth_data_const.DEFAULT_TENANT_UUID,
-                                                default_datastore_url=auth_data_const.VM_DS_URL)
+                return None, self.__get_default_tenant_for_all_access(with_privileges)
             else:
                 return ErrorCode.INIT_NEEDED, None
 
-        tenant = None
         try:
-            cur = self.conn.execute(
-                "SELECT * FROM tenants WHERE name = ?",
-                (tenant_name,)
-            )
-            result = cur.fetchall()
-
-            for r in result:
-                # loop through each tenant
-                id = r[auth_data_const.COL_ID]
-                name = r[auth_data_const.COL_NAME]
-                description = r[auth_data_const.COL_DESCRIPTION]
-                default_datastore_url = r[auth_data_const.COL_DEFAULT_DATASTORE_URL]
-
-                # search vms for this tenant
-                vms = []
-                cur = self.conn.execute(
-                    "SELECT * FROM vms WHERE tenant_id = ?",
-                    (id,)
-                )
-                vms = cur.fetchall()
-
-                logging.debug("vms=%s", vms)
-                vm_list = create_vm_list(vms)
-
-                # search privileges and default_privileges for this tenant
-                privileges = []
-                cur = self.conn.execute(
-                    "SELECT * FROM privileges WHERE tenant_id = ?",
-                    (id,)
-                )
-                privileges = cur.fetchall()
-                ds_access_privileges = create_datastore_access_privileges(privileges)
-
-                logging.debug("privileges=%s", privileges)
-                logging.debug("ds_access_privileges=%s", ds_access_privileges)
-
-                tenant = DockerVolumeTenant(name=name,
-                                            description=description,
-                                            vms=vm_list,
-                                            privileges=ds_access_privileges,
-                                            id=id,
-                                            default_datastore_url=default_datastore_url)
+            tenant_list = self.__load_tenants(tenant_name, with_vms, with_privileges)
         except sqlite3.Error as e:
             logging.error("Error %s in get_tenant(%s)", e, tenant_name)
-            return ErrorCode.SQLITE3_ERROR, tenant
+            return ErrorCode.SQLITE3_ERROR, None
 
-        return None, tenant
+        if not tenant_list:
+            return None, None
+        return None, tenant_list[0]
 
-    def list_tenants(self):
-        """ Return a list of DockerVolumeTenants objects. """
+    def list_tenants(self, with_vms=True, with_privileges=True):
+        """
+        Return a list of DockerVolumeTenants objects.
+        If 'with_vms' or 'with_privileges' is False, VMs or privileges of the
+        tenants are not read from DB and are left empty.
+        """
         if self.allow_all_access():
-            _, tenant = self.get_tenant(auth_data_const.DEFAULT_TENANT)
-            return None, [tenant]
+            return None, [self.__get_default_tenant_for_all_access(with_privileges)]
 
-        tenant_list = []
         try:
-            cur = self.conn.execute(
-                "SELECT * FROM tenants"
-            )
-            result = cur.fetchall()
-
-            for r in result:
-                # loop through each tenant
-                id = r[auth_data_const.COL_ID]
-                name = r[auth_data_const.COL_NAME]
-                description = r[auth_data_const.COL_DESCRIPTION]
-                default_datastore_url = r[auth_data_const.COL_DEFAULT_DATASTORE_URL]
-
-                # search vms for this tenant
-                vms = []
-                cur = self.conn.execute(
-                    "SELECT * FROM vms WHERE tenant_id = ?",
-                    (id,)
-                )
-                vms = cur.fetchall()
-                vm_list = create_vm_list(vms)
-                # search privileges and default_privileges for this tenant
-                privileges = []
-                cur = self.conn.execute(
-                    "SELECT * FROM privileges WHERE tenant_id = ?",
-                    (id,)
-                )
-                privileges = cur.fetchall()
-                ds_access_privileges = create_datastore_access_privileges(privileges)
-
-                logging.debug("privileges=%s", privileges)
-                logging.debug("ds_access_privileges=%s", ds_access_privileges)
-
-                tenant = DockerVolumeTenant(name=name,
-                                            description=description,
-                                            vms=vm_list,
-                                            privileges=ds_access_privileges,
-                                            id=id,
-                                            default_datastore_url=default_datastore_url)
-                tenant_list.append(tenant)
+            tenant_list = self.__load_tenants(with_vms=with_vms, with_privileges=with_privileges)
         except sqlite3.Error as e:
             logging.error("Error %s when listing all tenants", e)
-            return str(e), tenant_list
+            return str(e), []
 
         return None, tenant_list
 
@@ -1150,6 +1339,7 @@ class AuthorizationDataManager:
                 [tenant_id]
             )
             self.conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when removing volumes from volumes table for tenant_id %s",
                           e, tenant_id)
@@ -1157,6 +1347,45 @@ class AuthorizationDataManager:
 
         return None
 
+    def get_usage_drift(self):
+        """
+        Compare "usage" table with the storage used according to volumes table.
+        Return value:
+        -- error_msg: return None on success or error string
+        -- result: list of (tenant_id, datastore_url, used_size in "usage" table,
+           sum of volume sizes in volumes table), one for each (tenant, datastore)
+           found in either table
+        """
+        try:
+            cur = self.conn.execute("""
+                SELECT tenant_id, datastore_url, SUM(used_size), SUM(volume_size)
+                FROM (SELECT tenant_id, datastore_url, used_size, 0 AS volume_size FROM usage
+                      UNION ALL
+                      SELECT tenant_id, datastore_url, 0, IFNULL(volume_size, 0) FROM volumes)
+                GROUP BY tenant_id, datastore_url
+                """)
+            result = cur.fetchall()
+        except sqlite3.Error as e:
+            logging.error("Error %s when comparing usage and volumes tables", e)
+            return str(e), None
+
+        return None, [tuple(row) for row in result]
+
+    def recompute_usage(self):
+        """
+        Recompute "usage" table from volumes table.
+        Returns None for success, error string for errors.
+        """
+        try:
+            self.conn.executescript("BEGIN;" + USAGE_RECOMPUTE_SQL + "COMMIT;")
+            auth_snapshot.invalidate()
+        except sqlite3.Error as e:
+            logging.error("Error %s when recomputing usage table", e)
+            self.conn.rollback()
+            return str(e)
+
+        return None
+
     def remove_symlink_for_tenant(self, tenant_id):
         """
             Delete the symlink /vmfs/volume/datastore_name/tenant_name
@@ -1253,7 +1482,7 @@ class AuthorizationDataManager:
         """
         Remove a tenant with given id.
         A row with given tenant_id will be removed from table tenants, vms,
-        and privileges.
+        privileges and usage.
         If remove_volumes is True -  all volumes for this tenant will be removed as well.
         Returns None for success, error string for errors.
         """
@@ -1276,12 +1505,17 @@ class AuthorizationDataManager:
                 "DELETE FROM privileges WHERE tenant_id = ?",
                 [tenant_id]
             )
+            self.conn.execute(
+                "DELETE FROM usage WHERE tenant_id = ?",
+                [tenant_id]
+            )
             self.conn.execute(
                 "DELETE FROM tenants WHERE id = ?",
                 [tenant_id]
             )
 
             self.conn.commit()
+            auth_snapshot.invalidate()
         except sqlite3.Error as e:
             logging.error("Error %s when removing tables", e)
             return str(e)
@@ -1318,6 +1552,33 @@ class AuthorizationDataManager:
             logging.debug("get_tenant_name:"+error_msg)
             return error_msg, None
 
+    def get_vm_tenants(self, vm_ids):
+        """
+        Return (error_msg, {vm_id: (tenant_id, tenant_name)}) for VMs from 'vm_ids'
+        which belong to a tenant. VMs which are not in any tenant are not in the result.
+        """
+        if self.allow_all_access():
+            return None, {}
+
+        vm_ids = list(vm_ids)
+        vm_tenants = {}
+        try:
+            # keep the number of query parameters under sqlite limit
+            for i in range(0, len(vm_ids), MAX_QUERY_PARAMS):
+                chunk = vm_ids[i:i + MAX_QUERY_PARAMS]
+                cur = self.conn.execute(
+                    "SELECT vms.vm_id, tenants.id, tenants.name FROM vms "
+                    "JOIN tenants ON vms.tenant_id = tenants.id "
+                    "WHERE vms.vm_id IN ({})".format(",".join("?" * len(chunk))),
+                    chunk)
+                for vm_id, tenant_id, tenant_name in cur:
+                    vm_tenants[vm_id] = (tenant_id, tenant_name)
+        except sqlite3.Error as e:
+            logging.error("Error %s when querying tenants of vms %s", e, vm_ids)
+            return str(e), None
+
+        return None, vm_tenants
+
 def main():
     log_config.configure()
 
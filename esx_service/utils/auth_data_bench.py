@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for auth DB queries on a large config.
+# Creates a scratch auth DB with many tenants and VMs, and reports latency of
+# the queries used by request authorization and vmgroup commands, with and
+# without the indexes added in DB version 1.5.
+#
+# Not shipped in the VIB. "make test-esx" copies it to ESX along with the tests
+# and the service code, run it from there:
+#   python auth_data_bench.py [--tenants N] [--vms N] [--iterations N]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import auth
+import auth_data
+
+DS_URL = "/vmfs/volumes/bench-datastore"
+
+
+def populate(conn, tenants, vms):
+    """ Insert 'tenants' tenants and 'vms' VMs (spread evenly across tenants). Returns tenant ids """
+    tenant_ids = [str(uuid.uuid4()) for _ in range(tenants)]
+    conn.executemany("INSERT INTO tenants(id, name, description, default_datastore_url) VALUES (?, ?, ?, ?)",
+                     [(tid, "vmgroup_{}".format(i), "bench", DS_URL) for i, tid in enumerate(tenant_ids)])
+    conn.executemany("INSERT INTO vms(vm_id, tenant_id, vm_name) VALUES (?, ?, ?)",
+                     [(str(uuid.uuid4()), tenant_ids[i % tenants], "vm_{}".format(i)) for i in range(vms)])
+    conn.executemany("INSERT INTO privileges(tenant_id, datastore_url, allow_create, max_volume_size, usage_quota) "
+                     "VALUES (?, ?, 1, 0, 0)",
+                     [(tid, DS_URL) for tid in tenant_ids])
+    conn.commit()
+    return tenant_ids
+
+
+def measure(func, iterations):
+    """ Call func() 'iterations' times, return (avg, p50, p99) latency in ms """
+    times = []
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return (sum(times) / len(times),
+            times[len(times) // 2],
+            times[min(len(times) - 1, int(len(times) * 0.99))])
+
+
+def run_queries(mgr, tenant_ids, vm_ids, iterations):
+    """ Return a list of (query name, (avg, p50, p99)) """
+    conn = mgr.conn
+    queries = [
+        ("VM to vmgroup", lambda: conn.execute("SELECT tenant_id FROM vms WHERE vm_id = ?",
+                                               (random.choice(vm_ids),)).fetchall()),
+        ("VMs of vmgroup", lambda: auth.get_row_from_vms_table(conn, random.choice(tenant_ids))),
+        ("privileges of vmgroup", lambda: auth.get_row_from_privileges_table(conn, random.choice(tenant_ids))),
+        ("vmgroup by name", lambda: mgr.get_tenant("vmgroup_{}".format(random.randrange(len(tenant_ids))))),
+    ]
+    results = [(name, measure(func, iterations)) for name, func in queries]
+    # listing all vmgroups is slow, don't run it as many times
+    results.append(("list all vmgroups", measure(mgr.list_tenants, max(1, iterations // 100))))
+    return results
+
+
+def print_results(title, results):
+    print(title)
+    print("  {:<24} {:>10} {:>10} {:>10}".format("query", "avg(ms)", "p50(ms)", "p99(ms)"))
+    for name, (avg, p50, p99) in results:
+        print("  {:<24} {:>10.3f} {:>10.3f} {:>10.3f}".format(name, avg, p50, p99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark auth DB queries")
+    parser.add_argument("--tenants", type=int, default=1000, help="number of vmgroups")
+    parser.add_argument("--vms", type=int, default=10000, help="number of VMs")
+    parser.add_argument("--iterations", type=int, default=1000, help="queries to run per measurement")
+    args = parser.parse_args()
+
+    fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    os.remove(db_path)
+    mgr = auth_data.AuthorizationDataManager(db_path)
+    try:
+        err = mgr.new_db()
+        if err:
+            print("Failed to create DB {}: {}".format(db_path, err))
+            return 1
+        mgr.connect()
+
+        start = time.time()
+        tenant_ids = populate(mgr.conn, args.tenants, args.vms)
+        vm_ids = [r[0] for r in mgr.conn.execute("SELECT vm_id FROM vms").fetchall()]
+        print("Created {} vmgroups and {} VMs in {:.1f}s (journal mode {})".format(
+              args.tenants, args.vms, time.time() - start,
+              mgr.conn.execute("PRAGMA journal_mode").fetchone()[0]))
+
+        print_results("With indexes:", run_queries(mgr, tenant_ids, vm_ids, args.iterations))
+
+        mgr.conn.execute("DROP INDEX vms_tenant_id")
+        mgr.conn.commit()
+        print_results("Without indexes:", run_queries(mgr, tenant_ids, vm_ids, args.iterations))
+    finally:
+        del mgr
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,6 +20,7 @@ COL_ID = 'id'
 COL_NAME = 'name'
 COL_DESCRIPTION = 'description'
 COL_DEFAULT_DATASTORE_URL = 'default_datastore_url'
+COL_WEIGHT = 'weight'
 
 # column name in vms table
 COL_VM_ID = 'vm_id'
@@ -43,6 +44,11 @@ DEFAULT_DS  = '_DEFAULT'
 DEFAULT_DS_URL = DEFAULT_DS + "_URL"
 ORPHAN_TENANT = "_ORPHAN"
 
+# tenant weight (share of request processing when the service is busy) constants
+DEFAULT_TENANT_WEIGHT = 1
+MIN_TENANT_WEIGHT = 1
+MAX_TENANT_WEIGHT = 100
+
 VM_DS = '_VM_DS'
 VM_DS_URL = VM_DS + "://"
 ALL_DS = '_ALL_DS'
@@ -24,6 +24,7 @@ import auth
 import log_config
 import glob
 import random
+import threading
 
 ADMIN_CLI = '/usr/lib/vmware/vmdkops/bin/vmdkops_admin.py'
 # Admin CLI to control config DB init
@@ -257,6 +258,26 @@ class TestAuthDataModel(unittest.TestCase):
         actual_output = tenants_row[auth_data_const.COL_DEFAULT_DATASTORE_URL]
         self.assertEqual(actual_output, expected_output)
 
+    def test_set_weight(self):
+        vms = [(self.vm1_uuid, self.vm1_name)]
+        privileges = self.get_privileges()
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Some tenant',
+                                                          vms=vms,
+                                                          privileges=privileges)
+
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenant1.weight, auth_data_const.DEFAULT_TENANT_WEIGHT)
+        error_info = tenant1.set_weight(self.auth_mgr.conn, 5)
+        self.assertEqual(error_info, None)
+        # Check tenants table
+        error_info, tenants_row = auth.get_row_from_tenants_table(self.auth_mgr.conn, tenant1.id)
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenants_row[auth_data_const.COL_WEIGHT], 5)
+        error_info, weight = auth.get_tenant_weight(tenant1.id)
+        self.assertEqual(error_info, None)
+        self.assertEqual(weight, 5)
+
     def test_add_datastore_access_privileges(self):
         vms = [(self.vm1_uuid, self.vm1_name)]
         privileges = []
@@ -417,6 +438,57 @@ class TestAuthDataModel(unittest.TestCase):
 
         self.assertEqual(tenant2_actual_output, tenant2_expected_output)
 
+    def test_list_tenants_projection(self):
+        vms = [(self.vm1_uuid, self.vm1_name)]
+        privileges = self.get_privileges()
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Some tenant',
+                                                          vms=vms,
+                                                          privileges=privileges)
+        self.assertEqual(error_info, None)
+
+        error_info, tenants_list = self.auth_mgr.list_tenants(with_vms=False, with_privileges=False)
+        self.assertEqual(error_info, None)
+        tenant1_idx = self.get_tenant_idx(tenants_list, tenant1.id)
+        self.assertNotEqual(tenant1_idx, -1)
+        self.assertEqual(tenants_list[tenant1_idx].name, self.tenant_name)
+        self.assertEqual(tenants_list[tenant1_idx].vms, [])
+        self.assertEqual(tenants_list[tenant1_idx].privileges, [])
+
+        error_info, tenant = self.auth_mgr.get_tenant(self.tenant_name, with_privileges=False)
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenant.id, tenant1.id)
+        self.assertEqual(tenant.vms, vms)
+        self.assertEqual(tenant.privileges, [])
+
+        error_info, tenant = self.auth_mgr.get_tenant(self.tenant_name, with_vms=False)
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenant.vms, [])
+        self.assertEqual(len(tenant.privileges), len(privileges))
+
+        error_info, tenant = self.auth_mgr.get_tenant("no_such_tenant")
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenant, None)
+
+    def test_get_vm_tenants(self):
+        vms = [(self.vm1_uuid, self.vm1_name), (self.vm2_uuid, self.vm2_name)]
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Some tenant',
+                                                          vms=vms,
+                                                          privileges=[])
+        self.assertEqual(error_info, None)
+
+        error_info, vm_tenants = self.auth_mgr.get_vm_tenants([self.vm1_uuid, self.vm2_uuid, self.vm3_uuid])
+        self.assertEqual(error_info, None)
+        self.assertEqual(vm_tenants, {self.vm1_uuid: (tenant1.id, self.tenant_name),
+                                      self.vm2_uuid: (tenant1.id, self.tenant_name)})
+
+        # more VMs than fit in one query
+        vm_ids = [str(uuid.uuid4()) for _ in range(auth_data.MAX_QUERY_PARAMS)] + [self.vm2_uuid]
+        error_info, vm_tenants = self.auth_mgr.get_vm_tenants(vm_ids)
+        self.assertEqual(error_info, None)
+        self.assertEqual(list(vm_tenants.keys()), [self.vm2_uuid])
+
 
     def test_remove_tenants(self):
         vms = [(self.vm1_uuid, self.vm1_name)]
@@ -461,6 +533,71 @@ class TestAuthDataModel(unittest.TestCase):
         self.assertEqual(error_info, None)
         self.assertEqual(privileges_row, [])
 
+    def test_usage(self):
+        """ Test usage table follows volumes table """
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Some tenant',
+                                                          vms=[],
+                                                          privileges=self.get_privileges())
+        self.assertEqual(error_info, None)
+        datastore_url = self.get_datastore_url('datastore1')
+        conn = self.auth_mgr.conn
+        conn.execute("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                     (tenant1.id, datastore_url, "vol1", 100))
+        conn.execute("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                     (tenant1.id, datastore_url, "vol2", 200))
+        conn.execute("DELETE FROM volumes WHERE tenant_id = ? AND volume_name = ?", (tenant1.id, "vol1"))
+        conn.commit()
+
+        def get_drift():
+            error_info, drift = self.auth_mgr.get_usage_drift()
+            self.assertEqual(error_info, None)
+            return [row for row in drift if row[0] == tenant1.id]
+
+        self.assertEqual(get_drift(), [(tenant1.id, datastore_url, 200, 200)])
+
+        # counters out of sync are fixed by recompute_usage()
+        conn.execute("UPDATE usage SET used_size = 1000 WHERE tenant_id = ?", (tenant1.id,))
+        conn.commit()
+        self.assertEqual(get_drift(), [(tenant1.id, datastore_url, 1000, 200)])
+        self.assertEqual(self.auth_mgr.recompute_usage(), None)
+        self.assertEqual(get_drift(), [(tenant1.id, datastore_url, 200, 200)])
+
+        error_info = self.auth_mgr.remove_tenant(tenant1.id, False)
+        self.assertEqual(error_info, None)
+
+class TestAuthMgrPool(unittest.TestCase):
+    """ Test sharing of auth DB connections by auth.AuthMgrPool """
+
+    def test_reuse(self):
+        pool = auth.AuthMgrPool(TestAuthDataModel.db_path)
+        error_msg, auth_mgr = pool.get()
+        self.assertEqual(error_msg, None)
+        self.assertEqual(auth_mgr.mode, auth_data.DBMode.SingleNode)
+        # a thread keeps its connection
+        self.assertIs(pool.get()[1], auth_mgr)
+
+        # another thread gets its own connection, without mode discovery,
+        # and returns it to the pool when it exits
+        results = []
+        t = threading.Thread(target=lambda: results.append(pool.get()))
+        t.start()
+        t.join()
+        error_msg, other_auth_mgr = results[0]
+        self.assertEqual(error_msg, None)
+        self.assertIsNot(other_auth_mgr, auth_mgr)
+        self.assertEqual(other_auth_mgr.mode, auth_data.DBMode.SingleNode)
+        stats = pool.stats()
+        self.assertEqual(stats["discoveries"], 1)
+        self.assertEqual(stats["connects"], 2)
+        self.assertEqual(stats["idle"], 1)
+
+        t = threading.Thread(target=lambda: results.append(pool.get()))
+        t.start()
+        t.join()
+        self.assertIs(results[1][1], other_auth_mgr)
+        self.assertEqual(pool.stats()["connects"], 2)
+
 def setUpModule():
     # Let's make sure we are testing a local DB
     os.system(ADMIN_RM_LOCAL_AUTH_DB)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-memory snapshot of the authorization data in auth DB.
+# Tenants, VMs, privileges and per datastore usage counters are small and change
+# rarely, so the service keeps all of them in an AuthSnapshot and authorizes
+# requests without going to the DB (which in MultiNode mode is on a shared datastore).
+#
+# The snapshot is reloaded when:
+#   - invalidate() is called. auth_data calls it after each committed change,
+#     so changes made in this process are seen by the next request.
+#   - 'PRAGMA data_version' of the snapshot's own connection changes, which sqlite
+#     bumps on any change committed by another connection or process (e.g. the
+#     admin CLI, or another ESX host in MultiNode mode). It is polled at most
+#     every POLL_INTERVAL seconds.
+#
+# Listeners added with add_reload_listener() are called with the old and the new
+# snapshot after each reload, so the service can drop state derived from auth data
+# (e.g. resolved volume folders of tenants, see vmdk_utils.vol_path_cache).
+
+import collections
+import logging
+import sqlite3
+import time
+
+import auth_data_const
+import threadutils
+
+# How often (seconds) to check auth DB for changes made by other processes
+POLL_INTERVAL = 1
+
+TenantInfo = collections.namedtuple("TenantInfo", ["id", "name", "default_datastore_url", "weight"])
+
+
+class AuthSnapshot(object):
+    """
+    Immutable copy of authorization data, indexed for request authorization.
+    Callers must not modify the returned objects.
+    """
+
+    def __init__(self, data_version, generation, tenants, vm_tenants, privileges, usage):
+        self.data_version = data_version
+        self.generation = generation
+        self.loaded_at = time.time()
+        # {tenant_uuid: TenantInfo}
+        self.tenants = tenants
+        # {tenant_name: TenantInfo}
+        self.tenants_by_name = dict((t.name, t) for t in tenants.values())
+        # {vm_uuid: tenant_uuid}
+        self.vm_tenants = vm_tenants
+        # {tenant_uuid: {datastore_url: privileges dict}}
+        self.privileges = privileges
+        # {(tenant_uuid, datastore_url): storage used in MB}
+        self.usage = usage
+
+    def get_tenant(self, tenant_uuid):
+        """ Return TenantInfo for tenant_uuid, or None """
+        return self.tenants.get(tenant_uuid)
+
+    def get_tenant_by_name(self, name):
+        """ Return TenantInfo for tenant name, or None """
+        return self.tenants_by_name.get(name)
+
+    def get_vm_tenant(self, vm_uuid):
+        """
+        Return TenantInfo of the tenant the VM belongs to, DEFAULT tenant
+        if the VM is not in any tenant, or None if DEFAULT tenant does not exist
+        """
+        tenant_uuid = self.vm_tenants.get(vm_uuid)
+        if tenant_uuid:
+            # a VM row always has a tenant, keep the uuid even if the tenant row is gone
+            return self.tenants.get(tenant_uuid) or TenantInfo(tenant_uuid, None, None,
+                                                               auth_data_const.DEFAULT_TENANT_WEIGHT)
+        return self.tenants_by_name.get(auth_data_const.DEFAULT_TENANT)
+
+    def get_privileges(self, tenant_uuid, datastore_url):
+        """ Return privileges dict for (tenant_uuid, datastore_url), or None """
+        return self.privileges.get(tenant_uuid, {}).get(datastore_url)
+
+    def get_usage(self, tenant_uuid, datastore_url):
+        """ Return storage (MB) used by volumes of tenant_uuid on datastore_url """
+        return self.usage.get((tenant_uuid, datastore_url), 0)
+
+
+def load(conn, generation=0):
+    """
+    Read AuthSnapshot from auth DB connection 'conn' (in autocommit mode).
+    Raises sqlite3.Error on failures.
+    """
+    # a single read transaction, so data_version matches the data read
+    conn.execute("BEGIN")
+    try:
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+        tenants = {}
+        for row in conn.execute("SELECT id, name, default_datastore_url, weight FROM tenants"):
+            tenants[row[0]] = TenantInfo(*row)
+
+        vm_tenants = dict(conn.execute("SELECT vm_id, tenant_id FROM vms").fetchall())
+
+        privileges = {}
+        for row in conn.execute("SELECT tenant_id, datastore_url, allow_create, max_volume_size, usage_quota "
+                                "FROM privileges"):
+            privileges.setdefault(row[0], {})[row[1]] = {
+                auth_data_const.COL_TENANT_ID: row[0],
+                auth_data_const.COL_DATASTORE_URL: row[1],
+                auth_data_const.COL_ALLOW_CREATE: row[2],
+                auth_data_const.COL_MAX_VOLUME_SIZE: row[3],
+                auth_data_const.COL_USAGE_QUOTA: row[4]}
+
+        usage = {}
+        for row in conn.execute("SELECT tenant_id, datastore_url, used_size FROM usage"):
+            usage[(row[0], row[1])] = row[2]
+    finally:
+        conn.execute("COMMIT")
+
+    return AuthSnapshot(data_version, generation, tenants, vm_tenants, privileges, usage)
+
+
+class SnapshotCache(object):
+    """
+    Keeps the current AuthSnapshot of an auth DB and reloads it when the DB changes.
+    Uses its own connection, so writes made on any other connection bump its data_version.
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._listeners = []
+        self._lock = threadutils.get_lock()
+        self._db_path = None
+        self._conn = None
+        self._snapshot = None
+        self._polled_at = 0
+        self._generation = 0
+        self._loads = 0
+        self._polls = 0
+        self._invalidations = 0
+        self._load_time = 0
+
+    def get(self, db_path):
+        """ Return up to date AuthSnapshot for auth DB at db_path. Raises sqlite3.Error on failures """
+        snapshot = self._snapshot
+        if snapshot and self._db_path == db_path and snapshot.generation == self._generation and \
+           time.time() - self._polled_at < self.poll_interval:
+            return snapshot
+
+        with self._lock:
+            if self._db_path != db_path:
+                self._close()
+                self._snapshot = None
+                self._db_path = db_path
+            try:
+                if not self._conn:
+                    self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+                self._polled_at = time.time()
+                self._polls += 1
+                old_snapshot = self._snapshot
+                if old_snapshot and old_snapshot.generation == self._generation:
+                    data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+                    if data_version == old_snapshot.data_version:
+                        return old_snapshot
+                start = time.time()
+                snapshot = self._snapshot = load(self._conn, self._generation)
+                self._load_time = time.time() - start
+                self._loads += 1
+                logging.debug("Loaded authorization data from %s: %d tenants, %d VMs (%.3fs)",
+                              db_path, len(snapshot.tenants), len(snapshot.vm_tenants),
+                              self._load_time)
+                listeners = list(self._listeners)
+            except sqlite3.Error:
+                # reconnect on next call
+                self._close()
+                self._snapshot = None
+                raise
+
+        for listener in listeners:
+            try:
+                listener(old_snapshot, snapshot)
+            except Exception:
+                logging.exception("Auth data reload listener failed")
+        return snapshot
+
+    def add_reload_listener(self, listener):
+        """ Call listener(old snapshot or None, new snapshot) after each reload """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def invalidate(self, reconnect=False):
+        """
+        Drop the current snapshot, the next get() reloads it. With reconnect, the
+        next get() also reopens the DB (e.g. because the DB file was replaced).
+        """
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            if reconnect:
+                self._close()
+
+    def stats(self):
+        """ Return a dict with snapshot size, age and reload counters """
+        with self._lock:
+            snapshot = self._snapshot
+            return {"loads": self._loads,
+                    "polls": self._polls,
+                    "invalidations": self._invalidations,
+                    "last_load_time": round(self._load_time, 4),
+                    "age": round(time.time() - snapshot.loaded_at, 1) if snapshot else None,
+                    "tenants": len(snapshot.tenants) if snapshot else 0,
+                    "vms": len(snapshot.vm_tenants) if snapshot else 0}
+
+    def close(self):
+        with self._lock:
+            self._close()
+            self._snapshot = None
+
+    def _close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+_cache = SnapshotCache()
+
+
+def get(db_path):
+    """ Return current AuthSnapshot of auth DB at db_path. Raises sqlite3.Error on failures """
+    return _cache.get(db_path)
+
+
+def invalidate(reconnect=False):
+    """ Force reload of the authorization data, called after changes to auth DB """
+    _cache.invalidate(reconnect)
+
+
+def add_reload_listener(listener):
+    """ Call listener(old snapshot or None, new snapshot) after each reload of authorization data """
+    _cache.add_reload_listener(listener)
+
+
+def stats():
+    return _cache.stats()
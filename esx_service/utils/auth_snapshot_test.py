@@ -0,0 +1,143 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for auth_snapshot.py
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import auth_data_const
+import auth_snapshot
+
+TENANT1_UUID = "7c4b6f2e-8a1d-4e0b-9b9a-3f1c2d4e5f60"
+VM1_UUID = "564d0000-0000-0000-0000-000000000001"
+VM2_UUID = "564d0000-0000-0000-0000-000000000002"
+DS1_URL = "/vmfs/volumes/ds1"
+
+
+class TestAuthSnapshot(unittest.TestCase):
+    """Test loading and reloading of authorization data snapshot"""
+
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript("""
+            CREATE TABLE tenants(id TEXT PRIMARY KEY NOT NULL, name TEXT UNIQUE NOT NULL, description TEXT,
+                                 default_datastore_url TEXT, weight INTEGER NOT NULL DEFAULT 1);
+            CREATE TABLE vms(vm_id TEXT PRIMARY KEY NOT NULL, tenant_id TEXT NOT NULL, vm_name TEXT);
+            CREATE TABLE privileges(tenant_id TEXT NOT NULL, datastore_url TEXT NOT NULL, allow_create INTEGER,
+                                    max_volume_size INTEGER, usage_quota INTEGER,
+                                    PRIMARY KEY (tenant_id, datastore_url));
+            CREATE TABLE usage(tenant_id TEXT NOT NULL, datastore_url TEXT NOT NULL,
+                               used_size INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(tenant_id, datastore_url));
+            """)
+        self.conn.execute("INSERT INTO tenants VALUES (?, ?, '', ?, 1)",
+                          (auth_data_const.DEFAULT_TENANT_UUID, auth_data_const.DEFAULT_TENANT,
+                           auth_data_const.VM_DS_URL))
+        self.conn.execute("INSERT INTO tenants VALUES (?, 'tenant1', '', ?, 3)", (TENANT1_UUID, DS1_URL))
+        self.conn.execute("INSERT INTO vms VALUES (?, ?, 'vm1')", (VM1_UUID, TENANT1_UUID))
+        self.conn.execute("INSERT INTO privileges VALUES (?, ?, 1, 100, 1000)", (TENANT1_UUID, DS1_URL))
+        self.conn.execute("INSERT INTO usage VALUES (?, ?, 300)", (TENANT1_UUID, DS1_URL))
+        self.conn.commit()
+        self.cache = auth_snapshot.SnapshotCache(poll_interval=0)
+
+    def tearDown(self):
+        self.cache.close()
+        self.conn.close()
+        os.remove(self.db_path)
+
+    def test_load(self):
+        snapshot = self.cache.get(self.db_path)
+        tenant = snapshot.get_vm_tenant(VM1_UUID)
+        self.assertEqual(tenant.name, "tenant1")
+        self.assertEqual(tenant.default_datastore_url, DS1_URL)
+        self.assertEqual(tenant.weight, 3)
+        # VMs not in any tenant belong to DEFAULT tenant
+        self.assertEqual(snapshot.get_vm_tenant(VM2_UUID).id, auth_data_const.DEFAULT_TENANT_UUID)
+        self.assertEqual(snapshot.get_tenant_by_name("tenant1").id, TENANT1_UUID)
+
+        privileges = snapshot.get_privileges(TENANT1_UUID, DS1_URL)
+        self.assertEqual(privileges[auth_data_const.COL_MAX_VOLUME_SIZE], 100)
+        self.assertEqual(privileges[auth_data_const.COL_USAGE_QUOTA], 1000)
+        self.assertIsNone(snapshot.get_privileges(TENANT1_UUID, auth_data_const.ALL_DS_URL))
+        self.assertEqual(snapshot.get_usage(TENANT1_UUID, DS1_URL), 300)
+        self.assertEqual(snapshot.get_usage(TENANT1_UUID, auth_data_const.ALL_DS_URL), 0)
+
+    def test_no_default_tenant(self):
+        self.conn.execute("DELETE FROM tenants WHERE id = ?", (auth_data_const.DEFAULT_TENANT_UUID,))
+        self.conn.commit()
+        self.assertIsNone(self.cache.get(self.db_path).get_vm_tenant(VM2_UUID))
+
+    def test_reused_until_changed(self):
+        snapshot = self.cache.get(self.db_path)
+        self.assertIs(self.cache.get(self.db_path), snapshot)
+        self.assertEqual(self.cache.stats()["loads"], 1)
+
+    def test_reload_on_external_change(self):
+        snapshot = self.cache.get(self.db_path)
+        # a change committed by another connection bumps data_version
+        self.conn.execute("INSERT INTO vms VALUES (?, ?, 'vm2')", (VM2_UUID, TENANT1_UUID))
+        self.conn.commit()
+        snapshot = self.cache.get(self.db_path)
+        self.assertEqual(snapshot.get_vm_tenant(VM2_UUID).id, TENANT1_UUID)
+        self.assertEqual(self.cache.stats()["loads"], 2)
+
+    def test_poll_interval(self):
+        cache = auth_snapshot.SnapshotCache(poll_interval=3600)
+        try:
+            snapshot = cache.get(self.db_path)
+            self.conn.execute("DELETE FROM vms")
+            self.conn.commit()
+            # not polled again yet
+            self.assertIs(cache.get(self.db_path), snapshot)
+            # but reloaded right away when invalidated
+            cache.invalidate()
+            self.assertEqual(cache.get(self.db_path).get_vm_tenant(VM1_UUID).id,
+                             auth_data_const.DEFAULT_TENANT_UUID)
+            self.assertEqual(cache.stats()["invalidations"], 1)
+        finally:
+            cache.close()
+
+    def test_reload_listener(self):
+        reloads = []
+        self.cache.add_reload_listener(lambda old, new: reloads.append((old, new)))
+        snapshot = self.cache.get(self.db_path)
+        self.cache.get(self.db_path)
+        self.assertEqual(reloads, [(None, snapshot)])
+
+        # vmgroup renamed by the admin CLI
+        self.conn.execute("UPDATE tenants SET name = 'tenant2' WHERE id = ?", (TENANT1_UUID,))
+        self.conn.commit()
+        new_snapshot = self.cache.get(self.db_path)
+        self.assertEqual(reloads[-1], (snapshot, new_snapshot))
+        self.assertNotEqual(snapshot.tenants, new_snapshot.tenants)
+
+        # a failing listener does not fail the reload
+        self.cache.add_reload_listener(lambda old, new: 1 / 0)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(self.db_path).tenants, new_snapshot.tenants)
+        self.assertEqual(len(reloads), 3)
+
+    def test_error(self):
+        self.conn.execute("DROP TABLE usage")
+        self.conn.commit()
+        self.assertRaises(sqlite3.Error, self.cache.get, self.db_path)
+        self.assertEqual(self.cache.stats()["tenants"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
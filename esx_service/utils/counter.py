@@ -17,6 +17,7 @@
 # keep track of the in-flight operations.
 
 import logging
+import math
 import threading
 
 class OpsCounter:
@@ -66,3 +67,104 @@ class OpsCounter:
         Block until the counter value decreased to 0
         '''
         return self._event.wait(timeout)
+
+
+class AdmissionControl:
+    '''
+    Limits the number of in-flight operations globally, per key (e.g. VM)
+    and per command class, so an overloaded backend slows down a bounded
+    number of requests instead of all of them.
+
+    A limit of 0 (or a class missing from class_limits) means "no limit".
+    '''
+
+    # Reasons an operation was declined, also used as stats keys
+    GLOBAL = "global"
+    PER_KEY = "per_key"
+    PER_CLASS = "per_class"
+
+    # Weight of the last completed operation in the average duration
+    DURATION_EWMA_ALPHA = 0.2
+
+    def __init__(self, max_total=0, max_per_key=0, class_limits=None,
+                 min_retry_after=1, max_retry_after=30):
+        self.max_total = max_total
+        self.max_per_key = max_per_key
+        self.class_limits = dict(class_limits or {})
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+        self._lock = threading.Lock()
+        self._total = 0
+        self._by_key = {}
+        self._by_class = {}
+        self._avg_duration = {}
+        self._admitted = 0
+        self._rejected = {self.GLOBAL: 0, self.PER_KEY: 0, self.PER_CLASS: 0}
+
+    def admit(self, key, op_class):
+        '''
+        Try to admit an operation.
+        Returns (None, None) if admitted - the caller must then call release()
+        when the operation completes. Otherwise returns (reason, retry_after)
+        with retry_after being the suggested delay (seconds) before a retry.
+        '''
+        with self._lock:
+            reason = None
+            class_limit = self.class_limits.get(op_class, 0)
+            if self.max_total and self._total >= self.max_total:
+                reason = self.GLOBAL
+            elif class_limit and self._by_class.get(op_class, 0) >= class_limit:
+                reason = self.PER_CLASS
+            elif self.max_per_key and self._by_key.get(key, 0) >= self.max_per_key:
+                reason = self.PER_KEY
+
+            if reason:
+                self._rejected[reason] += 1
+                return reason, self._retry_after(op_class)
+
+            self._total += 1
+            self._by_key[key] = self._by_key.get(key, 0) + 1
+            self._by_class[op_class] = self._by_class.get(op_class, 0) + 1
+            self._admitted += 1
+            return None, None
+
+    def release(self, key, op_class, duration=None):
+        '''
+        Release an operation admitted by admit().
+        'duration' (seconds) is used to estimate retry_after for the class.
+        '''
+        with self._lock:
+            self._total -= 1
+            self._by_key[key] -= 1
+            if not self._by_key[key]:
+                del self._by_key[key]
+            self._by_class[op_class] -= 1
+            if duration is not None:
+                avg = self._avg_duration.get(op_class)
+                if avg is None:
+                    self._avg_duration[op_class] = duration
+                else:
+                    self._avg_duration[op_class] = avg + self.DURATION_EWMA_ALPHA * (duration - avg)
+
+    def _retry_after(self, op_class):
+        '''
+        Suggested retry delay: about the time a slot of this class takes to free up.
+        Called with self._lock held.
+        '''
+        retry_after = int(math.ceil(self._avg_duration.get(op_class, 0)))
+        return max(self.min_retry_after, min(self.max_retry_after, retry_after))
+
+    def stats(self):
+        '''
+        Return a dict with limits, in-flight counts and rejection counters
+        '''
+        with self._lock:
+            return {"limits": {"total": self.max_total,
+                               "per_key": self.max_per_key,
+                               "per_class": dict(self.class_limits)},
+                    "in_flight": self._total,
+                    "in_flight_keys": len(self._by_key),
+                    "in_flight_by_class": dict(self._by_class),
+                    "avg_duration": dict((c, round(d, 3)) for c, d in self._avg_duration.items()),
+                    "admitted": self._admitted,
+                    "rejected": dict(self._rejected)}
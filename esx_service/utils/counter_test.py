@@ -0,0 +1,74 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for counter.py
+
+import unittest
+import counter
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """Test AdmissionControl limits"""
+
+    def test_global_limit(self):
+        ac = counter.AdmissionControl(max_total=2)
+        self.assertEqual(ac.admit("vm1", "read"), (None, None))
+        self.assertEqual(ac.admit("vm2", "read"), (None, None))
+        reason, retry_after = ac.admit("vm3", "read")
+        self.assertEqual(reason, counter.AdmissionControl.GLOBAL)
+        self.assertEqual(retry_after, 1)
+        ac.release("vm1", "read")
+        self.assertEqual(ac.admit("vm3", "read"), (None, None))
+
+    def test_per_key_limit(self):
+        ac = counter.AdmissionControl(max_per_key=1)
+        self.assertEqual(ac.admit("vm1", "read"), (None, None))
+        reason, _ = ac.admit("vm1", "read")
+        self.assertEqual(reason, counter.AdmissionControl.PER_KEY)
+        # other VMs are not affected
+        self.assertEqual(ac.admit("vm2", "read"), (None, None))
+
+    def test_per_class_limit(self):
+        ac = counter.AdmissionControl(class_limits={"heavy": 1})
+        self.assertEqual(ac.admit("vm1", "heavy"), (None, None))
+        reason, _ = ac.admit("vm2", "heavy")
+        self.assertEqual(reason, counter.AdmissionControl.PER_CLASS)
+        # cheap operations still go through
+        self.assertEqual(ac.admit("vm2", "read"), (None, None))
+
+    def test_retry_after(self):
+        ac = counter.AdmissionControl(class_limits={"heavy": 1}, max_retry_after=10)
+        ac.admit("vm1", "heavy")
+        ac.release("vm1", "heavy", duration=4.2)
+        ac.admit("vm1", "heavy")
+        self.assertEqual(ac.admit("vm2", "heavy")[1], 5)
+        ac.release("vm1", "heavy", duration=1000)
+        ac.admit("vm1", "heavy")
+        self.assertEqual(ac.admit("vm2", "heavy")[1], 10)
+
+    def test_stats(self):
+        ac = counter.AdmissionControl(max_total=1)
+        ac.admit("vm1", "read")
+        ac.admit("vm2", "read")
+        stats = ac.stats()
+        self.assertEqual(stats["in_flight"], 1)
+        self.assertEqual(stats["in_flight_by_class"], {"read": 1})
+        self.assertEqual(stats["admitted"], 1)
+        self.assertEqual(stats["rejected"][counter.AdmissionControl.GLOBAL], 1)
+        ac.release("vm1", "read")
+        self.assertEqual(ac.stats()["in_flight_keys"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,7 @@ class ErrorCode:
     TENANT_GET_FAILED = 7
     TENANT_NAME_INVALID = 8
     TENANT_NOT_EMPTY = 9
+    TENANT_WEIGHT_INVALID = 10
     # Tenant related error code end
 
     # VM related error code start
@@ -94,6 +95,7 @@ error_code_to_message = {
     ErrorCode.TENANT_GET_FAILED : "Get vmgroup {0} failed",
     ErrorCode.TENANT_NAME_INVALID : "Vmgroup name {0} is invalid, only {1} is allowed",
     ErrorCode.TENANT_NOT_EMPTY : "Cannot delete non-empty vmgroup {0}. Remove VMs from the vmgroup before deleting it.",
+    ErrorCode.TENANT_WEIGHT_INVALID : "Vmgroup weight {0} is invalid, it must be an integer from {1} to {2}",
 
     ErrorCode.VM_NOT_FOUND : "Cannot find vm {0}",
     ErrorCode.REPLACE_VM_EMPTY : "Replace VM cannot be empty",
@@ -28,6 +28,10 @@ import time
 import threadutils
 import vmdk_utils
 import os
+import sidecar_cache
+import size_cache
+import zlib
+import collections
 
 # Python version 3.5.1
 PYTHON64_VERSION = 50659824
@@ -59,6 +63,8 @@ DVOL_KEY = "docker-volume-vsphere"
 # Volume attributes
 VOL_SIZE = 'size'
 VOL_ALLOC = 'allocated'
+# Age in seconds of VOL_ALLOC, see size_cache.py
+VOL_ALLOC_AGE = 'allocatedAge'
 
 # Results in a buffered, locked, filter-less open,
 # all vmdks are opened with these flags
@@ -69,12 +75,55 @@ VMDK_MAX_SNAPS = 32
 # Default kv side car alignment
 KV_ALIGN = 4096
 
+# Key of the CRC32 of the rest of the side car, added on save and checked on load.
+# It is a regular JSON key, so older versions can still read the side car.
+KV_CHECKSUM = "sidecarChecksum"
+
+# Separators of the JSON we write. Older versions write json.dumps() defaults, with
+# a space after each separator, so compact JSON marks a side car written by this code:
+# if its checksum does not match, it is a torn write rather than a change made by an
+# older version (see decode()).
+KV_SEPARATORS = (',', ':')
+
+# Suffix of the temp file a side car is written to, before renaming it over the side car
+KV_TMP_SUFFIX = ".tmp"
+
+# Max number of corrupt side cars to report in io_stats()
+KV_MAX_CORRUPT_REPORTED = 16
+
 # Flag to track the version of Python on the platform
 is_64bits = False
 
 # Get a Reentrant locking decorator
+# Serializes DiskLib/ObjLib calls only. Sidecar file I/O (and its EBUSY retries)
+# is done under per volume locks, see volume_lock().
 diskLibLock = threadutils.get_lock_decorator(reentrant=True)
 
+# Decoded sidecars, see load() and save()
+sidecarCache = sidecar_cache.SidecarCache()
+
+# Per volume locks, serialize read-modify-write of a sidecar (see update())
+sidecarLocks = threadutils.LockManager()
+
+
+# Side car I/O counters, see io_stats()
+ioStatsLock = threadutils.get_lock()
+ioStats = {"writes": 0,
+           "writes_skipped": 0,
+           "in_place_writes": 0,
+           "corrupt": 0,
+           "checksum_mismatch": 0}
+# volpath of the last corrupt side cars found
+corruptSidecars = collections.deque(maxlen=KV_MAX_CORRUPT_REPORTED)
+
+
+def volume_lock(volpath):
+    """
+    Return the lock for metadata operations on the volume.
+    Code holding it may take diskLibLock, but not the other way around.
+    """
+    return sidecarLocks.get_lock(volpath, reentrant=True)
+
 
 class disk_info(Structure):
     _fields_ = [('size', c_uint64),
@@ -204,23 +253,24 @@ def vol_open_path(volpath, open_flags=VMDK_OPEN_DEFAULT):
 
 
 @diskLibLock
-def create(volpath, kv_dict):
+def get_vol_type(volpath):
     """
-    Create the side car for the volume identified by volpath.
+    Return ObjLib type of the volume, or None on errors
     """
-    obj_handle = get_uint(0)
-
-    # If the volume is a virtual type then
-    # create the KV as a flat file.
     vol_type = c_uint32(0)
     res = lib.ObjLib_PathToType(volpath.encode(), byref(vol_type))
     if res != 0:
         logging.warning("Could not determine type of volume %s, error - %x", volpath, res)
-        return False
+        return None
+    return vol_type.value
 
-    if vol_type.value == c_uint32(KV_VOL_VIRTUAL).value:
-        return save(volpath, kv_dict)
 
+@diskLibLock
+def sidecar_create(volpath):
+    """
+    Create storage specific side car for the volume. Return True on success
+    """
+    obj_handle = get_uint(0)
     dhandle = vol_open_path(volpath)
     if not disk_is_valid(dhandle):
         return False
@@ -239,27 +289,14 @@ def create(volpath, kv_dict):
 
     lib.DiskLib_SidecarClose(dhandle, DVOL_KEY.encode(), byref(obj_handle))
     lib.DiskLib_Close(dhandle)
-
-    return save(volpath, kv_dict)
+    return True
 
 
 @diskLibLock
-def delete(volpath):
+def sidecar_delete(volpath):
     """
-    Delete the side car for the given volume.
+    Delete storage specific side car for the volume. Return True on success
     """
-    vol_type = c_uint32(0)
-    res = lib.ObjLib_PathToType(volpath.encode(), byref(vol_type))
-    if res != 0:
-        logging.warning("KV delete - could not determine type of volume %s, error - %x", volpath, res)
-        return False
-    if vol_type.value == c_uint32(KV_VOL_VIRTUAL).value:
-        meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(), DVOL_KEY.encode())
-        if os.path.exists(meta_file):
-            os.unlink(meta_file)
-            return True
-
-    # Other volume types are storage specific sidecars.
     dhandle = vol_open_path(volpath)
     if not disk_is_valid(dhandle):
         return False
@@ -273,6 +310,46 @@ def delete(volpath):
     return True
 
 
+def create(volpath, kv_dict):
+    """
+    Create the side car for the volume identified by volpath.
+    """
+    sizeCache.invalidate(volpath)
+    with volume_lock(volpath):
+        # If the volume is a virtual type then
+        # create the KV as a flat file.
+        vol_type = get_vol_type(volpath)
+        if vol_type is None:
+            return False
+
+        if vol_type != KV_VOL_VIRTUAL and not sidecar_create(volpath):
+            return False
+
+        return save(volpath, kv_dict)
+
+
+def delete(volpath):
+    """
+    Delete the side car for the given volume.
+    """
+    sizeCache.invalidate(volpath)
+    with volume_lock(volpath):
+        sidecarCache.invalidate(volpath)
+        vol_type = get_vol_type(volpath)
+        if vol_type is None:
+            return False
+        meta_file = get_meta_file(volpath)
+        if os.path.exists(meta_file + KV_TMP_SUFFIX):
+            os.unlink(meta_file + KV_TMP_SUFFIX)
+        if vol_type == KV_VOL_VIRTUAL:
+            if os.path.exists(meta_file):
+                os.unlink(meta_file)
+                return True
+
+        # Other volume types are storage specific sidecars.
+        return sidecar_delete(volpath)
+
+
 def align_str(kv_str, block):
     """
     Align a given string to the specified block boundary.
@@ -284,19 +361,28 @@ def align_str(kv_str, block):
 
 
 @diskLibLock
-def load(volpath):
+def get_meta_file(volpath):
     """
-    Load and return dictionary from the sidecar
+    Return path of the sidecar file for the volume, as str
     """
     meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
                                                 DVOL_KEY.encode())
+    # c_char_p is returned as bytes on Python 3
+    if meta_file is not None and not isinstance(meta_file, str):
+        meta_file = meta_file.decode()
+    return meta_file
+
+
+def read_meta_file(volpath, meta_file):
+    """
+    Return content of the sidecar file, or None on errors
+    """
     retry_count = 0
     vol_name = vmdk_utils.get_volname_from_vmdk_path(volpath)
     while True:
         try:
             with open(meta_file, "r") as fh:
-                kv_str = fh.read()
-            break
+                return fh.read()
         except IOError as open_error:
             # This is a workaround to the timing/locking with metadata files issue #626
             if open_error.errno == errno.EBUSY and retry_count <= vmdk_utils.VMDK_RETRY_COUNT:
@@ -308,41 +394,64 @@ def load(volpath):
                 logging.exception("Failed to access %s", meta_file)
                 return None
 
-    try:
-        return json.loads(kv_str)
-    except ValueError:
-        logging.exception("load:Failed to decode meta-data for %s", volpath)
-        return None
+
+def write_file(path, data):
+    """
+    Write data to the file and flush it to disk
+    """
+    with open(path, "w") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
 
 
-@diskLibLock
-def save(volpath, kv_dict, key=None, value=None):
+def write_meta_file(volpath, meta_file, kv_str, old_str=None):
     """
-    Save the dictionary to side car.
+    Write kv_str to the sidecar file. Return True on success, False on errors
+    The sidecar is not written if it already has this content. Pass 'old_str' if
+    the content was just read, otherwise the sidecar is read to check it.
+    For virtual volumes, whose sidecar is a flat file we create, new content goes to
+    a temp file which is renamed over the sidecar, so a crash leaves either the old
+    or the new sidecar. Other sidecars (vSAN, VVol) are created by DiskLib and must stay
+    the same file, so they (and flat files on which rename fails) are rewritten in place
+    with no double buffering. A crash during such a write can lose the meta-data: the
+    checksum added by encode() only makes load() report the torn sidecar as corrupt,
+    instead of returning mixed old and new content.
     """
-    meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
-                                                DVOL_KEY.encode())
-    kv_str = json.dumps(kv_dict)
+    data = align_str(kv_str, KV_ALIGN)
+    if old_str is None:
+        try:
+            with open(meta_file, "r") as fh:
+                old_str = fh.read()
+        except IOError:
+            pass
+    if old_str == data:
+        count_io("writes_skipped")
+        return True
 
+    tmp_file = meta_file + KV_TMP_SUFFIX
+    use_rename = get_vol_type(volpath) == KV_VOL_VIRTUAL
     retry_count = 0
     vol_name = vmdk_utils.get_volname_from_vmdk_path(volpath)
     while True:
         try:
-            if key:
-                with open(meta_file, "r") as rfh:
-                    kv_val = rfh.read()
-                    try:
-                        kv_match = json.loads(kv_val)
-                    except ValueError:
-                        logging.exception("load:Failed to decode meta-data for %s", volpath)
-                        return False
-
-                    if key in kv_match and kv_match[key] != value:
-                        return False
-            with open(meta_file, "w") as fh:
-                fh.write(align_str(kv_str, KV_ALIGN))
-            break
-        except IOError as open_error:
+            if use_rename:
+                write_file(tmp_file, data)
+                try:
+                    os.rename(tmp_file, meta_file)
+                except OSError as rename_error:
+                    if rename_error.errno == errno.EBUSY:
+                        raise
+                    logging.warning("Failed to rename %s (%s), writing %s in place",
+                                    tmp_file, rename_error, meta_file)
+                    os.unlink(tmp_file)
+                    use_rename = False
+            if not use_rename:
+                write_file(meta_file, data)
+                count_io("in_place_writes")
+            count_io("writes")
+            return True
+        except (IOError, OSError) as open_error:
             # This is a workaround to the timing/locking with metadata files issue #626
             if open_error.errno == errno.EBUSY and retry_count <= vmdk_utils.VMDK_RETRY_COUNT:
                 logging.warning("Meta file %s busy for save(), retrying...", meta_file)
@@ -351,45 +460,214 @@ def save(volpath, kv_dict, key=None, value=None):
                 time.sleep(vmdk_utils.VMDK_RETRY_SLEEP)
             else:
                 logging.exception("Failed to save meta-data for %s", volpath)
+                if os.path.exists(tmp_file):
+                    os.unlink(tmp_file)
                 return False
 
+
+def checksum(kv_dict):
+    """
+    Return checksum of the dictionary, as stored in KV_CHECKSUM
+    """
+    payload = json.dumps(kv_dict, sort_keys=True).encode()
+    return "{:08x}".format(zlib.crc32(payload) & 0xffffffff)
+
+
+def encode(kv_dict):
+    """
+    Return side car content for the dictionary, with its checksum
+    """
+    kv_dict = dict(kv_dict)
+    kv_dict.pop(KV_CHECKSUM, None)
+    kv_dict[KV_CHECKSUM] = checksum(kv_dict)
+    return json.dumps(kv_dict, sort_keys=True, separators=KV_SEPARATORS)
+
+
+def decode(volpath, kv_str):
+    """
+    Return dictionary from side car content, or None if the side car is not a JSON object,
+    or is a torn write of ours (see KV_SEPARATORS).
+    Side cars written without a checksum are accepted. So are side cars with a stale
+    checksum, which older versions leave when they change a side car they loaded with
+    it; these are only counted and logged.
+    """
+    try:
+        kv_dict = json.loads(kv_str)
+    except ValueError as decode_error:
+        report_corrupt(volpath, "corrupt", decode_error)
+        return None
+    if not isinstance(kv_dict, dict):
+        report_corrupt(volpath, "corrupt", "not a JSON object")
+        return None
+
+    stored = kv_dict.pop(KV_CHECKSUM, None)
+    if stored is not None and stored != checksum(kv_dict):
+        if is_own_format(kv_str):
+            report_corrupt(volpath, "corrupt", "checksum mismatch")
+            return None
+        logging.warning("Meta-data of %s has checksum %s, expected %s, it was likely "
+                        "changed by an older version", volpath, checksum(kv_dict), stored)
+        count_io("checksum_mismatch")
+    return kv_dict
+
+
+def is_json(kv_str):
+    """
+    Return True if kv_str is valid JSON
+    """
+    try:
+        json.loads(kv_str)
+    except ValueError:
+        return False
+    return True
+
+
+def is_own_format(kv_str):
+    """
+    Return True if kv_str is a JSON object with a checksum, as encode() writes it
+    """
+    try:
+        kv_dict = json.loads(kv_str)
+    except ValueError:
+        return False
+    return (isinstance(kv_dict, dict) and KV_CHECKSUM in kv_dict and
+            kv_str.strip() == json.dumps(kv_dict, sort_keys=True, separators=KV_SEPARATORS))
+
+
+def count_io(name):
+    with ioStatsLock:
+        ioStats[name] += 1
+
+
+def report_corrupt(volpath, name, reason):
+    """
+    Log and count a corrupt side car
+    """
+    logging.error("Meta-data of %s is corrupt: %s", volpath, reason)
+    with ioStatsLock:
+        ioStats[name] += 1
+        if volpath in corruptSidecars:
+            corruptSidecars.remove(volpath)
+        corruptSidecars.append(volpath)
+
+
+def load(volpath, use_cache=True):
+    """
+    Load and return dictionary from the sidecar
+    With use_cache=False the sidecar is read from disk even if it is cached, e.g. when
+    the caller needs to see a change just made by another ESX host, which stat() may
+    not show yet on a shared datastore. The cache is refreshed with the result.
+    """
+    meta_file = get_meta_file(volpath)
+    if use_cache:
+        kv_dict = sidecarCache.get(volpath, meta_file)
+        if kv_dict is not None:
+            return kv_dict
+
+    with volume_lock(volpath):
+        kv_str = read_meta_file(volpath, meta_file)
+        if kv_str is None:
+            return None
+
+        kv_dict = decode(volpath, kv_str)
+        if kv_dict is None:
+            sidecarCache.invalidate(volpath)
+            return None
+
+        sidecarCache.put(volpath, meta_file, kv_dict)
+    return kv_dict
+
+
+def save(volpath, kv_dict, key=None, value=None):
+    """
+    Save the dictionary to side car.
+    If key is passed, the side car is saved only if key is not there, or has the given value.
+    """
+    if key:
+        def replace_all(vol_meta):
+            vol_meta.clear()
+            vol_meta.update(kv_dict)
+        return update(volpath, replace_all, expect={key: value})
+
+    meta_file = get_meta_file(volpath)
+    kv_str = encode(kv_dict)
+    with volume_lock(volpath):
+        if not write_meta_file(volpath, meta_file, kv_str):
+            sidecarCache.invalidate(volpath)
+            return False
+        sidecarCache.put(volpath, meta_file, kv_dict)
+    return True
+
+
+def update(volpath, mutator, expect=None, default=None):
+    """
+    Read-modify-write the side car, with one read and at most one write.
+    mutator(vol_meta) changes the dictionary in place. If it changes nothing, nothing is written.
+    expect - dict of {key: value}. If any of the keys is in the side car with a different
+             value, the side car is not changed.
+    default - dictionary to pass to mutator if the side car is missing or torn (not valid
+              JSON, or a checksum mismatch in a side car we wrote), if None update fails
+    Concurrent update() and save() of the same volume in this process are serialized.
+    Return True if the side car has the requested change, False otherwise.
+    """
+    meta_file = get_meta_file(volpath)
+    with volume_lock(volpath):
+        # always read from disk, a cached copy could miss a change made by another host
+        kv_str = read_meta_file(volpath, meta_file)
+        old_dict = None
+        if kv_str is not None:
+            old_dict = decode(volpath, kv_str)
+        if old_dict is None:
+            sidecarCache.invalidate(volpath)
+            # a side car that is valid JSON, but not an object, is not ours to replace
+            if default is None or (kv_str is not None and is_json(kv_str) and
+                                   not is_own_format(kv_str)):
+                return False
+            old_dict = default
+
+        if expect:
+            for key, value in expect.items():
+                if key in old_dict and old_dict[key] != value:
+                    logging.info("update: %s of %s is %s, expected %s, skipping update",
+                                 key, volpath, old_dict[key], value)
+                    return False
+
+        kv_dict = sidecar_cache.copy_value(old_dict)
+        mutator(kv_dict)
+        if old_dict is not default and kv_dict == old_dict:
+            sidecarCache.put(volpath, meta_file, old_dict, copy=False)
+            return True
+
+        if not write_meta_file(volpath, meta_file, encode(kv_dict), kv_str):
+            sidecarCache.invalidate(volpath)
+            return False
+        sidecarCache.put(volpath, meta_file, kv_dict, copy=False)
     return True
 
-@diskLibLock
 def fixup_kv(src_volpath, dst_volpath):
     """
     Fix up the sidecars for the destination volume which ever is a
     volume of type - virtual.
     """
-    src_vol_type = c_uint32(0)
-    res = lib.ObjLib_PathToType(src_volpath.encode(), byref(src_vol_type))
-    if res != 0:
-        logging.warning("Could not determine type of volume %s, error - %x", src_volpath, res)
+    sizeCache.invalidate(dst_volpath)
+    src_vol_type = get_vol_type(src_volpath)
+    if src_vol_type is None:
         return False
 
-    dst_vol_type = c_uint32(0)
-    res = lib.ObjLib_PathToType(dst_volpath.encode(), byref(dst_vol_type))
-    if res != 0:
-        logging.warning("Could not determine type of volume %s, error - %x", dst_volpath, res)
+    dst_vol_type = get_vol_type(dst_volpath)
+    if dst_vol_type is None:
         return False
 
-    if src_vol_type.value != c_uint32(KV_VOL_VIRTUAL).value:
+    if src_vol_type != KV_VOL_VIRTUAL:
         # If the destination is a virtual type volume,
         # the source will create a native sidecar that must be deleted
         # and a new flat file version is created.
-        if dst_vol_type.value == c_uint32(KV_VOL_VIRTUAL).value:
-            dhandle = vol_open_path(dst_volpath)
-            if not disk_is_valid(dhandle):
-                return False
-            res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
-            if res != 0:
-                logging.warning("Side car delete for %s failed - %x", dst_volpath, res)
-                lib.DiskLib_Close(dhandle)
-                return False
-
-            lib.DiskLib_Close(dhandle)
-            src_dict = load(src_volpath)
-            return create(dst_volpath, src_dict)
+        if dst_vol_type == KV_VOL_VIRTUAL:
+            with volume_lock(dst_volpath):
+                if not sidecar_delete(dst_volpath):
+                    return False
+                src_dict = load(src_volpath)
+                return create(dst_volpath, src_dict)
         else:
             return True
     else:
@@ -400,9 +678,9 @@ def fixup_kv(src_volpath, dst_volpath):
         return create(dst_volpath, src_dict)
 
 @diskLibLock
-def get_info(volpath):
+def get_size(volpath):
     """
-    Return disk stats for the volume
+    Return (capacity, allocated) of the volume in bytes, or None on errors
     """
     dhandle = vol_open_path(volpath, VMDK_OPEN_DISKCHAIN_NOIO)
 
@@ -418,7 +696,51 @@ def get_info(volpath):
         logging.warning("Failed to get size of disk %s - %x", volpath, res)
         return None
 
-    return {VOL_SIZE: convert(sinfo.size), VOL_ALLOC: convert(sinfo.allocated)}
+    return sinfo.size, sinfo.allocated
+
+def cache_stats():
+    """
+    Return sidecar cache statistics
+    """
+    return sidecarCache.stats()
+
+def io_stats():
+    """
+    Return side car write and corruption statistics
+    """
+    with ioStatsLock:
+        stats = dict(ioStats)
+        stats["corrupt_sidecars"] = list(corruptSidecars)
+    return stats
+
+# Disk sizes, invalidated by create(), delete() and fixup_kv()
+sizeCache = size_cache.SizeCache(get_size)
+
+def size_cache_stats():
+    """
+    Return disk size cache statistics
+    """
+    return sizeCache.stats()
+
+def start_size_sampler(max_staleness=size_cache.MAX_STALENESS):
+    """
+    Start background refresh of cached allocated sizes, which get_info()
+    returns at most max_staleness seconds old.
+    """
+    sizeCache.max_staleness = max_staleness
+    size_cache.start_sampler(sizeCache)
+
+def get_info(volpath):
+    """
+    Return disk stats for the volume, from the size cache
+    """
+    size = sizeCache.get(volpath)
+    if not size:
+        return None
+
+    return {VOL_SIZE: convert(size[0]),
+            VOL_ALLOC: convert(size[1]),
+            VOL_ALLOC_AGE: int(size[2])}
 
 
 def get_uint(val):
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark for concurrent volume metadata (sidecar) operations.
+# Runs reads and read-modify-writes of sidecars of existing docker volumes from
+# 1, 2, 4... threads, each thread working on its own volumes, and reports ops/sec.
+# With --serialize every operation is done under one global lock, as kvESX did
+# before sidecar I/O was moved under per volume locks.
+#
+# Not shipped in the VIB. "make test-esx" copies it to ESX along with the tests
+# and the service code, run it from there with a few docker volumes created:
+#   python kvESX_bench.py [--threads N] [--ops N] [--serialize]
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import kvESX
+import vmdk_utils
+
+# Key written by the benchmark, removed when it is done
+BENCH_KEY = "kvESXBench"
+
+
+def run_ops(vol_paths, ops, lock):
+    """ Do 'ops' sidecar operations on 'vol_paths', alternating read and update """
+    def set_key(vol_meta):
+        vol_meta[BENCH_KEY] = i
+
+    for i in range(ops):
+        vol_path = vol_paths[i % len(vol_paths)]
+        with lock:
+            if i % 2:
+                kvESX.update(vol_path, set_key)
+            else:
+                kvESX.load(vol_path, use_cache=False)
+
+
+def measure(vol_paths, threads, ops, serialize):
+    """ Run 'ops' operations in each of 'threads' threads. Return ops/sec """
+    if serialize:
+        lock = threading.Lock()
+    else:
+        # never blocks, each thread holds it at most once
+        lock = threading.Semaphore(threads)
+    # give every thread its own volumes, so they do not contend for volume locks
+    workers = [threading.Thread(target=run_ops, args=(vol_paths[n::threads], ops, lock))
+               for n in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * ops / (time.time() - start)
+
+
+def cleanup(vol_paths):
+    def remove_key(vol_meta):
+        vol_meta.pop(BENCH_KEY, None)
+
+    for vol_path in vol_paths:
+        kvESX.update(vol_path, remove_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent sidecar operations")
+    parser.add_argument("--threads", type=int, default=8, help="max number of threads")
+    parser.add_argument("--ops", type=int, default=200, help="operations per thread")
+    parser.add_argument("--serialize", action="store_true",
+                        help="run every operation under one global lock")
+    args = parser.parse_args()
+
+    kvESX.kv_esx_init()
+    vol_paths = [os.path.join(v['path'], v['filename']) for v in vmdk_utils.get_volumes("*")]
+    if len(vol_paths) < args.threads:
+        print("Need at least {} docker volumes, found {}".format(args.threads, len(vol_paths)))
+        return 1
+
+    print("{} volumes, {} ops per thread{}".format(len(vol_paths), args.ops,
+                                                 ", serialized" if args.serialize else ""))
+    print("  {:>8} {:>10}".format("threads", "ops/sec"))
+    try:
+        threads = 1
+        while threads <= args.threads:
+            print("  {:>8} {:>10.1f}".format(threads, measure(vol_paths, threads, args.ops, args.serialize)))
+            threads *= 2
+    finally:
+        cleanup(vol_paths)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
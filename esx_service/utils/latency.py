@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-request latency breakdown.
+# A worker thread calls start() when it picks up a request, lap(stage) after
+# each stage of the request, and finish() when the reply is sent. lap() charges
+# the time since the previous lap to 'stage', so instrumenting code only needs
+# one call after each step, and it is a no-op outside of a timed request.
+# Finished requests are aggregated into per command histograms (see stats()),
+# and requests slower than slow_threshold are logged with their breakdown.
+
+import logging
+import math
+import threading
+import time
+
+# Requests taking longer than this (seconds) are logged with per stage timing. 0 disables.
+DEFAULT_SLOW_THRESHOLD = 5
+
+# Time not charged to any stage by lap() is reported under this name
+UNACCOUNTED_STAGE = "other"
+
+# Histogram bucket i holds durations up to HISTOGRAM_BASE * HISTOGRAM_FACTOR**i seconds
+HISTOGRAM_BASE = 0.001
+HISTOGRAM_FACTOR = math.sqrt(2)
+HISTOGRAM_BUCKETS = 50  # up to ~9 hours
+
+slow_threshold = DEFAULT_SLOW_THRESHOLD
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}  # {cmd: {stage: Histogram}}, stage None is the request total
+
+
+class Histogram(object):
+    """ Log-scale histogram of durations (seconds), for percentile estimates """
+
+    def __init__(self):
+        self.buckets = [0] * (HISTOGRAM_BUCKETS + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        if duration <= HISTOGRAM_BASE:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(duration / HISTOGRAM_BASE, HISTOGRAM_FACTOR)))
+        self.buckets[min(index, HISTOGRAM_BUCKETS)] += 1
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, p):
+        """
+        Return the upper bound of the bucket holding the p-th percentile (p in 0..100),
+        capped at the max duration seen
+        """
+        if not self.count:
+            return 0
+        rank = int(math.ceil(self.count * p / 100.0))
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(HISTOGRAM_BASE * HISTOGRAM_FACTOR ** index, self.max)
+        return self.max
+
+    def summary(self):
+        """ Return a dict with count, avg, max and p50/p90/p99, in seconds """
+        return {"count": self.count,
+                "avg": round(self.sum / self.count, 4) if self.count else 0,
+                "max": round(self.max, 4),
+                "p50": round(self.percentile(50), 4),
+                "p90": round(self.percentile(90), 4),
+                "p99": round(self.percentile(99), 4)}
+
+
+class RequestTimer(object):
+    """ Timing of a single request, broken down into stages """
+
+    def __init__(self, cmd, label=None, started_at=None):
+        self.cmd = cmd
+        self.label = label
+        self.started_at = started_at or time.time()
+        self.last_lap = self.started_at
+        self.stages = []  # [(stage, seconds)] in order of first lap
+        self._index = {}
+
+    def lap(self, stage):
+        """ Charge time since the previous lap to 'stage' """
+        now = time.time()
+        duration = now - self.last_lap
+        self.last_lap = now
+        if stage in self._index:
+            i = self._index[stage]
+            self.stages[i] = (stage, self.stages[i][1] + duration)
+        else:
+            self._index[stage] = len(self.stages)
+            self.stages.append((stage, duration))
+
+    def total(self):
+        return self.last_lap - self.started_at
+
+    def breakdown(self):
+        """ Return stages as a string, e.g. "vm_info=0.001s get_tenant=0.020s" """
+        return " ".join("{0}={1:.3f}s".format(stage, duration) for stage, duration in self.stages)
+
+
+def start(cmd=None, label=None, started_at=None):
+    """
+    Start timing a request in the current thread. 'started_at' (e.g. when
+    the request was received) defaults to now.
+    """
+    _local.timer = RequestTimer(cmd, label, started_at)
+    return _local.timer
+
+
+def current():
+    """ Return the RequestTimer of the current thread, or None """
+    return getattr(_local, "timer", None)
+
+
+def set_command(cmd):
+    """ Set the command of the request timed in the current thread, once it is known """
+    timer = current()
+    if timer:
+        timer.cmd = cmd
+
+
+def lap(stage):
+    """ Charge time since the previous lap to 'stage', if a request is timed in this thread """
+    timer = current()
+    if timer:
+        timer.lap(stage)
+
+
+def finish():
+    """
+    Finish timing the request in the current thread: record it in the
+    histograms and log it if slow. Returns the RequestTimer, or None.
+    """
+    timer = current()
+    if not timer:
+        return None
+    _local.timer = None
+    timer.lap(UNACCOUNTED_STAGE)
+    total = timer.total()
+    cmd = timer.cmd or "unknown"
+
+    with _lock:
+        histograms = _histograms.setdefault(cmd, {})
+        histograms.setdefault(None, Histogram()).add(total)
+        for stage, duration in timer.stages:
+            histograms.setdefault(stage, Histogram()).add(duration)
+
+    if slow_threshold and total >= slow_threshold:
+        logging.warning("Slow request: cmd=%s VM=%s total=%.3fs %s",
+                        cmd, timer.label, total, timer.breakdown())
+    return timer
+
+
+def stats():
+    """
+    Return {cmd: {count, avg, max, p50, p90, p99, "stages": {stage: {...}}}}
+    with durations in seconds
+    """
+    with _lock:
+        result = {}
+        for cmd, histograms in _histograms.items():
+            summary = histograms[None].summary()
+            summary["stages"] = dict((stage, h.summary())
+                                     for stage, h in histograms.items() if stage is not None)
+            result[cmd] = summary
+        return result
+
+
+def reset():
+    """ Drop all recorded histograms """
+    with _lock:
+        _histograms.clear()
@@ -0,0 +1,102 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for latency.py
+
+import logging
+import time
+import unittest
+import latency
+
+
+class LogCapture(logging.Handler):
+    """Collect formatted log messages (assertLogs is not in Python 2.7)"""
+
+    def __init__(self):
+        logging.Handler.__init__(self, level=logging.WARNING)
+        self.output = []
+
+    def emit(self, record):
+        self.output.append(record.getMessage())
+
+
+class TestHistogram(unittest.TestCase):
+    """Test Histogram percentiles"""
+
+    def test_percentiles(self):
+        h = latency.Histogram()
+        for _ in range(90):
+            h.add(0.01)
+        for _ in range(10):
+            h.add(2.0)
+        summary = h.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["max"], 2.0)
+        # bucket bounds are within a factor of sqrt(2) of the value
+        self.assertTrue(0.01 <= summary["p50"] < 0.01 * latency.HISTOGRAM_FACTOR)
+        self.assertTrue(0.01 <= summary["p90"] < 0.01 * latency.HISTOGRAM_FACTOR)
+        self.assertEqual(summary["p99"], 2.0)
+
+    def test_empty(self):
+        self.assertEqual(latency.Histogram().percentile(99), 0)
+
+
+class TestRequestTiming(unittest.TestCase):
+    """Test per request stage timing"""
+
+    def setUp(self):
+        latency.reset()
+
+    def test_stages(self):
+        latency.start("get", label="vm1")
+        latency.lap("vm_info")
+        time.sleep(0.02)
+        latency.lap("execute")
+        latency.lap("vm_info")
+        timer = latency.finish()
+        stages = dict(timer.stages)
+        self.assertEqual([stage for stage, _ in timer.stages],
+                         ["vm_info", "execute", latency.UNACCOUNTED_STAGE])
+        self.assertTrue(stages["execute"] >= 0.02)
+        self.assertIsNone(latency.current())
+
+        stats = latency.stats()
+        self.assertEqual(stats["get"]["count"], 1)
+        self.assertEqual(stats["get"]["stages"]["execute"]["count"], 1)
+
+    def test_no_timer(self):
+        # laps outside of a timed request are ignored
+        latency.lap("execute")
+        self.assertIsNone(latency.finish())
+        self.assertEqual(latency.stats(), {})
+
+    def test_slow_log(self):
+        saved = latency.slow_threshold
+        latency.slow_threshold = 0.001
+        try:
+            latency.start("create", started_at=time.time() - 1)
+            latency.set_command("remove")
+            logs = LogCapture()
+            logging.getLogger().addHandler(logs)
+            try:
+                latency.finish()
+            finally:
+                logging.getLogger().removeHandler(logs)
+            self.assertIn("cmd=remove", logs.output[0])
+        finally:
+            latency.slow_threshold = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
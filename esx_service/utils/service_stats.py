@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runtime statistics for the vmdkops service.
+# Components register a provider (a function returning a dict) under a name.
+# The service periodically dumps a snapshot of all providers to STATS_FILE,
+# which is where the admin CLI (a separate process) picks it up from.
+
+import json
+import logging
+import os
+import os.path
+import time
+
+import threadutils
+
+# Location of the stats snapshot. /var/run is not persistent, which is what we want.
+STATS_FILE = "/var/run/vmdkops/service_stats.json"
+
+# How often (seconds) the service refreshes STATS_FILE
+STATS_DUMP_INTERVAL = 10
+
+_providers = {}
+_lock = threadutils.get_lock()
+
+
+def register(name, provider):
+    """Register provider() as the source of stats published under 'name'"""
+    with _lock:
+        _providers[name] = provider
+
+
+def unregister(name):
+    """Remove stats provider registered under 'name'"""
+    with _lock:
+        _providers.pop(name, None)
+
+
+def snapshot():
+    """Return a dict {name: provider()} for all registered providers"""
+    with _lock:
+        providers = list(_providers.items())
+
+    result = {}
+    for name, provider in providers:
+        try:
+            result[name] = provider()
+        except Exception as ex:
+            logging.warning("Failed to collect stats for %s: %s", name, ex)
+    return result
+
+
+def dump(path=STATS_FILE):
+    """Write a snapshot to 'path'. The file is replaced atomically."""
+    data = {"pid": os.getpid(),
+            "timestamp": time.time(),
+            "stats": snapshot()}
+    try:
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        tmp_path = "{0}.{1}".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as ex:
+        logging.warning("Failed to save service stats to %s: %s", path, ex)
+
+
+def load(path=STATS_FILE):
+    """Return the last dumped data {pid, timestamp, stats}, or None if unavailable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def flatten(stats, prefix=""):
+    """
+    Flatten nested stats dict into a sorted list of ("a.b.c", value) pairs.
+    Used to print stats as 'key: value' lines.
+    """
+    result = []
+    for key in sorted(stats.keys()):
+        name = "{0}.{1}".format(prefix, key) if prefix else str(key)
+        value = stats[key]
+        if isinstance(value, dict):
+            result += flatten(value, name)
+        else:
+            result.append((name, value))
+    return result
+
+
+def reporter(interval=STATS_DUMP_INTERVAL, path=STATS_FILE):
+    """Thread body - periodically dump stats to 'path'"""
+    threadutils.set_thread_name("StatsReporter")
+    while True:
+        dump(path)
+        time.sleep(interval)
+
+
+def start_reporter(interval=STATS_DUMP_INTERVAL, path=STATS_FILE):
+    """Start a daemon thread refreshing the stats file"""
+    threadutils.start_new_thread(target=reporter, args=(interval, path), daemon=True)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# LRU cache of decoded volume metadata (sidecar) files.
+#
+# An entry is used only if (mtime, size, inode) of the file did not change since
+# the entry was cached. mtime has limited resolution, so a change made in the same
+# mtime tick as the cached read/write would not be noticed. Such "racy" entries
+# (same idea as racy git index entries) are not trusted, and the next get() re-reads
+# the file, which caches it again as a non racy entry.
+
+import collections
+import os
+import time
+
+import threadutils
+
+# Max number of sidecars to keep
+CACHE_SIZE = 1024
+
+# mtime resolution (seconds) assumed for datastore file systems
+MTIME_GRANULARITY = 1
+
+
+def file_signature(st):
+    """ Return (mtime, size, inode) for os.stat() result 'st' """
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def copy_value(value):
+    """ Return a copy of decoded JSON value, so callers can modify it """
+    if isinstance(value, dict):
+        return dict((k, copy_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        # as json would decode it
+        return [copy_value(v) for v in value]
+    return value
+
+
+class SidecarCache(object):
+    """
+    Bounded LRU cache of {path: decoded sidecar dict}, validated with file signature.
+    get() and put() work with copies, so cached dicts are never shared with callers.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, mtime_granularity=MTIME_GRANULARITY):
+        self._max_size = max_size
+        self._mtime_granularity = mtime_granularity
+        self._lock = threadutils.get_lock()
+        # {path: (signature, racy, value)}, in LRU order
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evictions = 0
+
+    def get(self, path, meta_file):
+        """
+        Return a copy of the dict cached for 'path' if its sidecar 'meta_file' did not
+        change since it was cached, or None
+        """
+        try:
+            sig = file_signature(os.stat(meta_file))
+        except OSError:
+            sig = None
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if not entry:
+                self._misses += 1
+                return None
+            if sig is None or entry[0] != sig or entry[1]:
+                del self._entries[path]
+                self._stale += 1
+                self._misses += 1
+                return None
+            # LRU bump, OrderedDict.move_to_end() is not in Python 2.7
+            self._entries[path] = self._entries.pop(path)
+            self._hits += 1
+            value = entry[2]
+        return copy_value(value)
+
+    def put(self, path, meta_file, value, copy=True):
+        """
+        Cache 'value' as content of sidecar 'meta_file' of 'path', read or written just now.
+        With copy=False 'value' is cached as is, and the caller must not modify it.
+        """
+        now = time.time()
+        try:
+            st = os.stat(meta_file)
+        except OSError:
+            self.invalidate(path)
+            return
+        racy = st.st_mtime >= now - self._mtime_granularity
+        if copy:
+            value = copy_value(value)
+
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = (file_signature(st), racy, value)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, path=None):
+        """ Drop cached sidecar for 'path', or all of them if 'path' is None """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        """ Return a dict with cache statistics """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {"size": len(self._entries),
+                    "hits": self._hits,
+                    "misses": self._misses,
+                    "hit_rate": round(float(self._hits) / lookups, 3) if lookups else 0,
+                    "stale": self._stale,
+                    "evictions": self._evictions}
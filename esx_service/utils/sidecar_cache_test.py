@@ -0,0 +1,108 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for sidecar_cache.py
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import sidecar_cache
+
+VOL_PATH = "/vmfs/volumes/ds1/dockvols/vol1.vmdk"
+
+
+class TestSidecarCache(unittest.TestCase):
+    """Test validation and eviction of cached sidecars"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.meta_file = os.path.join(self.dir, "vol1-1234.vmfd")
+        self.write(self.meta_file, '{"status": "detached"}')
+        self.cache = sidecar_cache.SidecarCache(max_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content, age=10):
+        """ Write file with mtime 'age' seconds in the past, so it is not racy """
+        with open(path, "w") as f:
+            f.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_hit(self):
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "detached", "volOpts": {"size": "1gb"}})
+        value = self.cache.get(VOL_PATH, self.meta_file)
+        self.assertEqual(value["volOpts"]["size"], "1gb")
+        # callers get copies
+        value["volOpts"]["size"] = "2gb"
+        self.assertEqual(self.cache.get(VOL_PATH, self.meta_file)["volOpts"]["size"], "1gb")
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (2, 1, 0.667))
+
+    def test_changed_file(self):
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "detached"})
+        # same size and mtime, but a new inode
+        new_file = self.meta_file + ".new"
+        self.write(new_file, '{"status": "attached"}')
+        st = os.stat(self.meta_file)
+        os.utime(new_file, (st.st_atime, st.st_mtime))
+        os.rename(new_file, self.meta_file)
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+        self.assertEqual(self.cache.stats()["stale"], 1)
+
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "attached"})
+        self.write(self.meta_file, '{"status": "detached"}', age=5)
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+
+    def test_racy(self):
+        # file changed just now, a change in the same mtime tick would be missed
+        self.write(self.meta_file, '{"status": "attached"}', age=0)
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "attached"})
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+
+    def test_missing_file(self):
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "detached"})
+        os.remove(self.meta_file)
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "detached"})
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_lru(self):
+        files = []
+        for i in range(3):
+            meta_file = os.path.join(self.dir, "vol{}.vmfd".format(i))
+            self.write(meta_file, "{}")
+            files.append(("vol{}.vmdk".format(i), meta_file))
+        self.cache.put(files[0][0], files[0][1], {})
+        self.cache.put(files[1][0], files[1][1], {})
+        # use vol0, so vol1 is the least recently used one
+        self.assertEqual(self.cache.get(files[0][0], files[0][1]), {})
+        self.cache.put(files[2][0], files[2][1], {})
+        self.assertIsNone(self.cache.get(files[1][0], files[1][1]))
+        self.assertEqual(self.cache.get(files[0][0], files[0][1]), {})
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        self.cache.put(VOL_PATH, self.meta_file, {"status": "detached"})
+        self.cache.invalidate(VOL_PATH)
+        self.assertIsNone(self.cache.get(VOL_PATH, self.meta_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
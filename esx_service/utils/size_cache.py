@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# LRU cache of (capacity, allocated) sizes of VMDKs.
+#
+# Reading the sizes opens the whole disk chain, so it is not done on every request.
+# Capacity changes only when we create, clone or delete a disk, and the entry is
+# invalidated then. Allocated size drifts as the disk is written to, so entries are
+# refreshed by a background sampler, a few at a time, before they get older than
+# max_staleness. A get() of an entry older than that reads the sizes again, so
+# the age returned with the sizes never exceeds max_staleness.
+
+import collections
+import logging
+import time
+
+import threadutils
+
+# Max number of disks to keep
+CACHE_SIZE = 4096
+
+# Max age (seconds) of allocated size returned by get()
+MAX_STALENESS = 300
+
+# Sampler wakes up every SAMPLE_INTERVAL seconds and refreshes up to SAMPLE_BATCH
+# entries older than half of max_staleness, pausing SAMPLE_PAUSE seconds between them
+SAMPLE_INTERVAL = 30
+SAMPLE_BATCH = 32
+SAMPLE_PAUSE = 0.1
+
+
+class SizeCache(object):
+    """
+    Cache of {path: (capacity, allocated)}, with allocated size at most max_staleness old.
+    size_fn(path) returns (capacity, allocated) of the disk, or None on errors.
+    """
+
+    def __init__(self, size_fn, max_size=CACHE_SIZE, max_staleness=MAX_STALENESS,
+                 clock=time.time):
+        self.max_staleness = max_staleness
+        self._size_fn = size_fn
+        self._max_size = max_size
+        self._clock = clock
+        self._lock = threadutils.get_lock()
+        # {path: (capacity, allocated, sampled at)}, in LRU order
+        self._entries = collections.OrderedDict()
+        # bumped by invalidate(), so a size read before it is not cached
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._sampled = 0
+        self._errors = 0
+        self._evictions = 0
+
+    def get(self, path):
+        """
+        Return (capacity, allocated, age in seconds of allocated) of the disk, or None
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                age = self._clock() - entry[2]
+                if age <= self.max_staleness:
+                    # LRU bump, OrderedDict.move_to_end() is not in Python 2.7
+                    self._entries[path] = self._entries.pop(path)
+                    self._hits += 1
+                    return entry[0], entry[1], age
+            self._misses += 1
+
+        entry = self.refresh(path)
+        if entry:
+            with self._lock:
+                if path in self._entries:
+                    self._entries[path] = self._entries.pop(path)
+        return entry
+
+    def refresh(self, path):
+        """
+        Read sizes of the disk and cache them. Return (capacity, allocated, 0), or None
+        """
+        with self._lock:
+            generation = self._generation
+        size = self._size_fn(path)
+        with self._lock:
+            if size is None:
+                self._errors += 1
+                self._entries.pop(path, None)
+                return None
+            if generation == self._generation:
+                self._entries[path] = (size[0], size[1], self._clock())
+                while len(self._entries) > self._max_size:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        return size[0], size[1], 0
+
+    def invalidate(self, path=None):
+        """ Drop cached sizes of 'path', or of all disks if 'path' is None """
+        with self._lock:
+            self._generation += 1
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def sample(self, max_count=SAMPLE_BATCH, pause=0):
+        """
+        Refresh up to max_count entries older than half of max_staleness, oldest first,
+        sleeping 'pause' seconds after each. Return the number of entries refreshed.
+        """
+        with self._lock:
+            oldest = self._clock() - self.max_staleness / 2.0
+            paths = sorted((entry[2], path) for path, entry in self._entries.items()
+                           if entry[2] <= oldest)
+        count = 0
+        for _, path in paths[:max_count]:
+            with self._lock:
+                if path not in self._entries:
+                    continue
+            self.refresh(path)
+            count += 1
+            with self._lock:
+                self._sampled += 1
+            if pause:
+                time.sleep(pause)
+        return count
+
+    def stats(self):
+        """ Return a dict with cache statistics """
+        with self._lock:
+            lookups = self._hits + self._misses
+            now = self._clock()
+            return {"size": len(self._entries),
+                    "max_staleness": self.max_staleness,
+                    "oldest": round(max([now - e[2] for e in self._entries.values()] or [0]), 1),
+                    "hits": self._hits,
+                    "misses": self._misses,
+                    "hit_rate": round(float(self._hits) / lookups, 3) if lookups else 0,
+                    "sampled": self._sampled,
+                    "errors": self._errors,
+                    "evictions": self._evictions}
+
+
+def sampler(cache, interval, batch, pause):
+    """Thread body - periodically refresh sizes in the cache"""
+    threadutils.set_thread_name("SizeSampler")
+    while True:
+        time.sleep(interval)
+        try:
+            cache.sample(batch, pause)
+        except Exception:
+            logging.exception("Failed to refresh disk sizes")
+
+
+def start_sampler(cache, interval=SAMPLE_INTERVAL, batch=SAMPLE_BATCH, pause=SAMPLE_PAUSE):
+    """Start a daemon thread refreshing sizes in the cache"""
+    threadutils.start_new_thread(target=sampler, args=(cache, interval, batch, pause), daemon=True)
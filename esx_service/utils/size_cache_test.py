@@ -0,0 +1,106 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for size_cache.py
+
+import unittest
+
+import size_cache
+
+VOL1 = "/vmfs/volumes/ds1/dockvols/vol1.vmdk"
+VOL2 = "/vmfs/volumes/ds1/dockvols/vol2.vmdk"
+
+
+class TestSizeCache(unittest.TestCase):
+    """Test staleness, invalidation and sampling of cached disk sizes"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.sizes = {VOL1: (100, 10), VOL2: (200, 20)}
+        self.calls = []
+        self.cache = size_cache.SizeCache(self.get_size, max_size=2, max_staleness=60,
+                                          clock=lambda: self.now)
+
+    def get_size(self, path):
+        self.calls.append(path)
+        return self.sizes.get(path)
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get(VOL1), (100, 10, 0))
+        self.now += 30
+        self.sizes[VOL1] = (100, 15)
+        self.assertEqual(self.cache.get(VOL1), (100, 10, 30))
+        self.assertEqual(self.calls, [VOL1])
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["oldest"]), (1, 1, 30))
+
+    def test_staleness_bound(self):
+        self.cache.get(VOL1)
+        self.sizes[VOL1] = (100, 15)
+        self.now += 61
+        self.assertEqual(self.cache.get(VOL1), (100, 15, 0))
+        self.assertEqual(self.calls, [VOL1, VOL1])
+
+    def test_invalidate(self):
+        self.cache.get(VOL1)
+        self.sizes[VOL1] = (300, 10)
+        self.cache.invalidate(VOL1)
+        self.assertEqual(self.cache.get(VOL1), (300, 10, 0))
+
+    def test_invalidate_during_refresh(self):
+        def get_size(path):
+            # disk is resized while its old size is being read
+            cache.invalidate(path)
+            return (100, 10)
+        cache = size_cache.SizeCache(get_size, clock=lambda: self.now)
+        self.assertEqual(cache.get(VOL1), (100, 10, 0))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_missing_disk(self):
+        self.assertIsNone(self.cache.get("/vmfs/volumes/ds1/dockvols/gone.vmdk"))
+        self.cache.get(VOL1)
+        del self.sizes[VOL1]
+        self.cache.invalidate(VOL1)
+        self.assertIsNone(self.cache.get(VOL1))
+        stats = self.cache.stats()
+        self.assertEqual((stats["size"], stats["errors"]), (0, 2))
+
+    def test_sample(self):
+        self.cache.get(VOL1)
+        self.now += 20
+        self.cache.get(VOL2)
+        self.now += 15
+        self.sizes[VOL1] = (100, 12)
+        # only VOL1 is older than half of max_staleness
+        self.assertEqual(self.cache.sample(), 1)
+        self.assertEqual(self.cache.get(VOL1), (100, 12, 0))
+        self.now += 20
+        self.assertEqual(self.cache.sample(max_count=1), 1)
+        self.assertEqual(self.calls, [VOL1, VOL2, VOL1, VOL2])
+        self.assertEqual(self.cache.stats()["sampled"], 2)
+
+    def test_lru(self):
+        self.cache.get(VOL1)
+        self.cache.get(VOL2)
+        self.cache.get(VOL1)
+        self.cache.get("/vmfs/volumes/ds1/dockvols/vol3.vmdk")
+        self.sizes["/vmfs/volumes/ds1/dockvols/vol3.vmdk"] = (1, 1)
+        self.cache.get("/vmfs/volumes/ds1/dockvols/vol3.vmdk")
+        self.cache.get(VOL1)
+        self.assertEqual(self.calls.count(VOL1), 1)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,8 +19,251 @@ Written by Bruno Moura <brunotm@gmail.com>
 
 import threading
 import logging
+import sys
+import time
+from collections import deque
 from weakref import WeakValueDictionary
 
+# Max number of lock names LockManager keeps statistics for. Past that, stats
+# of idle locks not used for the longest time are dropped.
+MAX_LOCK_STATS = 4096
+
+
+class LockStats(object):
+    """
+    Contention statistics of a named lock: acquire wait time, hold time,
+    current holder and number of waiters
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = get_lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.waiters = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_hold = 0.0
+        self.max_hold = 0.0
+        self.holder = None
+        self.held_since = None
+        self.readers = 0
+        self.last_used = time.time()
+
+    def wait_begin(self):
+        with self._lock:
+            self.waiters += 1
+            self.contended += 1
+
+    def wait_end(self):
+        with self._lock:
+            self.waiters -= 1
+
+    def acquired(self, wait, holder, now, shared=False):
+        """
+        Record an acquisition. Shared (reader) holds are accounted as one hold,
+        from the first reader in to the last reader out.
+        """
+        with self._lock:
+            self.acquisitions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.last_used = now
+            if shared:
+                self.readers += 1
+                self.holder = "{0} reader(s)".format(self.readers)
+                if self.readers > 1:
+                    return
+            else:
+                self.holder = holder
+            self.held_since = now
+
+    def released(self, now, shared=False):
+        with self._lock:
+            if shared:
+                self.readers -= 1
+                if self.readers:
+                    self.holder = "{0} reader(s)".format(self.readers)
+                    return
+            hold = now - self.held_since
+            self.total_hold += hold
+            self.max_hold = max(self.max_hold, hold)
+            self.holder = None
+            self.held_since = None
+            self.last_used = now
+
+    def is_idle(self):
+        return self.holder is None and self.waiters == 0
+
+    def to_dict(self, now):
+        """Return stats as a dict, times in seconds"""
+        with self._lock:
+            return {"acquisitions": self.acquisitions,
+                    "contended": self.contended,
+                    "waiters": self.waiters,
+                    "total_wait": round(self.total_wait, 4),
+                    "max_wait": round(self.max_wait, 4),
+                    "total_hold": round(self.total_hold, 4),
+                    "max_hold": round(self.max_hold, 4),
+                    "holder": self.holder,
+                    "held_for": round(now - self.held_since, 4) if self.held_since else 0}
+
+
+class InstrumentedLock(object):
+    """
+    Lock or RLock recording contention in LockStats.
+    Supports the same acquire()/release() and context manager protocol.
+    """
+    def __init__(self, name, stats, reentrant=False):
+        self.name = name
+        self._lock = get_lock(reentrant)
+        self._stats = stats
+        self._depth = 0  # only changed by the thread holding the lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.time()
+        acquired = self._lock.acquire(False)
+        if not acquired and blocking:
+            self._stats.wait_begin()
+            try:
+                acquired = acquire_with_timeout(self._lock, timeout)
+            finally:
+                self._stats.wait_end()
+        if acquired:
+            self._depth += 1
+            if self._depth == 1:
+                now = time.time()
+                self._stats.acquired(now - start, get_thread_name(), now)
+        return acquired
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._stats.released(time.time())
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __repr__(self):
+        return "<InstrumentedLock {0}>".format(self.name)
+
+
+class RWLock(object):
+    """
+    Reader/writer lock: any number of readers, or a single writer. Not reentrant.
+    Fairness: once a writer is waiting, new readers wait behind it, so writers
+    cannot be starved by a stream of readers. When a writer releases the lock,
+    the readers that were waiting for it go first, before the next writer, so
+    readers cannot be starved by a stream of writers either.
+    Optionally records contention in 'stats' (LockStats).
+
+    Use acquire_read()/release_read() and acquire_write()/release_write(),
+    or the context managers: "with rwlock.read():" / "with rwlock.write():"
+    """
+    def __init__(self, name=None, stats=None):
+        self.name = name
+        self._stats = stats
+        self._cond = threading.Condition(get_lock())
+        self._readers = 0           # readers holding the lock
+        self._writer = False        # True if a writer holds the lock
+        self._readers_waiting = 0
+        self._writers_waiting = 0
+        self._read_batch = 0        # waiting readers admitted ahead of writers
+
+    def acquire_read(self):
+        start = time.time()
+        with self._cond:
+            if self._writer or self._writers_waiting:
+                self._wait_begin()
+                self._readers_waiting += 1
+                try:
+                    while self._writer or (self._writers_waiting and not self._read_batch):
+                        self._cond.wait()
+                finally:
+                    self._readers_waiting -= 1
+                    self._wait_end()
+                if self._read_batch:
+                    self._read_batch -= 1
+            self._readers += 1
+        self._acquired(start, shared=True)
+
+    def release_read(self):
+        self._released(shared=True)
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        start = time.time()
+        with self._cond:
+            if self._writer or self._readers or self._read_batch:
+                self._wait_begin()
+                self._writers_waiting += 1
+                try:
+                    while self._writer or self._readers or self._read_batch:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                    self._wait_end()
+            self._writer = True
+        self._acquired(start, shared=False)
+
+    def release_write(self):
+        self._released(shared=False)
+        with self._cond:
+            self._writer = False
+            # let readers that waited for this writer go before the next writer
+            self._read_batch = self._readers_waiting
+            self._cond.notify_all()
+
+    def read(self):
+        """Context manager holding the lock shared"""
+        return _RWLockHolder(self.acquire_read, self.release_read)
+
+    def write(self):
+        """Context manager holding the lock exclusive"""
+        return _RWLockHolder(self.acquire_write, self.release_write)
+
+    def _wait_begin(self):
+        if self._stats:
+            self._stats.wait_begin()
+
+    def _wait_end(self):
+        if self._stats:
+            self._stats.wait_end()
+
+    def _acquired(self, start, shared):
+        if self._stats:
+            now = time.time()
+            self._stats.acquired(now - start, get_thread_name(), now, shared=shared)
+
+    def _released(self, shared):
+        if self._stats:
+            self._stats.released(time.time(), shared=shared)
+
+    def __repr__(self):
+        return "<RWLock {0}>".format(self.name)
+
+
+class _RWLockHolder(object):
+    """Context manager returned by RWLock.read() and RWLock.write()"""
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+
 class LockManager(object):
     """
     Thread safe lock manager class
@@ -28,6 +271,8 @@ class LockManager(object):
     def __init__(self):
         self._lock = get_lock()
         self._lock_store = WeakValueDictionary()
+        self._rwlock_store = WeakValueDictionary()
+        self._lock_stats = {}
 
     def get_lock(self, lockname, reentrant=False):
         """
@@ -39,7 +284,7 @@ class LockManager(object):
                 # logging.debug("LockManager.get_lock: existing lock: %s, %s",
                 #               lockname, lock)
             except KeyError:
-                lock = get_lock(reentrant)
+                lock = InstrumentedLock(lockname, self._get_stats(lockname), reentrant)
                 self._lock_store[lockname] = lock
                 # logging.debug("LockManager.get_lock: new lock: %s, %s",
                 #               lockname, lock)
@@ -47,6 +292,40 @@ class LockManager(object):
             #               self._list_locks())
             return lock
 
+    def get_rwlock(self, lockname):
+        """
+        Create or return a existing reader/writer lock identified by lockname.
+        RW locks are kept apart from the locks returned by get_lock().
+        """
+        with self._lock:
+            lock = self._rwlock_store.get(lockname)
+            if lock is None:
+                lock = RWLock(lockname, self._get_stats(lockname))
+                self._rwlock_store[lockname] = lock
+            return lock
+
+    def _get_stats(self, lockname):
+        """
+        Return LockStats for lockname. Stats outlive the (weakly referenced) locks,
+        so they accumulate over the life of the service.
+        """
+        stats = self._lock_stats.get(lockname)
+        if not stats:
+            if len(self._lock_stats) >= MAX_LOCK_STATS:
+                self._prune_stats()
+            stats = LockStats(lockname)
+            self._lock_stats[lockname] = stats
+        return stats
+
+    def _prune_stats(self):
+        """Drop stats for the least recently used half of idle locks"""
+        idle = sorted((s for s in self._lock_stats.values()
+                       if s.is_idle() and s.name not in self._lock_store
+                       and s.name not in self._rwlock_store),
+                      key=lambda s: s.last_used)
+        for s in idle[:max(1, len(idle) // 2)]:
+            del self._lock_stats[s.name]
+
     def _list_locks(self):
         return self._lock_store.keys()
 
@@ -57,6 +336,15 @@ class LockManager(object):
         with self._lock:
             return self._list_locks()
 
+    def stats(self):
+        """
+        Return {lockname: stats dict} for all locks handed out by this manager.
+        """
+        now = time.time()
+        with self._lock:
+            lock_stats = list(self._lock_stats.values())
+        return dict((s.name, s.to_dict(now)) for s in lock_stats)
+
 
 def get_lock_decorator(reentrant=False):
     """
@@ -129,3 +417,313 @@ def get_lock(reentrant=False):
         return threading.RLock()
     else:
         return threading.Lock()
+
+
+def acquire_with_timeout(lock, timeout):
+    """
+    Acquire a Lock, RLock or Semaphore, waiting at most 'timeout' seconds,
+    or forever if timeout is negative. Return True if acquired.
+    Python 2.7 acquire() takes no timeout, so it is emulated by polling there.
+    """
+    if timeout < 0:
+        return lock.acquire()
+    if sys.version_info.major >= 3:
+        return lock.acquire(True, timeout)
+
+    deadline = time.time() + timeout
+    delay = 0.0005
+    while not lock.acquire(False):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+    return True
+
+
+class RequestQueue(object):
+    """
+    FIFO queue of pending requests. Not thread safe, the owner
+    (e.g. WorkerPool) is expected to serialize access to it.
+    """
+    def __init__(self):
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, key=None, weight=1, label=None):
+        """Append item to the queue. key, weight and label are ignored for plain FIFO"""
+        self._items.append((time.time(), item))
+
+    def get(self):
+        """Remove and return (queued_at, item) for the oldest item"""
+        return self._items.popleft()
+
+    def oldest(self):
+        """Return the enqueue time of the oldest item, or None if empty"""
+        if not self._items:
+            return None
+        return self._items[0][0]
+
+    def stats(self):
+        """Return a dict with queue specific statistics"""
+        return {}
+
+
+class _Flow(object):
+    """Per key state of FairShareQueue"""
+    def __init__(self, label, weight):
+        self.label = label
+        self.weight = weight
+        self.items = deque()
+        self.deficit = 0
+        self.last_active = time.time()
+        self.queued = 0
+        self.served = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+
+class FairShareQueue(object):
+    """
+    Request queue with fair share between keys (e.g. VMs), using deficit round robin.
+    Each key with pending requests gets up to 'weight' requests served per round,
+    so a key flooding the queue cannot starve other keys.
+    Like RequestQueue, access is expected to be serialized by the owner.
+    """
+    # Forget stats for keys idle (with no requests) for longer than this, in seconds
+    IDLE_TIMEOUT = 600
+
+    def __init__(self):
+        self._flows = {}
+        self._active = deque()   # keys with pending requests, in round robin order
+        self._count = 0
+        self._last_prune = time.time()
+
+    def __len__(self):
+        return self._count
+
+    def put(self, item, key=None, weight=1, label=None):
+        """Append item to the queue of 'key', served with the share 'weight'"""
+        now = time.time()
+        flow = self._flows.get(key)
+        if not flow:
+            flow = _Flow(label if label else str(key), weight)
+            self._flows[key] = flow
+        flow.weight = max(1, weight)
+        if label:
+            flow.label = label
+        if not flow.items:
+            self._active.append(key)
+        flow.items.append((now, item))
+        flow.queued += 1
+        flow.last_active = now
+        self._count += 1
+        if now - self._last_prune > self.IDLE_TIMEOUT:
+            self._prune(now)
+
+    def get(self):
+        """Remove and return (queued_at, item) for the next item in round robin order"""
+        key = self._active[0]
+        flow = self._flows[key]
+        # each time the key comes up in the round it gets 'weight' more requests served
+        if flow.deficit <= 0:
+            flow.deficit += flow.weight
+        flow.deficit -= 1
+        queued_at, item = flow.items.popleft()
+        self._count -= 1
+
+        if not flow.items:
+            flow.deficit = 0
+            self._active.popleft()
+        elif flow.deficit <= 0:
+            self._active.rotate(-1)
+
+        now = time.time()
+        wait = now - queued_at
+        flow.served += 1
+        flow.wait_time += wait
+        flow.max_wait = max(flow.max_wait, wait)
+        flow.last_active = now
+        return queued_at, item
+
+    def oldest(self):
+        """Return the enqueue time of the oldest item, or None if empty"""
+        if not self._active:
+            return None
+        return min(self._flows[key].items[0][0] for key in self._active)
+
+    def _prune(self, now):
+        """Drop idle keys, so stats do not grow without bounds"""
+        self._last_prune = now
+        for key in [k for k, f in self._flows.items()
+                    if not f.items and now - f.last_active > self.IDLE_TIMEOUT]:
+            del self._flows[key]
+
+    def stats(self):
+        """Return a dict with per key queue length and wait time"""
+        per_key = {}
+        for key, flow in self._flows.items():
+            label = flow.label if flow.label not in per_key else "{0}/{1}".format(flow.label, key)
+            per_key[label] = {"weight": flow.weight,
+                              "queued": len(flow.items),
+                              "total_queued": flow.queued,
+                              "served": flow.served,
+                              "avg_queue_wait": round(flow.wait_time / flow.served, 3) if flow.served else 0,
+                              "max_queue_wait": round(flow.max_wait, 3)}
+        return {"active_keys": len(self._active), "keys": per_key}
+
+
+class WorkerPool(object):
+    """
+    Fixed size pool of worker threads serving a bounded request queue.
+    submit() refuses new work once max_queued requests are waiting, so
+    callers can push back on clients instead of piling up threads.
+    """
+    def __init__(self, name, workers, max_queued, request_queue=None):
+        self._name = name
+        self._workers = workers
+        self._max_queued = max_queued
+        self._queue = request_queue if request_queue is not None else RequestQueue()
+        self._cond = threading.Condition(get_lock())
+        self._busy = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._busy_time = 0.0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._started = None
+
+    def start(self):
+        """Start the worker threads"""
+        with self._cond:
+            if self._started:
+                return
+            self._started = time.time()
+        for index in range(self._workers):
+            start_new_thread(target=self._worker, args=(index,), daemon=True)
+        logging.info("WorkerPool %s: started %d workers, max queued requests %d",
+                     self._name, self._workers, self._max_queued)
+
+    def submit(self, target, args=(), key=None, weight=1, label=None):
+        """
+        Queue target(*args) for execution by a worker.
+        Returns False (and does not queue) when the queue is at its limit.
+        key, weight and label are passed to the request queue, e.g. for fair share scheduling.
+        """
+        with self._cond:
+            if len(self._queue) >= self._max_queued:
+                self._rejected += 1
+                return False
+            self._queue.put((target, args), key, weight, label)
+            self._submitted += 1
+            self._cond.notify()
+            return True
+
+    def _worker(self, index):
+        """Worker thread body - serve requests forever"""
+        worker_name = "{0}-{1}".format(self._name, index)
+        while True:
+            set_thread_name(worker_name)
+            with self._cond:
+                while not len(self._queue):
+                    self._cond.wait()
+                queued_at, (target, args) = self._queue.get()
+                self._busy += 1
+            start = time.time()
+            wait = start - queued_at
+            try:
+                target(*args)
+            except Exception:
+                logging.exception("WorkerPool %s: unhandled exception in %s", self._name, target)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._completed += 1
+                    self._busy_time += time.time() - start
+                    self._wait_time += wait
+                    self._max_wait = max(self._max_wait, wait)
+
+    def stats(self):
+        """Return a dict with pool statistics"""
+        with self._cond:
+            now = time.time()
+            oldest = self._queue.oldest()
+            uptime = now - self._started if self._started else 0
+            result = {"workers": self._workers,
+                      "busy": self._busy,
+                      "utilization": round(float(self._busy) / self._workers, 3) if self._workers else 0,
+                      "avg_utilization": round(self._busy_time / (uptime * self._workers), 3) \
+                                         if uptime and self._workers else 0,
+                      "queued": len(self._queue),
+                      "max_queued": self._max_queued,
+                      "oldest_queued_age": round(now - oldest, 3) if oldest else 0,
+                      "avg_queue_wait": round(self._wait_time / self._completed, 3) if self._completed else 0,
+                      "max_queue_wait": round(self._max_wait, 3),
+                      "submitted": self._submitted,
+                      "rejected": self._rejected,
+                      "completed": self._completed}
+            result.update(self._queue.stats())
+            return result
+
+
+class _Call(object):
+    """An in-flight SingleFlight call"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one execution.
+    The first caller for a key runs the function, callers arriving while it
+    is running wait for it and get the same result (or exception).
+    Only use for calls without side effects, e.g. read-only requests.
+    """
+    def __init__(self):
+        self._lock = get_lock()
+        self._calls = {}
+        self._requests = 0
+        self._collapsed = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), sharing the execution with concurrent calls for key"""
+        with self._lock:
+            self._requests += 1
+            call = self._calls.get(key)
+            if call:
+                self._collapsed += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Return a dict with request and collapse counters"""
+        with self._lock:
+            return {"requests": self._requests,
+                    "collapsed": self._collapsed,
+                    "collapse_rate": round(float(self._collapsed) / self._requests, 3) if self._requests else 0,
+                    "in_flight": len(self._calls)}
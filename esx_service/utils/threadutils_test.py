@@ -0,0 +1,351 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for threadutils.py
+
+import threading
+import time
+import unittest
+import threadutils
+
+# Max seconds to wait for workers in tests
+WAIT_TIMEOUT = 5
+
+
+class TestLockManager(unittest.TestCase):
+    """Test LockManager lock contention stats"""
+
+    def test_uncontended(self):
+        manager = threadutils.LockManager()
+        with manager.get_lock("vol1"):
+            self.assertEqual(manager.stats()["vol1"]["holder"], threadutils.get_thread_name())
+        stats = manager.stats()["vol1"]
+        self.assertEqual(stats["acquisitions"], 1)
+        self.assertEqual(stats["contended"], 0)
+        self.assertIsNone(stats["holder"])
+
+    def test_contended(self):
+        manager = threadutils.LockManager()
+        lock = manager.get_lock("vol1")
+        lock.acquire()
+        t = threading.Thread(target=lambda: manager.get_lock("vol1").acquire())
+        t.start()
+        while manager.stats()["vol1"]["waiters"] < 1:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        lock.release()
+        t.join(WAIT_TIMEOUT)
+        stats = manager.stats()["vol1"]
+        self.assertEqual(stats["acquisitions"], 2)
+        self.assertEqual(stats["contended"], 1)
+        self.assertEqual(stats["waiters"], 0)
+        self.assertTrue(stats["max_wait"] >= 0.05)
+        self.assertTrue(stats["max_hold"] >= 0.05)
+
+    def test_reentrant(self):
+        manager = threadutils.LockManager()
+        lock = manager.get_lock("siLock", reentrant=True)
+        with lock:
+            with lock:
+                pass
+            self.assertIsNotNone(manager.stats()["siLock"]["holder"])
+        self.assertEqual(manager.stats()["siLock"]["acquisitions"], 1)
+        self.assertIsNone(manager.stats()["siLock"]["holder"])
+
+    def test_acquire_timeout(self):
+        manager = threadutils.LockManager()
+        lock = manager.get_lock("vol1")
+        lock.acquire()
+        results = []
+        t = threading.Thread(target=lambda: results.append(manager.get_lock("vol1").acquire(timeout=0.1)))
+        t.start()
+        t.join(WAIT_TIMEOUT)
+        self.assertEqual(results, [False])
+        t = threading.Thread(target=lambda: results.append(manager.get_lock("vol1").acquire(timeout=WAIT_TIMEOUT)))
+        t.start()
+        time.sleep(0.05)
+        lock.release()
+        t.join(WAIT_TIMEOUT)
+        self.assertEqual(results, [False, True])
+        self.assertEqual(manager.stats()["vol1"]["acquisitions"], 2)
+
+    def test_stats_outlive_lock(self):
+        manager = threadutils.LockManager()
+        with manager.get_lock("vol1"):
+            pass
+        # the lock itself is only weakly referenced by the manager
+        self.assertEqual(list(manager.list_locks()), [])
+        self.assertEqual(manager.stats()["vol1"]["acquisitions"], 1)
+
+
+class TestRWLock(unittest.TestCase):
+    """Test RWLock sharing and fairness"""
+
+    def start(self, target):
+        t = threading.Thread(target=target)
+        t.start()
+        return t
+
+    def wait_for(self, condition):
+        deadline = time.time() + WAIT_TIMEOUT
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_shared_readers(self):
+        lock = threadutils.RWLock()
+        lock.acquire_read()
+        entered = threading.Event()
+
+        def reader():
+            with lock.read():
+                entered.set()
+
+        t = self.start(reader)
+        self.assertTrue(entered.wait(WAIT_TIMEOUT))
+        lock.release_read()
+        t.join(WAIT_TIMEOUT)
+
+    def test_writer_excludes_readers(self):
+        lock = threadutils.RWLock()
+        lock.acquire_write()
+        entered = threading.Event()
+
+        def reader():
+            with lock.read():
+                entered.set()
+
+        t = self.start(reader)
+        self.assertFalse(entered.wait(0.1))
+        lock.release_write()
+        self.assertTrue(entered.wait(WAIT_TIMEOUT))
+        t.join(WAIT_TIMEOUT)
+
+    def test_writer_not_starved(self):
+        lock = threadutils.RWLock()
+        order = []
+        lock.acquire_read()
+
+        def writer():
+            with lock.write():
+                order.append("writer")
+
+        def reader():
+            with lock.read():
+                order.append("reader")
+
+        w = self.start(writer)
+        self.wait_for(lambda: lock._writers_waiting == 1)
+        # a new reader queues behind the waiting writer
+        r = self.start(reader)
+        self.wait_for(lambda: lock._readers_waiting == 1)
+        lock.release_read()
+        w.join(WAIT_TIMEOUT)
+        r.join(WAIT_TIMEOUT)
+        self.assertEqual(order, ["writer", "reader"])
+
+    def test_readers_not_starved(self):
+        lock = threadutils.RWLock()
+        order = []
+        lock.acquire_write()
+
+        def writer():
+            with lock.write():
+                order.append("writer")
+
+        def reader():
+            with lock.read():
+                order.append("reader")
+
+        r = self.start(reader)
+        self.wait_for(lambda: lock._readers_waiting == 1)
+        w = self.start(writer)
+        self.wait_for(lambda: lock._writers_waiting == 1)
+        # the reader waiting for the first writer goes before the second one
+        lock.release_write()
+        r.join(WAIT_TIMEOUT)
+        w.join(WAIT_TIMEOUT)
+        self.assertEqual(order, ["reader", "writer"])
+
+    def test_stats(self):
+        manager = threadutils.LockManager()
+        lock = manager.get_rwlock("vol1")
+        self.assertIs(lock, manager.get_rwlock("vol1"))
+        with lock.read():
+            with manager.get_rwlock("vol1").read():
+                self.assertEqual(manager.stats()["vol1"]["holder"], "2 reader(s)")
+        with lock.write():
+            pass
+        stats = manager.stats()["vol1"]
+        self.assertEqual(stats["acquisitions"], 3)
+        self.assertIsNone(stats["holder"])
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Test WorkerPool scheduling and backpressure"""
+
+    def test_executes_requests(self):
+        pool = threadutils.WorkerPool(name="TestPool", workers=2, max_queued=10)
+        pool.start()
+        done = threading.Semaphore(0)
+        results = []
+
+        def work(i):
+            results.append(i)
+            done.release()
+
+        for i in range(5):
+            self.assertTrue(pool.submit(work, args=(i,)))
+        for _ in range(5):
+            self.assertTrue(threadutils.acquire_with_timeout(done, WAIT_TIMEOUT))
+        self.assertEqual(sorted(results), list(range(5)))
+        self.assertEqual(pool.stats()["submitted"], 5)
+
+    def test_rejects_when_full(self):
+        pool = threadutils.WorkerPool(name="TestPool", workers=1, max_queued=2)
+        pool.start()
+        release = threading.Event()
+        started = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(WAIT_TIMEOUT)
+
+        # occupy the only worker, then fill the queue
+        self.assertTrue(pool.submit(block))
+        self.assertTrue(started.wait(WAIT_TIMEOUT))
+        self.assertTrue(pool.submit(block))
+        self.assertTrue(pool.submit(block))
+        self.assertFalse(pool.submit(block))
+
+        stats = pool.stats()
+        self.assertEqual(stats["busy"], 1)
+        self.assertEqual(stats["queued"], 2)
+        self.assertEqual(stats["rejected"], 1)
+        release.set()
+
+    def test_survives_exceptions(self):
+        pool = threadutils.WorkerPool(name="TestPool", workers=1, max_queued=10)
+        pool.start()
+        done = threading.Event()
+
+        def fail():
+            raise ValueError("expected failure")
+
+        pool.submit(fail)
+        pool.submit(done.set)
+        self.assertTrue(done.wait(WAIT_TIMEOUT))
+
+
+class TestFairShareQueue(unittest.TestCase):
+    """Test FairShareQueue ordering"""
+
+    def drain(self, queue):
+        result = []
+        while len(queue):
+            _, item = queue.get()
+            result.append(item)
+        return result
+
+    def test_round_robin(self):
+        queue = threadutils.FairShareQueue()
+        # vm1 floods the queue before vm2 shows up
+        for i in range(4):
+            queue.put("vm1-{0}".format(i), key="vm1")
+        queue.put("vm2-0", key="vm2")
+        queue.put("vm2-1", key="vm2")
+        self.assertEqual(len(queue), 6)
+        self.assertEqual(self.drain(queue),
+                         ["vm1-0", "vm2-0", "vm1-1", "vm2-1", "vm1-2", "vm1-3"])
+
+    def test_weights(self):
+        queue = threadutils.FairShareQueue()
+        for i in range(3):
+            queue.put("vm1-{0}".format(i), key="vm1", weight=1)
+        for i in range(6):
+            queue.put("vm2-{0}".format(i), key="vm2", weight=2)
+        self.assertEqual(self.drain(queue),
+                         ["vm1-0", "vm2-0", "vm2-1", "vm1-1", "vm2-2", "vm2-3",
+                          "vm1-2", "vm2-4", "vm2-5"])
+
+    def test_stats(self):
+        queue = threadutils.FairShareQueue()
+        queue.put("a", key="uuid1", label="vm1")
+        queue.put("b", key="uuid1", label="vm1")
+        queue.put("c", key="uuid2", label="vm2", weight=3)
+        queue.get()
+        stats = queue.stats()
+        self.assertEqual(stats["active_keys"], 2)
+        self.assertEqual(stats["keys"]["vm1"]["queued"], 1)
+        self.assertEqual(stats["keys"]["vm1"]["served"], 1)
+        self.assertEqual(stats["keys"]["vm2"]["weight"], 3)
+        self.assertEqual(stats["keys"]["vm2"]["queued"], 1)
+
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test SingleFlight call collapsing"""
+
+    def test_collapse(self):
+        flight = threadutils.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def read(value):
+            calls.append(value)
+            started.set()
+            release.wait(WAIT_TIMEOUT)
+            return value
+
+        def request():
+            results.append(flight.do("key", read, "result"))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        self.assertTrue(started.wait(WAIT_TIMEOUT))
+        followers = [threading.Thread(target=request) for _ in range(3)]
+        for t in followers:
+            t.start()
+        # wait for followers to join the in-flight call
+        while flight.stats()["collapsed"] < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + followers:
+            t.join(WAIT_TIMEOUT)
+
+        self.assertEqual(calls, ["result"])
+        self.assertEqual(results, ["result"] * 4)
+        stats = flight.stats()
+        self.assertEqual(stats["requests"], 4)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_sequential_calls_not_collapsed(self):
+        flight = threadutils.SingleFlight()
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+        self.assertEqual(flight.do("key", lambda: 2), 2)
+        self.assertEqual(flight.stats()["collapsed"], 0)
+
+    def test_error(self):
+        flight = threadutils.SingleFlight()
+
+        def fail():
+            raise ValueError("expected failure")
+
+        self.assertRaises(ValueError, flight.do, "key", fail)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
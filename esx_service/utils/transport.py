@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Transports delivering client requests to the vmdkops service, and
+# resolvers mapping the client ID (cartel ID) reported by a transport to a VM.
+#
+# A transport implements:
+#   listen()                      - start listening
+#   get_request(bsize)            - block for the next request, returns (client, cartel, request_bytes),
+#                                   or None if the connection was dropped and should be ignored.
+#                                   Raises TransportError on failures.
+#   reply(client, reply_string)   - send reply (a json string) and close the client connection
+#   close()                       - stop listening
+#   host_agent_required           - True if requests must be declined while hostd is unavailable
+#
+# VmciTransport is what the service uses on ESX. UnixSocketTransport speaks the same
+# wire protocol over a Unix domain socket, with the cartel ID supplied by the client,
+# so request intake, admission control, scheduling and worker dispatch can be driven
+# and profiled without VMs. vmdk_ops.py still imports pyVmomi, and volume commands
+# still need DiskLib and hostd (without them they fail with an error reply), so
+# end-to-end volume operations can only be load tested on ESX. transport_bench.py
+# drives the service over it with many synthetic clients.
+#
+# An identity resolver is a function cartel -> (vm_name, cfg_path, vm_uuid, vc_uuid).
+
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+import sys
+import time
+from ctypes import CDLL, byref, c_char_p, c_int, c_int32, c_uint, create_string_buffer, get_errno
+
+# Wire protocol magic, see vmci/connection_types.h
+MAGIC = 0xbadbeef
+
+# VMCI C code uses '-1' to indicate failures
+VMCI_ERROR = -1
+
+# errno set by VMCI C code on requests from non privileged client ports
+ECONNABORTED = 103
+
+# Python version 3.5.1
+PYTHON64_VERSION = 50659824
+
+# Default path of the Unix socket used by UnixSocketTransport
+DEFAULT_UNIX_SOCKET_PATH = "/tmp/vmdkops.sock"
+
+# Seconds a Unix socket client has to send its whole request
+CLIENT_TIMEOUT = 5
+
+# Unix socket request header: MAGIC, cartel ID, length of the json
+_request_header = struct.Struct("=III")
+
+_header = struct.Struct("=I")
+
+
+class TransportError(Exception):
+    """ Failure to receive a request from a transport """
+    pass
+
+
+class VmciTransport(object):
+    """
+    Requests over vSocket, handled by the VMCI C library (libvmci_srv.so).
+    The cartel ID of the client VM is provided by VMCI.
+    """
+    host_agent_required = True
+
+    def __init__(self, port, lib_dir, lib64_dir):
+        self.port = port
+        self.lib_dir = lib_dir
+        self.lib64_dir = lib64_dir
+        self._lib = None
+        self._socket = None
+        self._cartel = c_int32()
+        self._buf = None
+
+    def listen(self):
+        """Load VMCI shared lib and open/bind/listen on the vSocket"""
+        if self._socket:
+            logging.error("VMCI Listening socket - multiple init") # message for us. Should never  happen
+            return
+
+        logging.info("Loading VMCI server lib.")
+        if sys.hexversion >= PYTHON64_VERSION:
+            self._lib = CDLL(os.path.join(self.lib64_dir, "libvmci_srv.so"), use_errno=True)
+        else:
+            self._lib = CDLL(os.path.join(self.lib_dir, "libvmci_srv.so"), use_errno=True)
+
+        self._socket = self._lib.vmci_init(c_uint(self.port))
+        if self._socket == VMCI_ERROR:
+            errno = get_errno()
+            self._socket = None
+            raise OSError("Failed to initialize vSocket listener: %s (errno=%d)" \
+                            %  (os.strerror(errno), errno))
+
+    def get_request(self, bsize):
+        if not self._buf or len(self._buf) != bsize:
+            self._buf = create_string_buffer(bsize)
+
+        logging.debug("lib.vmci_get_one_op: waiting for new request...")
+        c = self._lib.vmci_get_one_op(self._socket, byref(self._cartel), self._buf, c_int(bsize))
+        logging.debug("lib.vmci_get_one_op returns %d, buffer '%s'", c, self._buf.value)
+
+        errno = get_errno()
+        if errno == ECONNABORTED:
+            logging.warn("Client with non privileged port attempted a request")
+            return None
+        if c == VMCI_ERROR:
+            raise TransportError("vmci_get_one_op failed ret=%d: %s (errno=%d)" %
+                                 (c, os.strerror(errno), errno))
+        return c, self._cartel.value, self._buf.value
+
+    def reply(self, client, reply_string):
+        response = self._lib.vmci_reply(client, c_char_p(reply_string.encode()))
+        errno = get_errno()
+        logging.debug("lib.vmci_reply: VMCI replied with errcode %s", response)
+        if response == VMCI_ERROR:
+            logging.warning("vmci_reply returned error %s (errno=%d)",
+                            os.strerror(errno), errno)
+
+    def close(self):
+        """Release the VMCI listening socket"""
+        if self._socket:
+            self._lib.vmci_close(self._socket)
+            self._socket = None
+
+
+class UnixSocketTransport(object):
+    """
+    Requests over a Unix domain socket, for local testing and profiling.
+    Same framing as VMCI (MAGIC, length, json with trailing '\\0'), except that
+    the client sends its (synthetic) cartel ID right after MAGIC. One request
+    per connection, like VMCI.
+    Requests are read from all connections at once, as data arrives, so a slow or
+    stalled client does not hold up the others. A client which does not send its
+    whole request within 'timeout' seconds is dropped.
+    """
+    host_agent_required = False
+
+    def __init__(self, path=DEFAULT_UNIX_SOCKET_PATH, backlog=128, timeout=CLIENT_TIMEOUT):
+        self.path = path
+        self.backlog = backlog
+        self.timeout = timeout
+        self._socket = None
+        self._poll = None
+        # {fd: [client socket, data received so far, deadline]}
+        self._pending = {}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen(self.backlog)
+        self._poll = select.poll()
+        self._poll.register(self._socket.fileno(), select.POLLIN)
+        logging.info("Listening for requests on Unix socket %s", self.path)
+
+    def get_request(self, bsize):
+        while True:
+            now = time.time()
+            for fd in [fd for fd, pending in self._pending.items() if pending[2] <= now]:
+                self._drop(fd, "timed out after {0} seconds".format(self.timeout))
+
+            try:
+                events = self._poll.poll(self.timeout * 1000)
+            except (OSError, select.error) as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise TransportError("Failed to poll: {0}".format(ex))
+
+            for fd, _ in events:
+                if fd == self._socket.fileno():
+                    self._accept()
+                elif fd in self._pending:
+                    request = self._read(fd, bsize)
+                    if request is not False:
+                        return request
+
+    def _accept(self):
+        try:
+            client, _ = self._socket.accept()
+        except (OSError, socket.error) as ex:
+            raise TransportError("Failed to accept connection: {0}".format(ex))
+        client.setblocking(False)
+        self._pending[client.fileno()] = [client, b'', time.time() + self.timeout]
+        self._poll.register(client.fileno(), select.POLLIN)
+
+    def _read(self, fd, bsize):
+        """
+        Read what the client sent. Return (client, cartel, request) once it is complete,
+        False if more is to come, or None if the request was dropped.
+        """
+        pending = self._pending[fd]
+        try:
+            chunk = pending[0].recv(bsize + _request_header.size)
+        except (OSError, socket.error) as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            self._drop(fd, ex)
+            return None
+        if not chunk:
+            self._drop(fd, "connection closed after {0} bytes".format(len(pending[1])))
+            return None
+        data = pending[1] = pending[1] + chunk
+        if len(data) < _request_header.size:
+            return False
+
+        magic, cartel, size = _request_header.unpack(data[:_request_header.size])
+        if magic != MAGIC:
+            self._drop(fd, "Failed to receive magic: got 0x{0:x} (expected 0x{1:x})".format(magic, MAGIC))
+            return None
+        if size > bsize:
+            self._drop(fd, "Query is too large: {0} (max {1})".format(size, bsize))
+            return None
+        request = data[_request_header.size:]
+        if len(request) < size:
+            return False
+
+        client = pending[0]
+        self._forget(fd)
+        client.setblocking(True)
+        # same sanity check as vmci_server.c - json with a single trailing '\0'
+        if len(request) != size or request.find(b'\0') != size - 1:
+            client.close()
+            logging.warning("Dropped Unix socket request: protocol error, len mismatch")
+            return None
+        return client, cartel, request[:-1]
+
+    def _forget(self, fd):
+        self._poll.unregister(fd)
+        del self._pending[fd]
+
+    def _drop(self, fd, reason):
+        client = self._pending[fd][0]
+        self._forget(fd)
+        client.close()
+        logging.warning("Dropped Unix socket request: %s", reason)
+
+    def reply(self, client, reply_string):
+        data = reply_string.encode() + b'\0'
+        try:
+            client.sendall(_header.pack(MAGIC) + _header.pack(len(data)) + data)
+        except (OSError, socket.error) as ex:
+            logging.warning("Failed to send reply on Unix socket: %s", ex)
+        finally:
+            client.close()
+
+    def close(self):
+        for fd in list(self._pending):
+            self._pending[fd][0].close()
+        self._pending = {}
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def _recv_all(sock, size):
+    """Receive exactly 'size' bytes from sock"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise TransportError("Connection closed after {0} of {1} bytes".format(len(data), size))
+        data += chunk
+    return data
+
+
+def unix_socket_request(path, cartel, request):
+    """
+    Client side of UnixSocketTransport: send request (a json string) as VM with
+    given (synthetic) cartel ID and return the reply json string.
+    """
+    data = request.encode() + b'\0'
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(_request_header.pack(MAGIC, cartel, len(data)) + data)
+        magic, size = struct.unpack("=II", _recv_all(sock, 8))
+        if magic != MAGIC:
+            raise TransportError("Failed to receive magic: got 0x{0:x} (expected 0x{1:x})".format(magic, MAGIC))
+        return _recv_all(sock, size)[:-1].decode('utf-8')
+    finally:
+        sock.close()
+
+
+def synthetic_vm_info(cartel):
+    """
+    Identity resolver for local testing: every cartel ID is a distinct VM,
+    named "vm-<cartel>", with a stable uuid derived from the cartel ID.
+    """
+    vm_uuid = "564d0000-0000-0000-0000-{0:012x}".format(cartel)
+    vm_name = "vm-{0}".format(cartel)
+    cfg_path = "/vmfs/volumes/datastore1/{0}/{0}.vmx".format(vm_name)
+    return vm_name, cfg_path, vm_uuid, None
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Load driver for the vmdkops service over the Unix socket transport.
+# Sends requests as many synthetic clients (VMs, see transport.synthetic_vm_info),
+# from a number of threads, and reports throughput, latency and the replies
+# which were errors (e.g. declined by admission control). With --stalled,
+# that many connections send half a request and stall for the whole run.
+#
+# Not shipped in the VIB. "make test-esx" copies it to ESX along with the tests
+# and the service code. Start the service with --transport=unix[:<socket path>],
+# then run:
+#   python transport_bench.py [--socket PATH] [--clients N] [--threads N]
+#                             [--requests N] [--cmd CMD] [--stalled N]
+
+import argparse
+import collections
+import json
+import socket
+import sys
+import threading
+import time
+
+import transport
+
+# Supported by all versions of the service
+PROTOCOL_VERSION = "2"
+
+
+def run_client(args, next_request, results, lock):
+    """ Thread body - send requests until 'args.requests' were sent by all threads """
+    request = json.dumps({"cmd": args.cmd, "details": {"Name": args.name}, "version": PROTOCOL_VERSION})
+    while True:
+        with lock:
+            n = next_request[0]
+            if n >= args.requests:
+                return
+            next_request[0] += 1
+        # clients take turns, so every synthetic VM sends about the same number of requests
+        cartel = n % args.clients + 1
+        start = time.time()
+        try:
+            reply = json.loads(transport.unix_socket_request(args.socket, cartel, request))
+            error = reply.get(u'Error') if isinstance(reply, dict) else None
+        # socket.error is not an OSError on Python 2.7
+        except (transport.TransportError, OSError, socket.error) as ex:
+            error = "transport: {0}".format(ex)
+        latency = (time.time() - start) * 1000
+        with lock:
+            results.append((latency, error))
+
+
+def stall(path, count):
+    """ Open 'count' connections which send half a request header and stall """
+    stalled = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(b'\xef\xbe')
+        stalled.append(sock)
+    return stalled
+
+
+def report(results, elapsed):
+    latencies = sorted(latency for latency, _ in results)
+    errors = collections.Counter(error for _, error in results if error)
+    print("{0} requests in {1:.1f}s: {2:.1f} requests/sec".format(len(results), elapsed,
+                                                                  len(results) / elapsed))
+    print("latency ms: avg {0:.1f}, p50 {1:.1f}, p99 {2:.1f}, max {3:.1f}".format(
+        sum(latencies) / len(latencies), latencies[len(latencies) // 2],
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], latencies[-1]))
+    print("{0} errors".format(sum(errors.values())))
+    for error, count in errors.most_common(10):
+        print("  {0:>8} {1}".format(count, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the vmdkops service over its Unix socket transport")
+    parser.add_argument("--socket", default=transport.DEFAULT_UNIX_SOCKET_PATH,
+                        help="Unix socket the service listens on")
+    parser.add_argument("--clients", type=int, default=2000, help="number of synthetic VMs")
+    parser.add_argument("--threads", type=int, default=64, help="number of concurrent requests")
+    parser.add_argument("--requests", type=int, default=20000, help="total number of requests")
+    parser.add_argument("--cmd", default="list", help="command to send")
+    parser.add_argument("--name", default="", help="volume name to send with the command")
+    parser.add_argument("--stalled", type=int, default=0,
+                        help="connections which send half a request and stall")
+    args = parser.parse_args()
+
+    print("{0} '{1}' requests from {2} clients, {3} threads, {4} stalled connections".format(
+        args.requests, args.cmd, args.clients, args.threads, args.stalled))
+    stalled = stall(args.socket, args.stalled)
+    results = []
+    next_request = [0]
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_client, args=(args, next_request, results, lock))
+               for _ in range(args.threads)]
+    start = time.time()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        for sock in stalled:
+            sock.close()
+    if not results:
+        return 1
+    report(results, time.time() - start)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for transport.py
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import transport
+
+# Max seconds to wait for the client thread in tests
+WAIT_TIMEOUT = 5
+
+
+class TestUnixSocketTransport(unittest.TestCase):
+    """Test request/reply round trip over UnixSocketTransport"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "vmdkops.sock")
+        self.transport = transport.UnixSocketTransport(self.path)
+        self.transport.listen()
+
+    def tearDown(self):
+        self.transport.close()
+        os.rmdir(self.dir)
+
+    def test_round_trip(self):
+        replies = []
+        request = json.dumps({"cmd": "list", "details": {"Name": ""}})
+
+        def client():
+            replies.append(transport.unix_socket_request(self.path, 42, request))
+
+        t = threading.Thread(target=client)
+        t.start()
+        client_socket, cartel, txt = self.transport.get_request(4096)
+        self.assertEqual(cartel, 42)
+        self.assertEqual(txt.decode('utf-8'), request)
+        self.transport.reply(client_socket, json.dumps({"Error": "test"}))
+        t.join(WAIT_TIMEOUT)
+        self.assertEqual(json.loads(replies[0]), {"Error": "test"})
+
+    def test_request_too_large(self):
+        errors = []
+
+        def client():
+            try:
+                transport.unix_socket_request(self.path, 1, "x" * 100)
+            # socket.error is not an OSError on Python 2.7
+            except (transport.TransportError, OSError, socket.error) as ex:
+                errors.append(ex)
+
+        t = threading.Thread(target=client)
+        t.start()
+        # dropped request, client sees the connection closed
+        self.assertIsNone(self.transport.get_request(10))
+        t.join(WAIT_TIMEOUT)
+        self.assertEqual(len(errors), 1)
+
+    def test_stalled_client(self):
+        replies = []
+        request = json.dumps({"cmd": "list", "details": {"Name": ""}})
+
+        # sends half a header and stalls
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(self.path)
+        stalled.sendall(b'\xef\xbe')
+
+        def client():
+            replies.append(transport.unix_socket_request(self.path, 7, request))
+
+        t = threading.Thread(target=client)
+        t.start()
+        try:
+            # served while the first client is still connected
+            client_socket, cartel, txt = self.transport.get_request(4096)
+            self.assertEqual((cartel, txt.decode('utf-8')), (7, request))
+            self.transport.reply(client_socket, json.dumps(None))
+            t.join(WAIT_TIMEOUT)
+            self.assertEqual(replies, ["null"])
+        finally:
+            stalled.close()
+
+    def test_client_timeout(self):
+        self.transport.timeout = 0.1
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            stalled.connect(self.path)
+            stalled.sendall(b'\xef\xbe')
+
+            def client():
+                transport.unix_socket_request(self.path, 7, "{}")
+
+            # the request after the timeout is served, the stalled client is dropped
+            t = threading.Timer(0.3, client)
+            t.start()
+            client_socket, cartel, _ = self.transport.get_request(4096)
+            self.assertEqual(cartel, 7)
+            self.transport.reply(client_socket, "{}")
+            t.join(WAIT_TIMEOUT)
+            self.assertEqual(stalled.recv(1), b'')
+        finally:
+            stalled.close()
+
+
+class TestSyntheticIdentity(unittest.TestCase):
+    """Test synthetic VM identity resolver"""
+
+    def test_distinct_vms(self):
+        vm1 = transport.synthetic_vm_info(1)
+        vm2 = transport.synthetic_vm_info(2)
+        self.assertEqual(vm1, transport.synthetic_vm_info(1))
+        self.assertNotEqual(vm1[0], vm2[0])
+        self.assertNotEqual(vm1[2], vm2[2])
+        self.assertIsNone(vm1[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
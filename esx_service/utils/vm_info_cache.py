@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cache of VM identity by cartel ID, used by the VMCI listener (see vmdk_ops.py)
+
+import collections
+import time
+
+import threadutils
+
+# Seconds before a cached VM identity is looked up again
+CACHE_TTL = 600
+
+# Max cached VMs, the oldest entry is dropped to add one more
+CACHE_SIZE = 1024
+
+
+class VmInfoCache(object):
+    '''
+    Cache of VM identity by cartel ID of the VM process: cartel -> (vm_name, cfg_path, vm_uuid, vc_uuid).
+    A cartel ID is stable for the life of the VM process, and a restarted VM comes back
+    with a new cartel ID, which is a miss resolved by 'resolver' (VSI on ESX). Entries for a VM
+    are dropped on its power state changes (see vm_listener), and expire after 'ttl' to pick up renames.
+    A cartel ID can be reused by another VM with no power state event seen here, e.g. after
+    a vMotion or an unregister. So if 'identify' is given, every hit calls identify(cartel),
+    a cheap lookup of the process behind the cartel (its VMM leader world on ESX), and
+    an entry cached for another process is dropped and resolved again.
+    '''
+    def __init__(self, resolver, identify=None, ttl=CACHE_TTL, max_size=CACHE_SIZE, clock=time.time):
+        self._resolver = resolver
+        self._identify = identify
+        self._lock = threadutils.get_lock()
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock
+        # cartel -> (expiry time, identity, vm_info), oldest first
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._mismatches = 0
+        self._evictions = 0
+
+    def get(self, cartel):
+        '''Return VM info for cartel, from cache or from the resolver. Throws if lookup fails.'''
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(cartel)
+        identity = None
+        if entry and entry[0] > now:
+            if self._identify is None:
+                with self._lock:
+                    self._hits += 1
+                return entry[2]
+            try:
+                identity = self._identify(cartel)
+            except Exception:
+                # the process is gone, the resolver reports the error
+                identity = None
+            with self._lock:
+                if identity is not None and identity == entry[1]:
+                    self._hits += 1
+                    return entry[2]
+                self._mismatches += 1
+                if self._entries.get(cartel) is entry:
+                    del self._entries[cartel]
+        with self._lock:
+            self._misses += 1
+
+        if self._identify is not None and identity is None:
+            identity = self._identify(cartel)
+        vm_info = self._resolver(cartel)
+        with self._lock:
+            self._entries.pop(cartel, None)
+            if len(self._entries) >= self._max_size:
+                for key in [k for k, e in self._entries.items() if e[0] <= now]:
+                    del self._entries[key]
+            while len(self._entries) >= self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+            self._entries[cartel] = (now + self._ttl, identity, vm_info)
+        return vm_info
+
+    def invalidate_vm(self, vm_uuid):
+        '''Drop cached entries for the VM with given BIOS uuid'''
+        vm_uuid = vm_uuid.lower()
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[2][2].lower() == vm_uuid]:
+                del self._entries[key]
+                self._invalidations += 1
+
+    def stats(self):
+        '''Return a dict with cache statistics'''
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {"size": len(self._entries),
+                    "hits": self._hits,
+                    "misses": self._misses,
+                    "hit_rate": round(float(self._hits) / lookups, 3) if lookups else 0,
+                    "invalidations": self._invalidations,
+                    "mismatches": self._mismatches,
+                    "evictions": self._evictions}
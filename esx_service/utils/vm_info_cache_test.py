@@ -0,0 +1,114 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for vm_info_cache.py
+
+import unittest
+
+import vm_info_cache
+
+VM1_UUID = "564D0B36-0B5C-4F3B-8C44-9A5B8F2C1A01"
+
+
+class TestVmInfoCache(unittest.TestCase):
+    """Test expiry, eviction and invalidation of cached VM identities"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.lookups = []
+        self.cache = vm_info_cache.VmInfoCache(self.resolve, ttl=60, max_size=2,
+                                               clock=lambda: self.now)
+
+    def resolve(self, cartel):
+        self.lookups.append(cartel)
+        if cartel == 1:
+            return ("vm1", "/vmfs/volumes/ds1/vm1/vm1.vmx", VM1_UUID, None)
+        return ("vm{0}".format(cartel), "/vmfs/volumes/ds1/vm.vmx", "uuid-{0}".format(cartel), None)
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get(1)[0], "vm1")
+        self.assertEqual(self.cache.get(1)[0], "vm1")
+        self.assertEqual(self.lookups, [1])
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (1, 1, 0.5))
+
+    def test_ttl(self):
+        self.cache.get(1)
+        self.now += 59
+        self.cache.get(1)
+        self.now += 2
+        self.cache.get(1)
+        self.assertEqual(self.lookups, [1, 1])
+
+    def test_size_bound(self):
+        self.cache.get(1)
+        self.now += 30
+        self.cache.get(2)
+        # cache is full and nothing expired, the oldest entry is dropped
+        self.cache.get(3)
+        stats = self.cache.stats()
+        self.assertEqual((stats["size"], stats["evictions"]), (2, 1))
+        self.cache.get(2)
+        self.cache.get(1)
+        self.assertEqual(self.lookups, [1, 2, 3, 1])
+        self.assertEqual(self.cache.stats()["evictions"], 2)
+        # expired entries are dropped, not counted as evictions
+        self.now += 61
+        self.cache.get(4)
+        stats = self.cache.stats()
+        self.assertEqual((stats["size"], stats["evictions"]), (1, 2))
+
+    def test_cartel_reuse(self):
+        # VMM leader world of each cartel, changes when the cartel is reused
+        leaders = {1: 100}
+        cache = vm_info_cache.VmInfoCache(self.resolve, identify=lambda c: leaders[c],
+                                          clock=lambda: self.now)
+        self.assertEqual(cache.get(1)[2], VM1_UUID)
+        self.assertEqual(cache.get(1)[2], VM1_UUID)
+        self.assertEqual(self.lookups, [1])
+
+        # VM1 is unregistered with no power off seen, another VM gets its cartel
+        leaders[1] = 200
+        self.resolve = lambda cartel: ("vm5", "/vmfs/volumes/ds1/vm5/vm5.vmx", "uuid-5", None)
+        cache._resolver = self.resolve
+        self.assertEqual(cache.get(1)[0], "vm5")
+        self.assertEqual(cache.get(1)[0], "vm5")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["mismatches"]), (2, 2, 1))
+
+        # the process is gone
+        del leaders[1]
+        self.assertRaises(KeyError, cache.get, 1)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_invalidate_vm(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        # power state change of the VM, as reported by vm_listener
+        self.cache.invalidate_vm(VM1_UUID.lower())
+        self.cache.get(1)
+        self.cache.get(2)
+        self.assertEqual(self.lookups, [1, 2, 1])
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_resolver_error(self):
+        def fail(cartel):
+            raise KeyError(cartel)
+        cache = vm_info_cache.VmInfoCache(fail)
+        self.assertRaises(KeyError, cache.get, 1)
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -157,9 +157,7 @@ def listen_vm_propertychange(pc):
                     if objectSet.kind != 'modify':
                         continue
                     for change in objectSet.changeSet:
-                        # if the event was powerOff for a VM, set the status of all
-                        # docker volumes attached to the VM to be detached
-                        if change.name != VM_POWERSTATE or change.val != POWERSTATE_POWEROFF:
+                        if change.name != VM_POWERSTATE:
                             continue
 
                         moref = getattr(objectSet, 'obj', None)
@@ -168,6 +166,16 @@ def listen_vm_propertychange(pc):
                             logging.error("Could not retrieve the VM managed object.")
                             continue
 
+                        # VM process (and so its cartel ID) changes with power state,
+                        # drop the cached VM identity
+                        if vmdk_ops.vmInfoCache:
+                            vmdk_ops.vmInfoCache.invalidate_vm(moref.config.uuid)
+
+                        # if the event was powerOff for a VM, set the status of all
+                        # docker volumes attached to the VM to be detached
+                        if change.val != POWERSTATE_POWEROFF:
+                            continue
+
                         logging.info("VM poweroff change found for %s", moref.config.name)
 
                         set_device_detached(moref)
@@ -15,16 +15,19 @@
 
 # Utility functions for dealing with VMDKs and datastores
 
+import bisect
 import os
 import os.path
 import glob
+import json
 import re
 import logging
 import fnmatch
 import subprocess
+import time
 
 from pyVim import vmconfig
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 import pyVim
 from pyVim.invt import GetVmFolder, FindChild
 from error_code import *
@@ -74,6 +77,25 @@ lockManager = threadutils.LockManager()
 # vmdkops vib name
 VIB_NAME = "esx-vmdkops-service"
 
+# ESXi VIB database. Its mtime changes when VIBs are installed or removed
+VIB_DB_PATH = "/var/db/esximg/vibs"
+
+# Installed version shared between vmdkops processes, as {"vib_db_mtime": ..., "version": ...}
+VERSION_CACHE_FILE = "/var/run/vmdkops/version.json"
+
+# (vib_db_mtime, version) cached in memory by get_version()
+version_cache = None
+
+# Docker volume folders resolved by vmdk_ops.get_vol_path():
+# {(datastore, tenant_name, tenant_uuid): (path, expiration_time)}
+# Entries are dropped on datastore changes, when a folder turns out to be missing
+# and on tenant changes. Tenants are changed by the admin CLI, in another process,
+# so the service drops entries when its auth snapshot is reloaded with changed tenants
+# (see invalidate_vol_paths_on_reload(), registered in vmdk_ops.main()).
+vol_path_cache = {}
+vol_path_cache_lock = threadutils.get_lock()
+VOL_PATH_CACHE_TTL = 300
+
 def init_datastoreCache(force=False):
     """
     Initializes the datastore cache with the list of datastores accessible
@@ -100,9 +122,49 @@ def init_datastoreCache(force=False):
             tmp_ds.append((datastore.info.name,
                            datastore.info.url,
                            dockvols_path))
+        # datastores added, removed or renamed - resolved volume folders may be wrong now
+        if datastores and set(ds[:2] for ds in datastores) != set(ds[:2] for ds in tmp_ds):
+            invalidate_vol_paths()
         datastores = tmp_ds
 
 
+def get_cached_vol_path(datastore, tenant_name, tenant_uuid):
+    """ Return volume folder cached by cache_vol_path(), or None """
+    with vol_path_cache_lock:
+        entry = vol_path_cache.get((datastore, tenant_name, tenant_uuid))
+    if entry and entry[1] > time.time():
+        return entry[0]
+    return None
+
+
+def cache_vol_path(datastore, tenant_name, tenant_uuid, path):
+    """ Cache volume folder for (datastore, tenant), see vmdk_ops.get_vol_path() """
+    with vol_path_cache_lock:
+        vol_path_cache[(datastore, tenant_name, tenant_uuid)] = (path, time.time() + VOL_PATH_CACHE_TTL)
+
+
+def invalidate_vol_paths(datastore=None, tenant_name=None):
+    """
+    Drop cached volume folders for the datastore and/or tenant name,
+    all of them if both are None. Only affects this process, see vol_path_cache.
+    """
+    with vol_path_cache_lock:
+        for key in [k for k in vol_path_cache
+                    if (datastore is None or k[0] == datastore) and
+                    (tenant_name is None or k[1] == tenant_name)]:
+            del vol_path_cache[key]
+
+
+def invalidate_vol_paths_on_reload(old_snapshot, new_snapshot):
+    """
+    Auth snapshot reload listener (see auth_snapshot.add_reload_listener()).
+    Drop cached volume folders if tenants were added, removed or changed.
+    """
+    if old_snapshot is None or old_snapshot.tenants != new_snapshot.tenants:
+        logging.debug("Tenants changed, dropping cached volume folders")
+        invalidate_vol_paths()
+
+
 def validate_datastore(datastore):
     """
     Checks if the datastore is part of datastoreCache.
@@ -134,6 +196,18 @@ def get_datastores():
 def get_volumes(tenant_re):
     """ Return dicts of docker volumes, their datastore and their paths
     """
+    volumes = [volume for _, volume in iter_volumes(tenant_re)]
+    logging.debug("volumes %s", volumes)
+    return volumes
+
+
+def iter_volumes(tenant_re, start_after=None):
+    """ Generate (key, volume) pairs for docker volumes, where volume is a dict with
+    their datastore and their path (see get_volumes()), and key is a tuple
+    (datastore, (tenant dir path components under dockvols), file name).
+    Volumes are generated lazily and in key order, so a caller can stop early
+    and resume later by passing the last key it got as start_after.
+    """
     # Assume we have two tenants "tenant1" and "tenant2"
     # volumes for "tenant1" are in /vmfs/volumes/datastore1/dockervol/tenant1
     # volumes for "tenant2" are in /vmfs/volumes/datastore1/dockervol/tenant2
@@ -142,18 +216,22 @@ def get_volumes(tenant_re):
     # tenant_re = "tenant1" : only return volumes which belongs to tenant1
     # tenant_re = "tenant*" : return volumes which belong to tenant1 or tenant2
     # tenant_re = "*" : return all volumes under /vmfs/volumes/datastore1/dockervol
-    logging.debug("get_volumes: tenant_pattern(%s)", tenant_re)
-    volumes = []
-    for (datastore, url, path) in get_datastores():
-        logging.debug("get_volumes: %s %s %s", datastore, url, path)
+    logging.debug("iter_volumes: tenant_pattern(%s) start_after(%s)", tenant_re, start_after)
+    for (datastore, url, path) in sorted(get_datastores()):
+        logging.debug("iter_volumes: %s %s %s", datastore, url, path)
+        if start_after and datastore < start_after[0]:
+            continue
         if not tenant_re:
-            for file_name in list_vmdks(path):
+            after = start_after[2] if start_after and (datastore, ()) == start_after[:2] else None
+            for file_name in iter_vmdks(path, start_after=after):
                 # path : docker_vol path
-                volumes.append({'path': path,
-                                'filename': file_name,
-                                'datastore': datastore})
+                yield (datastore, (), file_name), {'path': path,
+                                                   'filename': file_name,
+                                                   'datastore': datastore}
         else:
             for root, dirs, files in os.walk(path):
+                # walk directories in a stable order, so keys are generated in order
+                dirs.sort()
                 # walkthough all files under docker_vol path
                 # root is the current directory which is traversing
                 #  root = /vmfs/volumes/datastore1/dockervol/tenant1_uuid
@@ -163,36 +241,43 @@ def get_volumes(tenant_re):
                 #  call get_tenant_name with "tenant1_uuid" to find corresponding
                 #  tenant_name which will be used to match
                 #  pattern specified by tenant_re
-                logging.debug("get_volumes: path=%s root=%s", path, root)
+                logging.debug("iter_volumes: path=%s root=%s", path, root)
                 sub_dir = root.replace(path, "")
                 sub_dir_name = sub_dir[1:]
+                dir_key = (datastore, tuple(sub_dir.split("/")[1:]))
+                if start_after and datastore == start_after[0]:
+                    # seek to the directory of start_after: skip subdirectories whose
+                    # keys are all before it, without listing them
+                    depth = len(dir_key[1]) + 1
+                    dirs[:] = [d for d in dirs if dir_key[1] + (d,) >= start_after[1][:depth]]
+                if start_after and dir_key < start_after[:2]:
+                    continue
+                after = start_after[2] if start_after and dir_key == start_after[:2] else None
                 # sub_dir_name is the tenant uuid
                 error_info, tenant_name = auth_api.get_tenant_name(sub_dir_name)
                 if not error_info:
-                    logging.debug("get_volumes: path=%s root=%s sub_dir_name=%s tenant_name=%s",
+                    logging.debug("iter_volumes: path=%s root=%s sub_dir_name=%s tenant_name=%s",
                                   path, root, sub_dir_name, tenant_name)
                     if fnmatch.fnmatch(tenant_name, tenant_re):
-                        for file_name in list_vmdks(root):
-                            volumes.append({'path': root,
-                                            'filename': file_name,
-                                            'datastore': datastore,
-                                            'tenant': tenant_name})
+                        for file_name in iter_vmdks(root, start_after=after, names=files):
+                            yield dir_key + (file_name,), {'path': root,
+                                                           'filename': file_name,
+                                                           'datastore': datastore,
+                                                           'tenant': tenant_name}
                 else:
                     # cannot find this tenant, this tenant was removed
                     # mark those volumes created by "orphan" tenant
-                    logging.debug("get_volumes: cannot find tenant_name for tenant_uuid=%s", sub_dir_name)
-                    logging.debug("get_volumes: path=%s root=%s sub_dir_name=%s",
+                    logging.debug("iter_volumes: cannot find tenant_name for tenant_uuid=%s", sub_dir_name)
+                    logging.debug("iter_volumes: path=%s root=%s sub_dir_name=%s",
                                 path, root, sub_dir_name)
 
                     # return orphan volumes only in case when volumes from any tenants are asked
                     if tenant_re == "*":
-                        for file_name in list_vmdks(root):
-                            volumes.append({'path': root,
-                                            'filename': file_name,
-                                            'datastore': datastore,
-                                            'tenant' : auth_data_const.ORPHAN_TENANT})
-    logging.debug("volumes %s", volumes)
-    return volumes
+                        for file_name in iter_vmdks(root, start_after=after, names=files):
+                            yield dir_key + (file_name,), {'path': root,
+                                                           'filename': file_name,
+                                                           'datastore': datastore,
+                                                           'tenant' : auth_data_const.ORPHAN_TENANT}
 
 
 def get_vmdk_path(path, vol_name):
@@ -271,6 +356,29 @@ def list_vmdks(path, volname="", show_snapshots=False):
     return vmdks
 
 
+def iter_vmdks(path, start_after=None, names=None):
+    """ Generate names of VMDKs in a given path in file name order, filtering out
+    non-descriptor files and delta disks like list_vmdks(). Files are checked lazily.
+
+    Params:
+    path -  where the VMDKs are looked for
+    start_after - if passed, only files with names after it are returned
+    names - content of path, if the caller already has it
+    """
+    if names is None:
+        # dockvols may not exists on a datastore - this is normal.
+        if not os.path.exists(path):
+            return
+        names = os.listdir(path)
+
+    expr = re.compile(SNAP_VMDK_REGEXP)
+    names = sorted(names)
+    start = bisect.bisect_right(names, start_after) if start_after is not None else 0
+    for file_name in names[start:]:
+        if vmdk_is_a_descriptor(path, file_name) and not expr.match(file_name):
+            yield file_name
+
+
 def vmdk_is_a_descriptor(path, file_name):
     """
     Is the file a vmdk descriptor file?  We assume any file that ends in .vmdk,
@@ -323,6 +431,42 @@ def get_vm_name_by_uuid(vm_uuid):
         return None
 
 
+def get_host_vms():
+    """
+    Returns {vm_uuid: (vm_name, devices)} for all VMs registered on the host, or None on errors.
+    All VMs are retrieved with one property collector call, which is much faster than
+    looking VMs up one by one when a long VM list needs to be checked.
+    """
+    si = vmdk_ops.get_si()
+    try:
+        view = si.content.viewManager.CreateContainerView(si.content.rootFolder,
+                                                          [vim.VirtualMachine], True)
+    except Exception as e:
+        logging.error("Failed to create VM view: %s", e)
+        return None
+
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name="traverseView", path="view",
+                                                                     skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                                   pathSet=["name", "config.uuid",
+                                                                            "config.hardware.device"])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+        host_vms = {}
+        for obj in si.content.propertyCollector.RetrieveContents([filter_spec]):
+            props = dict((p.name, p.val) for p in obj.propSet)
+            # VMs which are being registered/unregistered may have no config
+            if "config.uuid" in props:
+                host_vms[props["config.uuid"]] = (props.get("name"), props.get("config.hardware.device", []))
+        return host_vms
+    except Exception as e:
+        logging.error("Failed to retrieve VMs: %s", e)
+        return None
+    finally:
+        view.Destroy()
+
+
 def get_vm_config_path(vm_name):
     """Returns vm_uuid for given vm_name, or None """
     si = vmdk_ops.get_si()
@@ -411,17 +555,23 @@ def find_dvs_volume(dev):
 
     return None
 
-def check_volumes_mounted(vm_list):
+def check_volumes_mounted(vm_list, host_vms=None):
     """
     Return error_info if any vm in @param vm_list have docker volume mounted
+    If @param host_vms (as returned by get_host_vms()) is passed, VMs are looked up in it
+    instead of querying hostd for each VM
     """
     for vm_id, _ in vm_list:
-        vm = vmdk_ops.findVmByUuid(vm_id)
-        if vm:
-            for d in vm.config.hardware.device:
+        if host_vms is not None:
+            vm_name, devices = host_vms.get(vm_id, (None, None))
+        else:
+            vm = vmdk_ops.findVmByUuid(vm_id)
+            vm_name, devices = (vm.config.name, vm.config.hardware.device) if vm else (None, None)
+        if devices is not None:
+            for d in devices:
                 if find_dvs_volume(d):
                     error_info = generate_error_info(ErrorCode.VM_WITH_MOUNTED_VOLUMES,
-                                                     vm.config.name)
+                                                     vm_name)
                     return error_info
         else:
             error_info = generate_error_info(ErrorCode.VM_NOT_FOUND, vm_id)
@@ -501,7 +651,63 @@ def get_datastore_url_from_config_path(config_path):
     return config_ds_url
 
 def get_version():
-    """ Return the version of the installed VIB """
+    """
+    Return the version of the installed VIB.
+    localcli is slow, so the version is cached (in memory and in VERSION_CACHE_FILE)
+    and only looked up again when the VIB database changes.
+    """
+    global version_cache
+    try:
+        vib_db_mtime = os.stat(VIB_DB_PATH).st_mtime
+    except OSError:
+        # can't tell if the cached value is current
+        return get_version_from_localcli()
+
+    cached = version_cache
+    if cached and cached[0] == vib_db_mtime:
+        return cached[1]
+
+    try:
+        with open(VERSION_CACHE_FILE) as f:
+            data = json.load(f)
+        if data["vib_db_mtime"] == vib_db_mtime:
+            version_cache = (vib_db_mtime, data["version"])
+            return data["version"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    version = get_version_from_localcli()
+    if version != 'N/A':
+        version_cache = (vib_db_mtime, version)
+        try:
+            dir_name = os.path.dirname(VERSION_CACHE_FILE)
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            tmp_path = "{0}.{1}".format(VERSION_CACHE_FILE, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump({"vib_db_mtime": vib_db_mtime, "version": version}, f)
+            os.rename(tmp_path, VERSION_CACHE_FILE)
+        except (IOError, OSError) as ex:
+            logging.debug("Failed to save version to %s: %s", VERSION_CACHE_FILE, ex)
+    return version
+
+def get_cached_version():
+    """
+    Return the installed VIB version if get_version() has it cached and the VIB
+    database did not change since, otherwise None.
+    Never runs localcli, so it is safe to call from the VMCI listener thread.
+    """
+    cached = version_cache
+    if not cached:
+        return None
+    try:
+        vib_db_mtime = os.stat(VIB_DB_PATH).st_mtime
+    except OSError:
+        return None
+    return cached[1] if cached[0] == vib_db_mtime else None
+
+def get_version_from_localcli():
+    """ Return the version of the installed VIB, as reported by localcli """
     try:
         cmd = 'localcli software vib list | grep ' + VIB_NAME
         version_str = subprocess.check_output(cmd, shell=True).split()[1]
@@ -32,6 +32,7 @@ Commands ("cmd" in request):
 '''
 
 import atexit
+import base64
 import getopt
 import json
 import logging
@@ -43,9 +44,6 @@ import subprocess
 import sys
 import traceback
 import time
-from ctypes import *
-
-from vmware import vsi
 
 import pyVim
 from pyVim.connect import Connect, Disconnect
@@ -86,6 +84,7 @@ import vmdk_utils
 import vsan_policy
 import vsan_info
 import auth
+import auth_snapshot
 import sqlite3
 import convert
 import auth_data_const
@@ -95,9 +94,10 @@ from error_code import ErrorCode
 from error_code import error_code_to_message
 import vm_listener
 import counter
-
-# Python version 3.5.1
-PYTHON64_VERSION = 50659824
+import service_stats
+import transport
+import latency
+import vm_info_cache
 
 # External tools used by the plugin.
 OBJ_TOOL_CMD = "/usr/lib/vmware/osfs/bin/objtool open -u "
@@ -111,16 +111,22 @@ VMDK_ADAPTER_TYPE = 'busLogic'  # default adapter type
 
 # Server side understand protocol version. If you are changing client/server protocol we use
 # over VMCI, PLEASE DO NOT FORGET TO CHANGE IT FOR CLIENT in file <esx_vmdkcmd.go> !
-SERVER_PROTOCOL_VERSION = 2
+# Version 3 adds the "batch" command, version 2 clients are still served.
+SERVER_PROTOCOL_VERSION = 3
+SUPPORTED_PROTOCOL_VERSIONS = (2, 3)
+BATCH_PROTOCOL_VERSION = 3  # first version supporting "batch" command
 
-# Error codes
-VMCI_ERROR = -1 # VMCI C code uses '-1' to indicate failures
-ECONNABORTED = 103 # Error on non privileged client
+# Options for paginated "list" request, and the max page size
+LIST_PAGE_SIZE = 'page-size'
+LIST_PAGE_TOKEN = 'page-token'
+MAX_LIST_PAGE_SIZE = 1000
 
 # Volume data returned on Get request
 CAPACITY = 'capacity'
 SIZE = 'size'
 ALLOCATED = 'allocated'
+# Seconds since allocated size was read, at most --size-staleness
+ALLOCATED_AGE = 'allocatedAge'
 LOCATION = 'datastore'
 CREATED_BY_VM = 'created by VM'
 ATTACHED_TO_VM = 'attached to VM'
@@ -134,8 +140,8 @@ PVSCSI_MAX_TARGETS = 16
 # Service instance provide from connection to local hostd
 _service_instance = None
 
-# VMCI library used to communicate with clients
-lib = None
+# Transport used to communicate with clients (see transport.py). Created in main()
+requestTransport = None
 
 # For managing resource locks.
 lockManager = threadutils.LockManager()
@@ -149,6 +155,59 @@ opsCounter = counter.OpsCounter()
 # Timeout setting for waiting all in-flight ops drained
 WAIT_OPS_TIMEOUT = 20
 
+# Worker pool executing VMCI requests. Created in main()
+requestPool = None
+
+# Defaults for the request worker pool (override with -w and -q)
+REQUEST_WORKERS = 32        # number of worker threads
+MAX_QUEUED_REQUESTS = 256   # requests waiting for a worker before we reply "busy"
+BUSY_RETRY_AFTER = 1        # seconds the client is advised to wait before retrying
+
+# Admission control for in-flight (queued or executing) requests. Created in main()
+admissionControl = None
+MAX_INFLIGHT_REQUESTS = 128 # all VMs (override with --max-inflight, 0 is unlimited)
+MAX_INFLIGHT_PER_VM = 16    # single VM (override with --max-inflight-vm, 0 is unlimited)
+# Limits per command class (override with --max-inflight-class=heavy:8,attach:16,read:64)
+MAX_INFLIGHT_BY_CLASS = {"heavy": 8, "attach": 16, "read": 64}
+# Command class by command: expensive create/clone/remove are limited separately
+# from attach/detach and from cheap get/list. Unknown commands are "other" (no class limit).
+COMMAND_CLASSES = {"create": "heavy",
+                   "remove": "heavy",
+                   "attach": "attach",
+                   "detach": "attach",
+                   "batch": "attach",
+                   "get": "read",
+                   "list": "read"}
+DEFAULT_COMMAND_CLASS = "other"
+
+# Request scheduling weight per VM uuid, from the VM's vmgroup: {vm_uuid: (weight, expiration_time)}
+# Only accessed from the VMCI listener thread
+vmWeights = {}
+VM_WEIGHT_REFRESH_SEC = 60  # how long a VM weight is used before it is re-read from the auth DB
+VM_WEIGHT_CACHE_SIZE = 1024 # max cached weights before expired entries are dropped
+
+# VM identity (name, uuids) by cartel ID. Created in main()
+vmInfoCache = None
+VM_INFO_CACHE_TTL = 600     # seconds before a cached VM identity is looked up in VSI again
+VM_INFO_CACHE_SIZE = 1024   # max cached VMs, the oldest is dropped to add one more
+
+# Max age (seconds) of allocated size of a volume returned by get/list, refreshed in
+# the background (override with --size-staleness)
+SIZE_STALENESS = 300
+
+# Read-only commands for which identical concurrent requests share one execution
+# and its result, keyed by (tenant, datastore, volume, cmd)
+readFlights = {"get": threadutils.SingleFlight(),
+               "list": threadutils.SingleFlight()}
+
+# pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
+# to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
+UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
+
+# SCSI Controller keys are in the range of 1000 to 1003 (1000 + bus_number).
+SCSI_CONTROLLER_KEY_OFFSET = 1000
+MAX_SCSI_CONTROLLERS = 4
+
 # PCI bus and function number bits and mask, used on the slot number.
 PCI_BUS_BITS = 5
 PCI_BUS_MASK = 31
@@ -183,7 +242,8 @@ def RunCommand(cmd):
 # opts is  dictionary of {option: value}.
 # for now we care about size and (maybe) policy
 def createVMDK(vmdk_path, vm_name, vol_name,
-               opts={}, vm_uuid=None, tenant_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None):
+               opts={}, vm_uuid=None, tenant_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None,
+               auth_plan=None):
     logging.info("*** createVMDK: %s opts=%s vm_name=%s vm_uuid=%s tenant_uuid=%s datastore_url=%s",
                  vmdk_path, opts, vm_name, vm_uuid, tenant_uuid, datastore_url)
 
@@ -205,7 +265,8 @@ def createVMDK(vmdk_path, vm_name, vol_name,
                          vm_uuid=vm_uuid,
                          datastore_url=datastore_url,
                          vm_datastore_url=vm_datastore_url,
-                         vm_datastore=vm_datastore)
+                         vm_datastore=vm_datastore,
+                         auth_plan=auth_plan)
 
     if not kv.DISK_ALLOCATION_FORMAT in opts:
         disk_format = kv.DEFAULT_ALLOCATION_FORMAT
@@ -269,14 +330,18 @@ def createVMDK(vmdk_path, vm_name, vol_name,
         logging.debug(error_code_to_message[ErrorCode.VM_NOT_BELONG_TO_TENANT].format(vm_name))
 
 
-def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None):
+def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None,
+              auth_plan=None):
     logging.info("*** cloneVMDK: %s opts = %s vm_uuid=%s datastore_url=%s vm_datastore_url=%s vm_datastore=%s",
                  vmdk_path, opts, vm_uuid, datastore_url, vm_datastore_url, vm_datastore)
 
     # Get source volume path for cloning
-    error_info, tenant_uuid, tenant_name = auth.get_tenant(vm_uuid)
-    if error_info:
-        return err(error_info)
+    if auth_plan:
+        tenant_uuid, tenant_name = auth_plan.tenant_uuid, auth_plan.tenant_name
+    else:
+        error_info, tenant_uuid, tenant_name = auth.get_tenant(vm_uuid)
+        if error_info:
+            return err(error_info)
 
     try:
         src_volume, src_datastore = parse_vol_name(opts[kv.CLONE_FROM])
@@ -300,7 +365,8 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
                                  opts={},
                                  use_default_ds=False,
                                  vm_datastore_url=vm_datastore_url,
-                                 vm_datastore=vm_datastore)
+                                 vm_datastore=vm_datastore,
+                                 auth_plan=auth_plan)
     if error_info:
         errmsg = "Failed to authorize VM: {0}, datastore: {1}".format(error_info, src_datastore)
         logging.warning("*** cloneVMDK: %s", errmsg)
@@ -319,7 +385,8 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
     dest_vol = vmdk_utils.get_datastore_path(vmdk_path)
     source_vol = vmdk_utils.get_datastore_path(src_vmdk_path)
     lockname = "{}.{}.{}".format(src_datastore, tenant_name, src_volume)
-    with lockManager.get_lock(lockname):
+    # Cloning only reads the source volume, other readers of it can proceed
+    with lockManager.get_rwlock(lockname).read():
         # Verify if the source volume is in use.
         attached, uuid, attach_as, attached_vm_name = getStatusAttached(src_vmdk_path)
         if attached:
@@ -337,7 +404,8 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
                                      opts=opts,
                                      use_default_ds=False,
                                      vm_datastore_url=vm_datastore_url,
-                                     vm_datastore=vm_datastore)
+                                     vm_datastore=vm_datastore,
+                                     auth_plan=auth_plan)
         if error_info:
             return err(error_info)
 
@@ -390,17 +458,17 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
             return set_err
 
     # Update volume meta
-    vol_meta = kv.getAll(vmdk_path)
-    vol_meta[kv.CREATED_BY] = vm_name
-    vol_meta[kv.CREATED] = time.asctime(time.gmtime())
-    vol_meta[kv.VOL_OPTS][kv.CLONE_FROM] = src_volume
-    vol_meta[kv.VOL_OPTS][kv.DISK_ALLOCATION_FORMAT] = opts[kv.DISK_ALLOCATION_FORMAT]
-    if kv.ACCESS in opts:
-        vol_meta[kv.VOL_OPTS][kv.ACCESS] = opts[kv.ACCESS]
-    if kv.ATTACH_AS in opts:
-        vol_meta[kv.VOL_OPTS][kv.ATTACH_AS] = opts[kv.ATTACH_AS]
-
-    if not kv.setAll(vmdk_path, vol_meta):
+    def update_clone_meta(vol_meta):
+        vol_meta[kv.CREATED_BY] = vm_name
+        vol_meta[kv.CREATED] = time.asctime(time.gmtime())
+        vol_meta[kv.VOL_OPTS][kv.CLONE_FROM] = src_volume
+        vol_meta[kv.VOL_OPTS][kv.DISK_ALLOCATION_FORMAT] = opts[kv.DISK_ALLOCATION_FORMAT]
+        if kv.ACCESS in opts:
+            vol_meta[kv.VOL_OPTS][kv.ACCESS] = opts[kv.ACCESS]
+        if kv.ATTACH_AS in opts:
+            vol_meta[kv.VOL_OPTS][kv.ATTACH_AS] = opts[kv.ATTACH_AS]
+
+    if not kv.update(vmdk_path, update_clone_meta):
         msg = "Failed to create metadata kv store for {0}".format(vmdk_path)
         logging.warning(msg)
         removeVMDK(vmdk_path)
@@ -564,6 +632,8 @@ def vol_info(vol_meta, vol_size_info, datastore):
     vinfo[CAPACITY] = {}
     vinfo[CAPACITY][SIZE] = vol_size_info[SIZE]
     vinfo[CAPACITY][ALLOCATED] = vol_size_info[ALLOCATED]
+    if ALLOCATED_AGE in vol_size_info:
+        vinfo[CAPACITY][ALLOCATED_AGE] = vol_size_info[ALLOCATED_AGE]
     vinfo[LOCATION] = datastore
 
     if kv.ATTACHED_VM_UUID in vol_meta:
@@ -696,6 +766,15 @@ def getVMDK(vmdk_path, vol_name, datastore):
 
     return result
 
+def getVMDKLocked(lockname, vmdk_path, vol_name, datastore):
+    """getVMDK() under the volume lock, held shared with other readers"""
+    logging.debug("Trying to acquire shared lock: %s", lockname)
+    with lockManager.get_rwlock(lockname).read():
+        logging.debug("Acquired lock: %s", lockname)
+        response = getVMDK(vmdk_path, vol_name, datastore)
+    logging.debug("Released lock: %s", lockname)
+    return response
+
 def listVMDK(tenant):
     """
     Returns a list of volume names (note: may be an empty list).
@@ -703,13 +782,72 @@ def listVMDK(tenant):
     for volumes on vm_datastore
     """
     vmdk_utils.init_datastoreCache(force=True)
-    vmdks = vmdk_utils.get_volumes(tenant)
     # build  fully qualified vol name for each volume found
     return [{u'Name': get_full_vol_name(x['filename'], x['datastore']),
              u'Attributes': {}} \
-            for x in vmdks]
+            for _, x in vmdk_utils.iter_volumes(tenant)]
+
+
+
+def encode_list_token(key):
+    """Return an opaque continuation token for a volume key from vmdk_utils.iter_volumes()"""
+    datastore, sub_dir, file_name = key
+    data = json.dumps([datastore, list(sub_dir), file_name])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('utf-8')
+
+def decode_list_token(token):
+    """Return volume key encoded in a continuation token. Raises ValidationError on bad token"""
+    try:
+        datastore, sub_dir, file_name = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')).decode('utf-8'))
+        key = (datastore, tuple(sub_dir), file_name)
+    except (ValueError, TypeError, UnicodeError, AttributeError):
+        key = None
+    # a tampered token may decode to other JSON of the right length
+    if not key or not isinstance(sub_dir, list) or \
+       not all(isinstance(s, type(u'')) for s in (datastore, file_name) + key[1]):
+        raise ValidationError("Invalid {0} '{1}'".format(LIST_PAGE_TOKEN, token))
+    return key
+
+def listVMDKPage(tenant, opts):
+    """
+    Returns one page of listVMDK() results as {"Volumes": [...], "NextPageToken": token}.
+    Page size and position are passed in opts as LIST_PAGE_SIZE and LIST_PAGE_TOKEN,
+    where the token is NextPageToken from the previous page. The last page has no token.
+    Volumes are scanned lazily, so only the part of the inventory up to the end of the page is read,
+    and a page starting at a token goes straight to the token's tenant directory.
+    The Docker plugin does not send page options yet, so it still gets all volumes in one reply.
+    """
+    try:
+        page_size = int(opts.get(LIST_PAGE_SIZE, MAX_LIST_PAGE_SIZE))
+        if page_size <= 0 or page_size > MAX_LIST_PAGE_SIZE:
+            raise ValueError()
+    except (TypeError, ValueError):
+        return err("Invalid {0} '{1}', must be from 1 to {2}".format(LIST_PAGE_SIZE,
+                                                                      opts.get(LIST_PAGE_SIZE),
+                                                                      MAX_LIST_PAGE_SIZE))
+    start_after = None
+    token = opts.get(LIST_PAGE_TOKEN)
+    if token:
+        try:
+            start_after = decode_list_token(token)
+        except ValidationError as ex:
+            return err(str(ex))
+    else:
+        # refresh datastores once per listing, on the first page
+        vmdk_utils.init_datastoreCache(force=True)
 
+    volumes = []
+    next_token = None
+    last_key = None
+    for key, vol in vmdk_utils.iter_volumes(tenant, start_after):
+        if len(volumes) == page_size:
+            next_token = encode_list_token(last_key)
+            break
+        volumes.append({u'Name': get_full_vol_name(vol['filename'], vol['datastore']),
+                        u'Attributes': {}})
+        last_key = key
 
+    return {u'Volumes': volumes, u'NextPageToken': next_token}
 
 def findVmByUuid(vm_uuid, is_vc_uuid=False):
     """
@@ -775,12 +913,35 @@ def apply_action_VMDK(action, vmdk_path, vm_name, bios_uuid, vc_uuid):
     return action(vmdk_path, vm)
 
 
-def get_vol_path(datastore, tenant_name=None, create=True):
+def get_vol_path(datastore, tenant_name=None, create=True, tenant_uuid=None):
     """
     Check existence (and create if needed) the path for docker volume VMDKs
     Returns either path to tenant-specific folder (if tenant name is passed)
     or path to dockvol.
+    Existing folders are cached per (datastore, tenant), see vmdk_utils.get_cached_vol_path().
+    Passing tenant_uuid (when known) saves a tenant lookup in the auth DB, and makes
+    sure a tenant removed and re-created under the same name does not hit the cache.
     """
+    path = vmdk_utils.get_cached_vol_path(datastore, tenant_name, tenant_uuid)
+    if path:
+        return path, None
+
+    path, errMsg = resolve_vol_path(datastore, tenant_name, create, tenant_uuid)
+    if path and os.path.isdir(path):
+        vmdk_utils.cache_vol_path(datastore, tenant_name, tenant_uuid, path)
+    return path, errMsg
+
+def check_vol_path(response, path, datastore, tenant_name):
+    """
+    After a failed request, drop the cached folder for (datastore, tenant) if it
+    is missing, so the next get_vol_path() resolves (and creates) it again.
+    """
+    if response and u'Error' in response and not os.path.isdir(path):
+        logging.warning("Volume folder %s is missing, dropping it from cache", path)
+        vmdk_utils.invalidate_vol_paths(datastore, tenant_name)
+
+def resolve_vol_path(datastore, tenant_name, create, tenant_uuid):
+    """ get_vol_path() without the cache """
     # If tenant_name is set to None, the folder for Docker
     # volumes is created on <datastore>/DOCK_VOLS_DIR
     # If tenant_name is set, the folder for Dock volume
@@ -795,11 +956,13 @@ def get_vol_path(datastore, tenant_name=None, create=True):
     readable_path = path = dock_vol_path = os.path.join("/vmfs/volumes", datastore, DOCK_VOLS_DIR)
 
     if tenant_name:
-        error_info, tenant = auth_api.get_tenant_from_db(tenant_name)
-        if error_info:
-            logging.error("get_vol_path: failed to find tenant info for tenant %s", tenant_name)
-            path = dock_vol_path
-        path = os.path.join(dock_vol_path, tenant.id)
+        if not tenant_uuid:
+            error_info, tenant = auth_api.get_tenant_from_db(tenant_name)
+            if error_info:
+                logging.error("get_vol_path: failed to find tenant info for tenant %s", tenant_name)
+                path = dock_vol_path
+            tenant_uuid = tenant.id
+        path = os.path.join(dock_vol_path, tenant_uuid)
         readable_path = os.path.join(dock_vol_path, tenant_name)
 
     if os.path.isdir(path):
@@ -931,65 +1094,34 @@ def get_datastore_name(datastore_url):
 
     return datastore_name
 
-def authorize_check(vm_uuid, datastore_url, datastore, cmd, opts, use_default_ds, vm_datastore_url, vm_datastore):
+def authorize_check(vm_uuid, datastore_url, datastore, cmd, opts, use_default_ds, vm_datastore_url, vm_datastore,
+                    auth_plan=None):
     """
         Check command from vm can be executed on the datastore or not
         Return None on success or error_info if the command cannot be executed
+        <auth_plan> is an auth.AuthorizationPlan already loaded for this VM, reused
+        if it covers the datastore (saves the auth DB query)
     """
-    if use_default_ds:
-        # first check whether it has privilege to default_datastore
-        # privilege to default_datastore must always exists
-        error_info, tenant_uuid, tenant_name = auth.authorize(vm_uuid=vm_uuid,
-                                                              datastore_url=datastore_url,
-                                                              cmd=cmd,
-                                                              opts=opts,
-                                                              privilege_ds_url=datastore_url,
-                                                              vm_datastore_url=vm_datastore_url)
+    if not auth_plan or not auth_plan.covers(datastore_url):
+        error_info, auth_plan = auth.get_authorization_plan(vm_uuid=vm_uuid,
+                                                            datastore_url=datastore_url,
+                                                            vm_datastore_url=vm_datastore_url)
         if error_info:
             return error_info
-    else:
-        # user passed in volume with format vol@datastore
-        # check the privilege to that datastore
-        error_info, tenant_uuid, tenant_name = auth.authorize(vm_uuid=vm_uuid,
-                                                              datastore_url=datastore_url,
-                                                              cmd=cmd,
-                                                              opts=opts,
-                                                              privilege_ds_url=datastore_url,
-                                                              vm_datastore_url=vm_datastore_url)
-        # no privilege exists for the given datastore
-        # if the given datastore is the same as vm_datastore
-        # then we can check privilege against "_VM_DS"
-        # if no privilege exists for "_VM_DS" or given datastore is not the same
-        # as vm_datastore, need check against "_ALL_DS"
-        if error_info == error_code_to_message[ErrorCode.PRIVILEGE_NO_PRIVILEGE]:
-            if datastore == vm_datastore:
-                error_info, tenant_uuid, tenant_name = auth.authorize(vm_uuid=vm_uuid,
-                                                                      datastore_url=datastore_url,
-                                                                      cmd=cmd,
-                                                                      opts=opts,
-                                                                      privilege_ds_url=auth_data_const.VM_DS_URL,
-                                                                      vm_datastore_url=vm_datastore_url)
-                # privilege to "_VM_DS" exists, but authorize fails, return error_info
-                if error_info != error_code_to_message[ErrorCode.PRIVILEGE_NO_PRIVILEGE]:
-                    return error_info
-
-            # privilege to "_VM_DS" does not exists or the given datastore is not the same as
-            # vm_datastore, check privilege against "_ALL_DS"
-            error_info, tenant_uuid, tenant_name =auth.authorize(vm_uuid=vm_uuid,
-                                                                 datastore_url=datastore_url,
-                                                                 cmd=cmd,
-                                                                 opts=opts,
-                                                                 privilege_ds_url=auth_data_const.ALL_DS_URL,
-                                                                 vm_datastore_url=vm_datastore_url)
 
-        if error_info:
-            return error_info
-
-    return None
+    # privilege to default_datastore must always exists. For volume with format vol@datastore
+    # with no privilege to the datastore, fall back to "_VM_DS" (if it is the VM datastore),
+    # then to "_ALL_DS"
+    return auth_plan.check(cmd=cmd,
+                           opts=opts,
+                           datastore=datastore,
+                           vm_datastore=vm_datastore,
+                           use_default_ds=use_default_ds)
 
 
 # gets the requests, calculates path for volumes, and calls the relevant handler
-def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None):
+def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None,
+                   deferred_attaches=None):
     """
     Executes a <cmd> request issused from a VM.
     The request is about volume <full_volume_name> in format volume@datastore.
@@ -998,6 +1130,8 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     the one where the VM resides is used is "default_datastore" is not specified.
     For VM, the function gets vm_uuid, vm_name and config_path
     <opts> is a json options string blindly passed to a specific operation
+    If <deferred_attaches> list is passed, a validated "attach" is not executed but
+    appended to it as (lockname, vmdk_path), for the caller to attach in one go.
 
     Returns None (if all OK) or error string
     """
@@ -1005,10 +1139,12 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     # get datastore the VM is running on
     vm_datastore_url = vmdk_utils.get_datastore_url_from_config_path(config_path)
     vm_datastore = get_datastore_name(vm_datastore_url)
+    latency.lap("datastore_name")
     logging.debug("executeRequest: vm_datastore = %s, vm_datastore_url = %s",
                   vm_datastore, vm_datastore_url)
 
     error_info, tenant_uuid, tenant_name = auth.get_tenant(vm_uuid)
+    latency.lap("get_tenant")
     force_detach = False
     if error_info:
         # For "docker volume ls", in case of error from the plugin Docker prints a list of cached volume names,
@@ -1048,10 +1184,12 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         # let's just look in the attached device for the best match.
         vm = findVmByUuidChoice(vm_uuid, vc_uuid)
         vmdk_path = vmdk_utils.get_attached_volume_path(vm, vol_name, datastore)
+        latency.lap("vol_path")
 
     else:
         # default_datastore must be set for tenant
         error_info, default_datastore_url = auth_api.get_default_datastore_url(tenant_name)
+        latency.lap("default_datastore")
         if error_info:
             return err(error_info.msg)
         elif not default_datastore_url:
@@ -1061,6 +1199,7 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
 
         # default_datastore could be a real datastore name or a hard coded  one "_VM_DS"
         default_datastore = get_datastore_name(default_datastore_url)
+        latency.lap("datastore_name")
 
         vcuuid = 'None'
         if vc_uuid:
@@ -1071,7 +1210,13 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         if cmd == "list":
             threadutils.set_thread_name("{0}-nolock-{1}".format(vm_name, cmd))
             # if default_datastore is not set, should return error
-            return listVMDK(tenant_name)
+            if LIST_PAGE_SIZE in opts or LIST_PAGE_TOKEN in opts:
+                page = (opts.get(LIST_PAGE_SIZE), opts.get(LIST_PAGE_TOKEN))
+                response = readFlights[cmd].do((tenant_name, None, page, cmd), listVMDKPage, tenant_name, opts)
+            else:
+                response = readFlights[cmd].do((tenant_name, None, None, cmd), listVMDK, tenant_name)
+            latency.lap("execute")
+            return response
 
         try:
             vol_name, datastore = parse_vol_name(full_vol_name)
@@ -1091,19 +1236,26 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         else:
             datastore_url = vmdk_utils.get_datastore_url(datastore)
             use_default_ds = False
+        latency.lap("datastore_name")
 
         logging.debug("executeRequest: vm_uuid=%s, vm_name=%s, tenant_name=%s, tenant_uuid=%s, "
                       "default_datastore_url=%s datastore_url=%s",
                       vm_uuid, vm_name, tenant_uuid, tenant_name, default_datastore_url, datastore_url)
 
-    error_info = authorize_check(vm_uuid=vm_uuid,
-                                 datastore_url=datastore_url,
-                                 datastore=datastore,
-                                 cmd=cmd,
-                                 opts=opts,
-                                 use_default_ds=use_default_ds,
-                                 vm_datastore_url=vm_datastore_url,
-                                 vm_datastore=vm_datastore)
+    error_info, auth_plan = auth.get_authorization_plan(vm_uuid=vm_uuid,
+                                                        datastore_url=datastore_url,
+                                                        vm_datastore_url=vm_datastore_url)
+    if not error_info:
+        error_info = authorize_check(vm_uuid=vm_uuid,
+                                     datastore_url=datastore_url,
+                                     datastore=datastore,
+                                     cmd=cmd,
+                                     opts=opts,
+                                     use_default_ds=use_default_ds,
+                                     vm_datastore_url=vm_datastore_url,
+                                     vm_datastore=vm_datastore,
+                                     auth_plan=auth_plan)
+    latency.lap("authorize")
     if error_info:
         return err(error_info)
 
@@ -1115,12 +1267,13 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         # a real datastore_url instead of url of _VM_DS
         datastore_url = vm_datastore_url
 
-    path, errMsg = get_vol_path(datastore, tenant_name)
+    path, errMsg = get_vol_path(datastore, tenant_name, tenant_uuid=tenant_uuid)
     logging.debug("executeRequest for tenant %s with path %s", tenant_name, path)
     if path is None:
         return errMsg
 
     vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+    latency.lap("vol_path")
 
 
     # Set up locking for volume operations.
@@ -1129,14 +1282,24 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     # Set thread name to vm_name-lockname
     threadutils.set_thread_name("{0}-{1}".format(vm_name, lockname))
 
-    # Get a lock for the volume
+    if cmd == "get":
+        response = readFlights[cmd].do((tenant_name, datastore, vol_name, cmd),
+                                       getVMDKLocked, lockname, vmdk_path, vol_name, datastore)
+        latency.lap("execute")
+        check_vol_path(response, path, datastore, tenant_name)
+        return response
+
+    if cmd == "attach" and deferred_attaches is not None:
+        deferred_attaches.append((lockname, vmdk_path))
+        return None
+
+    # Get an exclusive lock for the volume
     logging.debug("Trying to acquire lock: %s", lockname)
-    with lockManager.get_lock(lockname):
+    with lockManager.get_rwlock(lockname).write():
         logging.debug("Acquired lock: %s", lockname)
+        latency.lap("lock_wait")
 
-        if cmd == "get":
-            response = getVMDK(vmdk_path, vol_name, datastore)
-        elif cmd == "create":
+        if cmd == "create":
             response = createVMDK(vmdk_path=vmdk_path,
                                   vm_name=vm_name,
                                   vm_uuid=vm_uuid,
@@ -1145,7 +1308,9 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
                                   tenant_uuid=tenant_uuid,
                                   datastore_url=datastore_url,
                                   vm_datastore_url=vm_datastore_url,
-                                  vm_datastore=vm_datastore)
+                                  vm_datastore=vm_datastore,
+                                  auth_plan=auth_plan)
+            check_vol_path(response, path, datastore, tenant_name)
         elif cmd == "remove":
             response = removeVMDK(vmdk_path=vmdk_path,
                                   vol_name=vol_name,
@@ -1156,18 +1321,99 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         # For attach/detach reconfigure tasks, hold a per vm lock.
         elif cmd == "attach":
             with lockManager.get_lock(vm_uuid):
+                latency.lap("lock_wait")
                 response = attachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
                                       bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         elif cmd == "detach":
             with lockManager.get_lock(vm_uuid):
+                latency.lap("lock_wait")
                 response = detachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
                                       bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         else:
             return err("Unknown command:" + cmd)
+        latency.lap("execute")
 
     logging.debug("Released lock: %s", lockname)
     return response
 
+def attachVMDKBatch(attaches, vm_name, bios_uuid, vc_uuid):
+    """
+    Attaches volumes deferred by executeRequest() to the VM with a single reconfigure.
+    <attaches> is a list of (lockname, vmdk_path).
+    Returns a list of replies, one per element of <attaches>.
+    """
+    vm = findVmByUuidChoice(bios_uuid, vc_uuid)
+    if not vm:
+        reply = err("Failed to find VM object for %s (bios %s vc %s)" % (vm_name, bios_uuid, vc_uuid))
+        return [reply] * len(attaches)
+    if vm.config.name != vm_name:
+        logging.warning("vm_name from vSocket '%s' does not match VM object '%s' ", vm_name, vm.config.name)
+
+    # Take volume locks in sorted order so concurrent batches cannot deadlock
+    locks = [lockManager.get_rwlock(lockname) for lockname in sorted(set(l for l, _ in attaches))]
+    for lock in locks:
+        lock.acquire_write()
+    try:
+        with lockManager.get_lock(bios_uuid):
+            results = disk_attach_batch([vmdk_path for _, vmdk_path in attaches], vm)
+    finally:
+        for lock in reversed(locks):
+            lock.release_write()
+
+    return [results[vmdk_path] for _, vmdk_path in attaches]
+
+def executeBatch(vm_uuid, vm_name, config_path, commands, vc_uuid=None):
+    """
+    Executes a "batch" request (protocol version 3) issued from a VM.
+    <commands> is a list of {"cmd": ..., "details": {"Name": ..., "Opts": ...}}.
+    Commands are executed in order, each with its own reply. Consecutive attach
+    commands are validated one by one and then attached with a single VM reconfigure.
+    Returns {"Results": [reply for each command]}
+    """
+    results = [None] * len(commands)
+    attaches = []   # [(index in commands, (lockname, vmdk_path))]
+
+    def flush_attaches():
+        if not attaches:
+            return
+        replies = attachVMDKBatch([a for _, a in attaches], vm_name, vm_uuid, vc_uuid)
+        for (index, _), reply in zip(attaches, replies):
+            results[index] = reply
+        del attaches[:]
+
+    for index, command in enumerate(commands):
+        try:
+            cmd = command["cmd"]
+            full_vol_name = command["details"]["Name"]
+            opts = command["details"].get("Opts", {})
+        except (KeyError, TypeError, AttributeError):
+            results[index] = err("Invalid command in batch: '{0}'".format(command))
+            continue
+
+        if cmd in ("version", "batch"):
+            results[index] = err("Command '{0}' is not supported in batch".format(cmd))
+            continue
+
+        if cmd != "attach":
+            flush_attaches()
+
+        deferred = []
+        reply = executeRequest(vm_uuid=vm_uuid,
+                               vc_uuid=vc_uuid,
+                               vm_name=vm_name,
+                               config_path=config_path,
+                               cmd=cmd,
+                               full_vol_name=full_vol_name,
+                               opts=opts,
+                               deferred_attaches=deferred)
+        if deferred:
+            attaches.append((index, deferred[0]))
+        else:
+            results[index] = reply
+
+    flush_attaches()
+    return {u'Results': results}
+
 def connectLocalSi():
     '''
 	Initialize a connection to the local SI
@@ -1304,18 +1550,16 @@ def dev_info(unit_number, pci_bus_slot_number):
 
 def reset_vol_meta(vmdk_path):
     '''Clears metadata for vmdk_path'''
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-       vol_meta = {}
     logging.debug("Reseting meta-data for disk=%s", vmdk_path)
-    if set(vol_meta.keys()) & {kv.STATUS, kv.ATTACHED_VM_UUID}:
-          logging.debug("Old meta-data for %s was (status=%s VM uuid=%s)",
-                        vmdk_path, vol_meta[kv.STATUS],
-                        vol_meta[kv.ATTACHED_VM_UUID])
-    vol_meta[kv.STATUS] = kv.DETACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = None
-    vol_meta[kv.ATTACHED_VM_NAME] = None
-    if not kv.setAll(vmdk_path, vol_meta):
+    def reset(vol_meta):
+        if set(vol_meta.keys()) & {kv.STATUS, kv.ATTACHED_VM_UUID}:
+              logging.debug("Old meta-data for %s was (status=%s VM uuid=%s)",
+                            vmdk_path, vol_meta.get(kv.STATUS),
+                            vol_meta.get(kv.ATTACHED_VM_UUID))
+        vol_meta[kv.STATUS] = kv.DETACHED
+        vol_meta[kv.ATTACHED_VM_UUID] = None
+        vol_meta[kv.ATTACHED_VM_NAME] = None
+    if not kv.update(vmdk_path, reset, default={}):
        msg = "Failed to save volume metadata for {0}.".format(vmdk_path)
        logging.warning("reset_vol_meta: " + msg)
        return err(msg)
@@ -1324,33 +1568,30 @@ def setStatusAttached(vmdk_path, vm, vm_dev_info=None):
     '''Sets metadata for vmdk_path to (attached, attachedToVM=uuid'''
     logging.debug("Set status=attached disk=%s VM name=%s uuid=%s", vmdk_path,
                   vm.config.name, vm.config.uuid)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.ATTACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = vm.config.instanceUuid
-    vol_meta[kv.ATTACHED_VM_NAME] = vm.config.name
-    if vm_dev_info:
-        vol_meta[kv.ATTACHED_VM_DEV] = vm_dev_info
-    if not kv.setAll(vmdk_path, vol_meta):
+    def set_attached(vol_meta):
+        vol_meta[kv.STATUS] = kv.ATTACHED
+        vol_meta[kv.ATTACHED_VM_UUID] = vm.config.instanceUuid
+        vol_meta[kv.ATTACHED_VM_NAME] = vm.config.name
+        if vm_dev_info:
+            vol_meta[kv.ATTACHED_VM_DEV] = vm_dev_info
+    if not kv.update(vmdk_path, set_attached, default={}):
         logging.warning("Attach: Failed to save Disk metadata for %s", vmdk_path)
 
 
 def setStatusDetached(vmdk_path, key=None, value=None):
     '''Sets metadata for vmdk_path to "detached"'''
     logging.debug("Set status=detached disk=%s", vmdk_path)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.DETACHED
-    # If attachedVMName is present, so is attachedVMUuid
-    try:
-        del vol_meta[kv.ATTACHED_VM_UUID]
-        del vol_meta[kv.ATTACHED_VM_NAME]
-        del vol_meta[kv.ATTACHED_VM_DEV]
-    except:
-        pass
-    if not kv.setAll(vmdk_path, vol_meta, key, value):
+    def set_detached(vol_meta):
+        vol_meta[kv.STATUS] = kv.DETACHED
+        # If attachedVMName is present, so is attachedVMUuid
+        try:
+            del vol_meta[kv.ATTACHED_VM_UUID]
+            del vol_meta[kv.ATTACHED_VM_NAME]
+            del vol_meta[kv.ATTACHED_VM_DEV]
+        except:
+            pass
+    expect = {key: value} if key else None
+    if not kv.update(vmdk_path, set_detached, expect=expect, default={}):
         logging.warning("Detach: Failed to save Disk metadata for %s", vmdk_path)
 
 
@@ -1360,7 +1601,8 @@ def getStatusAttached(vmdk_path):
     uuid and vm_name are None.
     '''
 
-    vol_meta = kv.getAll(vmdk_path)
+    # attach status may have been changed by another ESX host, don't trust the cache
+    vol_meta = kv.getAll(vmdk_path, use_cache=False)
     try:
         attach_as = vol_meta[kv.VOL_OPTS][kv.ATTACH_AS]
     except:
@@ -1472,6 +1714,22 @@ def find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number):
                 idx = idx + 1;
     return idx, disk_slot
 
+def disk_add_spec(vmdk_path, attach_mode, controller_key, disk_slot):
+    '''Return device change spec adding the disk at the given controller and slot'''
+    # add disk as independent, so it won't be snapshotted with the Docker VM
+    return vim.VirtualDeviceConfigSpec(
+        operation='add',
+        device=
+        vim.VirtualDisk(backing=vim.VirtualDiskFlatVer2BackingInfo(
+            fileName="[] " + vmdk_path,
+            diskMode=attach_mode, ),
+                        deviceInfo=vim.Description(
+                            # TODO: use docker volume name here. Issue #292
+                            label="dockerDataVolume",
+                            summary="dockerDataVolume", ),
+                        unitNumber=disk_slot,
+                        controllerKey=controller_key, ), )
+
 def disk_attach(vmdk_path, vm):
     '''
     Attaches *existing* disk to a vm on a PVSCI controller
@@ -1491,8 +1749,8 @@ def disk_attach(vmdk_path, vm):
     # 0 to 15 with 7 being reserved (for older SCSI controllers).
     # It is up to the API client to add controllers as needed.
     # SCSI Controller keys are in the range of 1000 to 1003 (1000 + bus_number).
-    offset_from_bus_number = 1000
-    max_scsi_controllers = 4
+    offset_from_bus_number = SCSI_CONTROLLER_KEY_OFFSET
+    max_scsi_controllers = MAX_SCSI_CONTROLLERS
 
 
     devices = vm.config.hardware.device
@@ -1557,21 +1815,8 @@ def disk_attach(vmdk_path, vm):
         logging.info("Added a PVSCSI controller, controller_key=%d pci_slot_number=%s",
                       controller_key, pci_slot_number[0])
 
-    # add disk as independent, so it won't be snapshotted with the Docker VM
-    disk_spec = vim.VirtualDeviceConfigSpec(
-        operation='add',
-        device=
-        vim.VirtualDisk(backing=vim.VirtualDiskFlatVer2BackingInfo(
-            fileName="[] " + vmdk_path,
-            diskMode=attach_mode, ),
-                        deviceInfo=vim.Description(
-                            # TODO: use docker volume name here. Issue #292
-                            label="dockerDataVolume",
-                            summary="dockerDataVolume", ),
-                        unitNumber=disk_slot,
-                        controllerKey=controller_key, ), )
     disk_changes = []
-    disk_changes.append(disk_spec)
+    disk_changes.append(disk_add_spec(vmdk_path, attach_mode, controller_key, disk_slot))
 
     spec = vim.vm.ConfigSpec()
     spec.deviceChange = disk_changes
@@ -1604,9 +1849,114 @@ def disk_attach(vmdk_path, vm):
     return vm_dev_info
 
 
+def allocate_disk_slots(devices, pvsci, count):
+    '''
+    Return a list of up to 'count' free (controller index in pvsci, disk slot) pairs
+    on the given PVSCSI controllers
+    '''
+    slots = []
+    for idx, controller in enumerate(pvsci):
+        taken = set([dev.unitNumber
+                     for dev in devices
+                     if type(dev) == vim.VirtualDisk and dev.controllerKey == controller.key])
+        # unit_number 7 is reserved for scsi controller
+        avail_slots = (set(range(0, 7)) | set(range(8, PVSCSI_MAX_TARGETS))) - taken
+        for disk_slot in sorted(avail_slots):
+            if len(slots) == count:
+                return slots
+            slots.append((idx, disk_slot))
+    return slots
+
+def disk_attach_batch(vmdk_paths, vm):
+    '''
+    Attaches a list of *existing* disks to a vm with a single reconfigure.
+    Returns a dict {vmdk_path: error or unit:bus numbers of attached disk}.
+    If the disks cannot be attached together, falls back to disk_attach() one by one
+    so each disk gets its own result.
+    '''
+    results = {}
+    pending = []
+    for vmdk_path in vmdk_paths:
+        if vmdk_path in results or vmdk_path in pending:
+            continue
+        if findDeviceByPath(vmdk_path, vm):
+            # already attached, disk_attach() will just report where
+            results[vmdk_path] = disk_attach(vmdk_path, vm)
+        else:
+            pending.append(vmdk_path)
+
+    if len(pending) < 2:
+        for vmdk_path in pending:
+            results[vmdk_path] = disk_attach(vmdk_path, vm)
+        return results
+
+    logging.info("Attaching %d disks to VM %s with a single reconfigure", len(pending), vm.config.name)
+    devices = vm.config.hardware.device
+    controllers = [d for d in devices if isinstance(d, vim.VirtualSCSIController)]
+    pvsci = [d for d in controllers if type(d) == vim.ParaVirtualSCSIController]
+    slots = allocate_disk_slots(devices, pvsci, len(pending))
+
+    # add PVSCSI controllers until there is enough room
+    while len(slots) < len(pending) and len(controllers) < MAX_SCSI_CONTROLLERS:
+        logging.info("Adding a PVSCSI controller")
+        _, ret_err = add_pvscsi_controller(vm, controllers, MAX_SCSI_CONTROLLERS,
+                                           SCSI_CONTROLLER_KEY_OFFSET)
+        if ret_err:
+            break
+        devices = vm.config.hardware.device
+        controllers = [d for d in devices if isinstance(d, vim.VirtualSCSIController)]
+        pvsci = [d for d in controllers if type(d) == vim.ParaVirtualSCSIController]
+        slots = allocate_disk_slots(devices, pvsci, len(pending))
+
+    if len(slots) < len(pending):
+        logging.warning("Not enough disk slots to attach %d disks together, attaching one by one",
+                        len(pending))
+        for vmdk_path in pending:
+            results[vmdk_path] = disk_attach(vmdk_path, vm)
+        return results
+
+    disk_changes = []
+    attached = []
+    for vmdk_path, (idx, disk_slot) in zip(pending, slots):
+        kv_status_attached, kv_uuid, attach_mode, attached_vm_name = getStatusAttached(vmdk_path)
+        logging.info("Attaching {0} as {1}".format(vmdk_path, attach_mode))
+        if kv_status_attached:
+            log_attached_volume(vmdk_path, kv_uuid, attached_vm_name)
+        disk_changes.append(disk_add_spec(vmdk_path, attach_mode, pvsci[idx].key, disk_slot))
+        pci_slot_number = get_controller_pci_slot(vm, pvsci[idx], SCSI_CONTROLLER_KEY_OFFSET)
+        attached.append((vmdk_path, dev_info(disk_slot, pci_slot_number)))
+
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = disk_changes
+    try:
+        si = get_si()
+        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+    except vim.fault.VimFault as ex:
+        # reconfigure is all or nothing, find out which disk(s) fail
+        logging.warning("Failed to attach disks together (%s), attaching one by one", ex.msg)
+        for vmdk_path in pending:
+            results[vmdk_path] = disk_attach(vmdk_path, vm)
+        return results
+
+    for vmdk_path, vm_dev_info in attached:
+        setStatusAttached(vmdk_path, vm, vm_dev_info)
+        logging.info("Disk %s successfully attached. %s", vmdk_path, vm_dev_info)
+        results[vmdk_path] = vm_dev_info
+    return results
+
+
 def err(string):
     return {u'Error': string}
 
+def err_retryable(string, retry_after):
+    """
+    Error for requests declined due to load. Clients understanding the
+    extra fields may retry after 'retry_after' seconds, others just see 'Error'.
+    """
+    return {u'Error': string,
+            u'Retryable': True,
+            u'RetryAfter': retry_after}
+
 
 def disk_detach(vmdk_path, vm):
     """detach disk (by full path) from a vm and return None or err(msg)"""
@@ -1727,15 +2077,13 @@ def set_vol_opts(name, tenant_name, options):
     if has_invalid_opt_value:
         return False
 
-    vol_meta = kv.getAll(vmdk_path)
-    if vol_meta:
-       if not vol_meta[kv.VOL_OPTS]:
+    def set_opts(vol_meta):
+       if not vol_meta.get(kv.VOL_OPTS):
            vol_meta[kv.VOL_OPTS] = {}
        for key in opts.keys():
            vol_meta[kv.VOL_OPTS][key] = opts[key]
-       return kv.setAll(vmdk_path, vol_meta)
 
-    return False
+    return kv.update(vmdk_path, set_opts)
 
 def wait_ops_in_flight():
     # Wait for the event indicating all in-flight ops are drained
@@ -1762,49 +2110,141 @@ def signal_handler_stop(signalnum, frame):
     # Fire a thread to wait for ops in flight to drain
     threadutils.start_new_thread(target=wait_ops_in_flight)
 
-def load_vmci():
-    global lib
+def send_vmci_reply(client_socket, reply_string):
+    requestTransport.reply(client_socket, json.dumps(reply_string))
 
-    logging.info("Loading VMCI server lib.")
-    if sys.hexversion >= PYTHON64_VERSION:
-        lib = CDLL(os.path.join(LIB_LOC64, "libvmci_srv.so"), use_errno=True)
-    else:
-        lib = CDLL(os.path.join(LIB_LOC, "libvmci_srv.so"), use_errno=True)
+def get_vm_info_by_cartel(cartel):
+    '''
+    Returns (vm_name, cfg_path, vm_uuid, vc_uuid) for the VM with given cartel ID,
+    using the VM info cache.
+    '''
+    return vmInfoCache.get(cartel)
+
+def get_vmm_leader(cartel):
+    '''
+    Return ID of the VMM leader world of the VM process with given cartel ID.
+    Identifies the process for VM info cache hits, a reused cartel ID has a new leader.
+    '''
+    # only available on ESX
+    from vmware import vsi
 
+    return vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
 
-def send_vmci_reply(client_socket, reply_string):
-    reply = json.dumps(reply_string)
-    response = lib.vmci_reply(client_socket, c_char_p(reply.encode()))
-    errno = get_errno()
-    logging.debug("lib.vmci_reply: VMCI replied with errcode %s", response)
-    if response == VMCI_ERROR:
-        logging.warning("vmci_reply returned error %s (errno=%d)",
-                        os.strerror(errno), errno)
-
-def execRequestThread(client_socket, cartel, request):
+def lookup_vm_info_by_cartel(cartel):
+    '''
+    Get VM name & ID from VSI (we only get cartelID from vmci, need to convert)
+    Returns (vm_name, cfg_path, vm_uuid, vc_uuid). vc_uuid is None if VM has no VC uuid.
     '''
-    Execute requests in a thread context with a per volume locking.
+    # only available on ESX, see transport.synthetic_vm_info for local testing
+    from vmware import vsi
+
+    vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
+    group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
+    vm_name = group_info["displayName"]
+    cfg_path = group_info["cfgPath"]
+    uuid = group_info["uuid"]            # BIOS UUID, see http://www.virtu-al.net/2015/12/04/a-quick-reference-of-vsphere-ids/
+    vcuuid = group_info["vcUuid"]       # VC UUID
+    vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
+    vc_uuid = None
+
+    # Use a VC uuid if one is present.
+    if len(vcuuid) > 0:
+        vc_uuid = UUID_FORMAT.format(*vcuuid.replace("-",  " ").split())
+
+    return vm_name, cfg_path, vm_uuid, vc_uuid
+
+def get_vm_weight(vm_uuid):
+    '''
+    Return request scheduling weight of a VM, which is the weight of its vmgroup.
+    Weights are cached for VM_WEIGHT_REFRESH_SEC to keep the auth DB off the request path.
+    '''
+    now = time.time()
+    cached = vmWeights.get(vm_uuid)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    error_msg, tenant_uuid, _ = auth.get_tenant(vm_uuid)
+    weight = auth_data_const.DEFAULT_TENANT_WEIGHT
+    if not error_msg and tenant_uuid:
+        error_msg, weight = auth.get_tenant_weight(tenant_uuid)
+    if error_msg:
+        logging.debug("Using default weight for VM %s: %s", vm_uuid, error_msg)
+        weight = auth_data_const.DEFAULT_TENANT_WEIGHT
+
+    # VMs come and go, don't keep weights of all VMs ever seen
+    if len(vmWeights) >= VM_WEIGHT_CACHE_SIZE:
+        for key in [k for k, w in vmWeights.items() if w[1] <= now]:
+            del vmWeights[key]
+    vmWeights[vm_uuid] = (weight, now + VM_WEIGHT_REFRESH_SEC)
+    return weight
+
+def check_protocol_version(req):
+    """
+    Check the protocol version of the client request.
+    Returns (client_protocol_version, None) if supported, or (client_protocol_version, error_reply)
+    """
+    # If req from client does not include version number, set the version to
+    # SERVER_PROTOCOL_VERSION by default to make backward compatible
+    client_protocol_version = int(req["version"]) if "version" in req else SERVER_PROTOCOL_VERSION
+    logging.debug("check_protocol_version: client protocol version=%d", client_protocol_version)
+    if client_protocol_version not in SUPPORTED_PROTOCOL_VERSIONS:
+        return client_protocol_version, err("""There is a mismatch between VDVS client (Docker plugin) protocol version
+                                    ({}) and server (ESXi) protocol version ({}) which indicates different
+                                    versions of the product are installed on Guest and ESXi sides,
+                                    please make sure VDVS plugin and driver are from the same release version.
+                                    """.format(client_protocol_version, SERVER_PROTOCOL_VERSION))
+    return client_protocol_version, None
+
+def peek_request(request):
+    """
+    Parse a raw request in the listener thread, to route it before it is queued.
+    Returns the request dict, or None if it cannot be parsed (execRequestThread
+    then reports the problem to the client).
+    """
+    try:
+        req = json.loads(request.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return req if isinstance(req, dict) else None
+
+def handle_version_request(client_socket, req):
+    """
+    Fast path for the "version" command: it needs neither VM info nor a worker thread,
+    so reply to it right from the listener loop, if the version is cached (see main()).
+    Returns True if the request was a "version" request and has been replied to.
+    """
+    if not req or req.get("cmd") != "version":
+        return False
+    try:
+        _, reply_string = check_protocol_version(req)
+    except (ValueError, TypeError):
+        # let execRequestThread report the problem
+        return False
+
+    if not reply_string:
+        version = vmdk_utils.get_cached_version()
+        if version is None:
+            # looking the version up runs localcli, which must not block the listener,
+            # so let a worker do it
+            return False
+        reply_string = {u'version': "%s" % version}
+    logging.debug("handle_version_request completed with ret=%s", reply_string)
+    send_vmci_reply(client_socket, reply_string)
+    return True
+
+def execRequestThread(client_socket, cartel, request, admission=None):
     '''
-    # Before we start, block to allow main thread or other running threads to advance.
-    # https://docs.python.org/2/faq/library.html#none-of-my-threads-seem-to-run-why
-    time.sleep(0.001)
+    Execute requests in a worker thread context with a per volume locking.
+    admission is (key, command class, admission time) of a request admitted
+    by admissionControl, released when the request completes.
+    '''
+    # time spent queued (since admission) is charged to "queue_wait"
+    latency.start(started_at=admission[2] if admission else None)
+    latency.lap("queue_wait")
     try:
-        # Get VM name & ID from VSI (we only get cartelID from vmci, need to convert)
-        vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
-        group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
-        vm_name = group_info["displayName"]
-        cfg_path = group_info["cfgPath"]
-        uuid = group_info["uuid"]            # BIOS UUID, see http://www.virtu-al.net/2015/12/04/a-quick-reference-of-vsphere-ids/
-        vcuuid = group_info["vcUuid"]       # VC UUID
-        # pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
-        # to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
-        UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
-        vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
-        vc_uuid = None
-
-        # Use a VC uuid if one is present.
-        if len(vcuuid) > 0:
-            vc_uuid = UUID_FORMAT.format(*vcuuid.replace("-",  " ").split())
+        vm_name, cfg_path, vm_uuid, vc_uuid = get_vm_info_by_cartel(cartel)
+        latency.current().label = vm_name
+        latency.lap("vm_info")
 
         try:
             req = json.loads(request.decode('utf-8'))
@@ -1813,24 +2253,26 @@ def execRequestThread(client_socket, cartel, request):
             send_vmci_reply(client_socket, reply_string)
         else:
             logging.debug("execRequestThread: req=%s", req)
-            # If req from client does not include version number, set the version to
-            # SERVER_PROTOCOL_VERSION by default to make backward compatible
-            client_protocol_version = int(req["version"]) if "version" in req else SERVER_PROTOCOL_VERSION
-            logging.debug("execRequestThread: client protocol version=%d", client_protocol_version)
-            if client_protocol_version != SERVER_PROTOCOL_VERSION:
-                reply_string = err("""There is a mismatch between VDVS client (Docker plugin) protocol version
-                                    ({}) and server (ESXi) protocol version ({}) which indicates different
-                                    versions of the product are installed on Guest and ESXi sides,
-                                    please make sure VDVS plugin and driver are from the same release version.
-                                    """.format(client_protocol_version, SERVER_PROTOCOL_VERSION))
+            latency.set_command(req.get("cmd"))
+            client_protocol_version, reply_string = check_protocol_version(req)
+            if reply_string:
                 send_vmci_reply(client_socket, reply_string)
                 logging.warning("executeRequest '%s' failed: %s", req["cmd"], reply_string)
                 return
 
-            # If the command is "version" then there is no need to handle the request via
-            # the normal VM request handler.
+            # "version" is normally answered by handleVmciRequests() directly, but keep
+            # handling it here in case the request did not take the fast path.
             if req["cmd"] == "version":
                 reply_string = {u'version': "%s" % vmdk_utils.get_version()}
+            elif req["cmd"] == "batch":
+                if client_protocol_version < BATCH_PROTOCOL_VERSION:
+                    reply_string = err("Command 'batch' requires protocol version {0}".format(BATCH_PROTOCOL_VERSION))
+                else:
+                    reply_string = executeBatch(vm_uuid=vm_uuid,
+                                                vc_uuid=vc_uuid,
+                                                vm_name=vm_name,
+                                                config_path=cfg_path,
+                                                commands=req["details"]["Commands"])
             else:
                 opts = req["details"]["Opts"] if "Opts" in req["details"] else {}
                 reply_string = executeRequest(
@@ -1844,66 +2286,41 @@ def execRequestThread(client_socket, cartel, request):
 
             logging.info("executeRequest '%s' completed with ret=%s", req["cmd"], reply_string)
             send_vmci_reply(client_socket, reply_string)
+            latency.lap("reply")
 
     except Exception as ex_thr:
         logging.exception("Unhandled Exception:")
         reply_string = err("Server returned an error: {0}".format(repr(ex_thr)))
         send_vmci_reply(client_socket, reply_string)
     finally:
+        latency.finish()
+        if admission:
+            key, cmd_class, admitted_at = admission
+            admissionControl.release(key, cmd_class, time.time() - admitted_at)
         opsCounter.decr()
 
-# code to grab/release VMCI listening socket
-g_vmci_listening_socket = None
-
-def vmci_grab_listening_socket(port):
-    """call C code to open/bind/listen on the VMCI socket"""
-    global g_vmci_listening_socket
-    if  g_vmci_listening_socket:
-        logging.error("VMCI Listening socket - multiple init") # message for us. Should never  happen
-        return
-
-    g_vmci_listening_socket = lib.vmci_init(c_uint(port))
-    if g_vmci_listening_socket == VMCI_ERROR:
-        errno = get_errno()
-        raise OSError("Failed to initialize vSocket listener: %s (errno=%d)" \
-                        %  (os.strerror(errno), errno))
-
-def vmci_release_listening_socket():
-    """Calls C code to release the VMCI listening socket"""
-    if g_vmci_listening_socket:
-        lib.vmci_close(g_vmci_listening_socket)
-
-# load VMCI shared lib , listen on vSocket in main loop, handle requests
-def handleVmciRequests(port):
-    skip_count = MAX_SKIP_COUNT  # retries for vmci_get_one_op failures
+# listen on the transport (vSocket on ESX) in main loop, handle requests
+def handleVmciRequests(transport_):
+    skip_count = MAX_SKIP_COUNT  # retries for get_request failures
     bsize = MAX_JSON_SIZE
-    txt = create_string_buffer(bsize)
-    cartel = c_int32()
-    vmci_grab_listening_socket(port)
+    transport_.listen()
 
     while True:
-        # Listening on VMCI socket
-        logging.debug("lib.vmci_get_one_op: waiting for new request...")
-        c = lib.vmci_get_one_op(g_vmci_listening_socket, byref(cartel), txt, c_int(bsize))
-        logging.debug("lib.vmci_get_one_op returns %d, buffer '%s'", c, txt.value)
-
-        errno = get_errno()
-        if errno == ECONNABORTED:
-            logging.warn("Client with non privileged port attempted a request")
-            continue
-        if c == VMCI_ERROR:
+        try:
+            request = transport_.get_request(bsize)
+        except transport.TransportError as ex:
             # We can self-correct by reoping sockets internally. Give it a chance.
-            logging.warning("vmci_get_one_op failed ret=%d: %s (errno=%d) Retrying...",
-                            c, os.strerror(errno), errno)
+            logging.warning("%s Retrying...", ex)
             skip_count = skip_count - 1
             if skip_count <= 0:
                 raise Exception(
-                    "vmci_get_one_op: too many errors. Giving up.")
+                    "get_request: too many errors. Giving up.")
+            continue
+        skip_count = MAX_SKIP_COUNT  # reset the counter, just in case
+        if not request:
             continue
-        else:
-            skip_count = MAX_SKIP_COUNT  # reset the counter, just in case
 
-        client_socket = c # Bind to avoid race conditions.
+        client_socket, cartel, txt = request # Bind to avoid race conditions.
 
         # Check the stop barrier - if set, fail new incoming requests and exit the loop
         if stopBarrier:
@@ -1912,7 +2329,13 @@ def handleVmciRequests(port):
             send_vmci_reply(client_socket, err(svc_stop_err))
             continue
 
-        if not get_si():
+        req = peek_request(txt)
+
+        # "version" only needs the (cached) VIB version, answer it without a worker
+        if handle_version_request(client_socket, req):
+            continue
+
+        if transport_.host_agent_required and not get_si():
             svc_connect_err = 'Service is presently unavailable, ensure the ESXi Host Agent is running on this host'
             logging.warning(svc_connect_err)
             send_vmci_reply(client_socket, err(svc_connect_err))
@@ -1920,28 +2343,149 @@ def handleVmciRequests(port):
 
         opsCounter.incr()
 
-        # Fire a thread to execute the request
-        threadutils.start_new_thread(
-            target=execRequestThread,
-            args=(client_socket, cartel.value, txt.value))
+        # Requests are queued per VM and VMs are served by their vmgroup weight,
+        # so a single VM flooding the service cannot starve the others
+        try:
+            vm_name, _, vm_uuid, _ = get_vm_info_by_cartel(cartel)
+            sched_key, sched_label, weight = vm_uuid, vm_name, get_vm_weight(vm_uuid)
+        except Exception as ex:
+            # execRequestThread will fail the same lookup and report it to the client
+            logging.debug("Failed to get VM info for cartel %d: %s", cartel, ex)
+            sched_key, sched_label, weight = cartel, None, auth_data_const.DEFAULT_TENANT_WEIGHT
+
+        # Shed load early: decline requests over the in-flight limits so the admitted
+        # ones keep a bounded latency when the backend (hostd, disk) slows down
+        cmd_class = get_command_class(req["cmd"] if req and "cmd" in req else None)
+        reason, retry_after = admissionControl.admit(sched_key, cmd_class)
+        if reason:
+            opsCounter.decr()
+            svc_limit_err = 'Too many requests in flight ({0} limit for {1} requests), please retry'.format(
+                            reason.replace("_", " "), cmd_class)
+            logging.warning("%s: VM=%s", svc_limit_err, sched_label)
+            send_vmci_reply(client_socket, err_retryable(svc_limit_err, retry_after))
+            continue
+        admission = (sched_key, cmd_class, time.time())
+
+        # Queue the request for the worker pool, or push back if we are overloaded
+        if not requestPool.submit(execRequestThread,
+                                  args=(client_socket, cartel, txt, admission),
+                                  key=sched_key,
+                                  weight=weight,
+                                  label=sched_label):
+            admissionControl.release(sched_key, cmd_class)
+            opsCounter.decr()
+            svc_busy_err = 'Service is busy ({0} requests queued), please retry'.format(MAX_QUEUED_REQUESTS)
+            logging.warning(svc_busy_err)
+            send_vmci_reply(client_socket, err_retryable(svc_busy_err, BUSY_RETRY_AFTER))
+            continue
 
     # Close listening socket when the loop is over
-    logging.info("Closing VMCI listening socket...")
-    vmci_release_listening_socket()
+    logging.info("Closing listening socket...")
+    transport_.close()
 
 def usage():
-    print("Usage: %s -p <vSocket Port to listen on>" % sys.argv[0])
+    print("Usage: %s -p <vSocket Port to listen on> [-w <worker threads>] [-q <max queued requests>]"
+          " [--max-inflight=<requests>] [--max-inflight-vm=<requests>]"
+          " [--max-inflight-class=<class>:<requests>,...] [--transport=vmci|unix[:<socket path>]]"
+          " [--slow-request=<seconds>] [--size-staleness=<seconds>]" % sys.argv[0])
+
+def start_request_pool(workers, max_queued):
+    """Create and start the worker pool serving VMCI requests"""
+    global requestPool
+    requestPool = threadutils.WorkerPool(name="Worker",
+                                         workers=workers,
+                                         max_queued=max_queued,
+                                         request_queue=threadutils.FairShareQueue())
+    requestPool.start()
+    service_stats.register("request_pool", requestPool.stats)
+
+def get_command_class(cmd):
+    """Return the admission control class of command 'cmd'"""
+    return COMMAND_CLASSES.get(cmd, DEFAULT_COMMAND_CLASS)
+
+def parse_class_limits(spec):
+    """
+    Parse per command class limits given as "class:limit,class:limit"
+    Returns {class: limit}. Raises ValueError on bad input.
+    """
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        cmd_class, limit = item.split(":")
+        limits[cmd_class.strip()] = int(limit)
+    return limits
+
+def init_admission_control(max_total, max_per_vm, class_limits):
+    """Create admission control for in-flight requests"""
+    global admissionControl
+    admissionControl = counter.AdmissionControl(max_total=max_total,
+                                                max_per_key=max_per_vm,
+                                                class_limits=class_limits,
+                                                min_retry_after=BUSY_RETRY_AFTER)
+    service_stats.register("admission", admissionControl.stats)
+
+def create_transport(spec, port):
+    """
+    Return (transport, identity resolver, process identity) for transport 'spec', which is
+    "vmci" (vSocket on 'port', VMs identified via VSI) or "unix[:<path>]"
+    (Unix socket for local testing, with synthetic VMs). The service still needs
+    pyVmomi to start, and volume commands need DiskLib and hostd, see main().
+    """
+    if spec == "vmci":
+        return (transport.VmciTransport(port, LIB_LOC, LIB_LOC64), lookup_vm_info_by_cartel,
+                get_vmm_leader)
+    if spec == "unix" or spec.startswith("unix:"):
+        path = spec[len("unix:"):] or transport.DEFAULT_UNIX_SOCKET_PATH
+        return transport.UnixSocketTransport(path), transport.synthetic_vm_info, None
+    raise ValueError("Unknown transport '{0}'".format(spec))
+
+def get_lock_stats():
+    """Return contention stats of all named locks, see threadutils.LockManager.stats()"""
+    lock_stats = vmdk_utils.lockManager.stats()
+    lock_stats.update(lockManager.stats())
+    return lock_stats
+
+def init_vm_info_cache(resolver, identify):
+    """Create the cache for VM identity by cartel ID"""
+    global vmInfoCache
+    vmInfoCache = vm_info_cache.VmInfoCache(resolver, identify=identify, ttl=VM_INFO_CACHE_TTL,
+                                            max_size=VM_INFO_CACHE_SIZE)
+    service_stats.register("vm_info_cache", vmInfoCache.stats)
 
 def main():
+    global MAX_QUEUED_REQUESTS, requestTransport
     log_config.configure()
     logging.info("==== Starting vmdkops service ====")
+    # also caches the version for handle_version_request()
     logging.info("Version: %s , Pid: %d", vmdk_utils.get_version(), os.getpid() )
     signal.signal(signal.SIGINT, signal_handler_stop)
     signal.signal(signal.SIGTERM, signal_handler_stop)
     try:
         port = 1019
-        opts, args = getopt.getopt(sys.argv[1:], 'hp:')
-    except getopt.error as msg:
+        workers = REQUEST_WORKERS
+        max_inflight = MAX_INFLIGHT_REQUESTS
+        max_inflight_vm = MAX_INFLIGHT_PER_VM
+        class_limits = dict(MAX_INFLIGHT_BY_CLASS)
+        transport_spec = "vmci"
+        size_staleness = SIZE_STALENESS
+        opts, args = getopt.getopt(sys.argv[1:], 'hp:w:q:',
+                                   ['max-inflight=', 'max-inflight-vm=', 'max-inflight-class=',
+                                    'transport=', 'slow-request=', 'size-staleness='])
+        for a, v in opts:
+            if a == '--transport':
+                transport_spec = v
+            if a == '--slow-request':
+                latency.slow_threshold = float(v)
+            if a == '--size-staleness':
+                size_staleness = int(v)
+            if a == '--max-inflight':
+                max_inflight = int(v)
+            if a == '--max-inflight-vm':
+                max_inflight_vm = int(v)
+            if a == '--max-inflight-class':
+                class_limits.update(parse_class_limits(v))
+    except (getopt.error, ValueError) as msg:
         if msg:
            logging.exception(msg)
         usage()
@@ -1949,21 +2493,51 @@ def main():
     for a, v in opts:
         if a == '-p':
             port = int(v)
+        if a == '-w':
+            workers = int(v)
+        if a == '-q':
+            MAX_QUEUED_REQUESTS = int(v)
         if a == '-h':
             usage()
             return 0
 
     try:
-        # Load and use DLL with vsocket shim to listen for docker requests
-        load_vmci()
+        # Transport to listen for docker requests on. On ESX this is the DLL with vsocket shim
+        requestTransport, resolver, identify = create_transport(transport_spec, port)
 
-        kv.init()
-        connectLocalSi()
+        if requestTransport.host_agent_required:
+            kv.init()
+            connectLocalSi()
+        else:
+            # Local testing: without DiskLib (and hostd) the request pipeline still runs,
+            # volume commands just fail with an error reply
+            try:
+                kv.init()
+            except OSError as ex:
+                logging.warning("DiskLib is not available (%s), volume commands will fail", ex)
+
+        init_vm_info_cache(resolver, identify)
+        init_admission_control(max_inflight, max_inflight_vm, class_limits)
+        start_request_pool(workers, MAX_QUEUED_REQUESTS)
+        service_stats.register("single_flight",
+                               lambda: dict((cmd, flight.stats()) for cmd, flight in readFlights.items()))
+        service_stats.register("latency", latency.stats)
+        service_stats.register("locks", get_lock_stats)
+        service_stats.register("auth_snapshot", auth_snapshot.stats)
+        # tenants are changed by the admin CLI, drop volume folders resolved for old ones
+        auth_snapshot.add_reload_listener(vmdk_utils.invalidate_vol_paths_on_reload)
+        service_stats.register("auth_db", auth.get_auth_mgr_stats)
+        service_stats.register("sidecar_cache", kv.cache_stats)
+        service_stats.register("sidecar_io", kv.io_stats)
+        service_stats.register("vol_size_cache", kv.size_cache_stats)
+        kv.start_size_sampler(size_staleness)
+        service_stats.start_reporter()
 
         # start the daemon. Do all the task to start the listener through the daemon
-        threadutils.start_new_thread(target=vm_listener.start_vm_changelistener,
-                                 daemon=True)
-        handleVmciRequests(port)
+        if requestTransport.host_agent_required:
+            threadutils.start_new_thread(target=vm_listener.start_vm_changelistener,
+                                     daemon=True)
+        handleVmciRequests(requestTransport)
 
     except Exception as e:
         logging.exception(e)
@@ -24,10 +24,13 @@ import glob
 import os
 import os.path
 import time
+import json
+import base64
 
 import vmdk_ops
 import log_config
 import volume_kv
+import kvESX
 import vsan_policy
 import vsan_info
 import vmdk_utils
@@ -38,6 +41,7 @@ import auth
 import auth_data
 import auth_api
 import auth_data_const
+import auth_snapshot
 import vmdk_utils
 import random
 import convert
@@ -349,6 +353,256 @@ class VmdkCreateCloneRemoveTestCase(unittest.TestCase):
         err = vmdk_ops.removeVMDK(self.name3)
         self.assertEqual(err, None, err)
 
+class VolumeKvUpdateTestCase(unittest.TestCase):
+    """Unit test for volume_kv.update()"""
+
+    volName = "vol_UnitTest_KvUpdate"
+    vm_name = test_utils.generate_test_vm_name()
+
+    def setUp(self):
+        self.name = vmdk_utils.get_vmdk_path(path, self.volName)
+        err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                  vmdk_path=self.name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+    def tearDown(self):
+        vmdk_ops.removeVMDK(self.name)
+
+    def testUpdate(self):
+        def attach(vol_meta):
+            vol_meta[volume_kv.STATUS] = volume_kv.ATTACHED
+            vol_meta[volume_kv.ATTACHED_VM_UUID] = "vm1"
+        self.assertTrue(volume_kv.update(self.name, attach))
+        vol_meta = volume_kv.getAll(self.name)
+        self.assertEqual(vol_meta[volume_kv.STATUS], volume_kv.ATTACHED)
+        self.assertEqual(vol_meta[volume_kv.CREATED_BY], self.vm_name)
+
+        # no-op change does not touch the file
+        mtime = os.stat(kvESX.get_meta_file(self.name)).st_mtime
+        time.sleep(1.1)
+        self.assertTrue(volume_kv.update(self.name, attach))
+        self.assertEqual(os.stat(kvESX.get_meta_file(self.name)).st_mtime, mtime)
+
+        def detach(vol_meta):
+            vol_meta[volume_kv.STATUS] = volume_kv.DETACHED
+        # attached to another VM, not changed
+        self.assertFalse(volume_kv.update(self.name, detach, expect={volume_kv.ATTACHED_VM_UUID: "vm2"}))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.ATTACHED)
+        self.assertTrue(volume_kv.update(self.name, detach, expect={volume_kv.ATTACHED_VM_UUID: "vm1"}))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.DETACHED)
+
+    def testMetaFile(self):
+        # DiskLib returns the path as bytes on Python 3
+        meta_file = kvESX.get_meta_file(self.name)
+        self.assertIsInstance(meta_file, str)
+        self.assertTrue(os.path.exists(meta_file))
+        self.assertTrue(volume_kv.set_kv(self.name, volume_kv.STATUS, volume_kv.ATTACHED))
+        self.assertTrue(volume_kv.set_kv(self.name, volume_kv.STATUS, volume_kv.DETACHED))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.DETACHED)
+        self.assertFalse(os.path.exists(meta_file + kvESX.KV_TMP_SUFFIX))
+        # tearDown() deletes the volume and its side car
+
+    def testCorruptSidecar(self):
+        meta_file = kvESX.get_meta_file(self.name)
+        with open(meta_file, "r") as f:
+            kv_str = f.read()
+        self.assertIn(kvESX.KV_CHECKSUM, kv_str)
+
+        # identical content is not written
+        skipped = volume_kv.io_stats()["writes_skipped"]
+        self.assertTrue(volume_kv.setAll(self.name, volume_kv.getAll(self.name)))
+        self.assertEqual(volume_kv.io_stats()["writes_skipped"], skipped + 1)
+
+        # torn write
+        corrupt = volume_kv.io_stats()["corrupt"]
+        with open(meta_file, "w") as f:
+            f.write(kv_str[:len(kv_str) // 4])
+        self.assertIsNone(volume_kv.getAll(self.name, use_cache=False))
+        stats = volume_kv.io_stats()
+        self.assertEqual(stats["corrupt"], corrupt + 1)
+        self.assertEqual(stats["corrupt_sidecars"][-1], self.name)
+
+        # torn write which is still valid JSON, the checksum does not match
+        vol_meta = json.loads(kv_str)
+        vol_meta[volume_kv.STATUS] = volume_kv.ATTACHED
+        with open(meta_file, "w") as f:
+            f.write(json.dumps(vol_meta, sort_keys=True, separators=kvESX.KV_SEPARATORS))
+        self.assertIsNone(volume_kv.getAll(self.name, use_cache=False))
+        self.assertEqual(volume_kv.io_stats()["corrupt"], corrupt + 2)
+
+        with open(meta_file, "w") as f:
+            f.write(kv_str)
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.DETACHED)
+        self.assertFalse(os.path.exists(meta_file + kvESX.KV_TMP_SUFFIX))
+
+    def testStaleChecksum(self):
+        # an older version loads the side car with its checksum, attaches the
+        # volume and writes it back, leaving the old checksum
+        meta_file = kvESX.get_meta_file(self.name)
+        with open(meta_file, "r") as f:
+            old_meta = json.loads(f.read())
+        old_meta[volume_kv.STATUS] = volume_kv.ATTACHED
+        old_meta[volume_kv.ATTACHED_VM_UUID] = "vm1"
+        with open(meta_file, "w") as f:
+            f.write(json.dumps(old_meta))
+
+        mismatch = volume_kv.io_stats()["checksum_mismatch"]
+        vol_meta = volume_kv.getAll(self.name, use_cache=False)
+        self.assertEqual(vol_meta[volume_kv.STATUS], volume_kv.ATTACHED)
+        self.assertEqual(vol_meta[volume_kv.CREATED_BY], self.vm_name)
+        self.assertEqual(volume_kv.io_stats()["checksum_mismatch"], mismatch + 1)
+
+        # detach as setStatusDetached() does, the rest of the meta-data is kept
+        def detach(vol_meta):
+            vol_meta[volume_kv.STATUS] = volume_kv.DETACHED
+            vol_meta.pop(volume_kv.ATTACHED_VM_UUID, None)
+        self.assertTrue(volume_kv.update(self.name, detach, default={}))
+        vol_meta = volume_kv.getAll(self.name, use_cache=False)
+        self.assertEqual(vol_meta[volume_kv.STATUS], volume_kv.DETACHED)
+        self.assertEqual(vol_meta[volume_kv.CREATED_BY], self.vm_name)
+        self.assertIn(volume_kv.VOL_OPTS, vol_meta)
+        with open(meta_file, "r") as f:
+            self.assertEqual(json.loads(f.read())[kvESX.KV_CHECKSUM], kvESX.checksum(vol_meta))
+
+        # valid JSON that is not an object is never replaced with the default
+        with open(meta_file, "w") as f:
+            f.write("[]")
+        self.assertFalse(volume_kv.update(self.name, detach, default={}))
+        with open(meta_file, "r") as f:
+            self.assertEqual(f.read(), "[]")
+
+class ListPageTestCase(unittest.TestCase):
+    """Unit test for paginated volume list"""
+
+    volNames = ["vol_UnitTest_ListPage{0}".format(i) for i in range(3)]
+    vm_name = test_utils.generate_test_vm_name()
+
+    def setUp(self):
+        self.names = [vmdk_utils.get_vmdk_path(path, n) for n in self.volNames]
+        for vol_name, vmdk_path in zip(self.volNames, self.names):
+            err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                      vmdk_path=vmdk_path,
+                                      vol_name=vol_name)
+            self.assertEqual(err, None, err)
+
+    def tearDown(self):
+        for vmdk_path in self.names:
+            vmdk_ops.removeVMDK(vmdk_path)
+
+    def list_all(self, page_size):
+        """ Return (names, number of pages) of all volumes listed page by page """
+        names = []
+        pages = 0
+        opts = {vmdk_ops.LIST_PAGE_SIZE: page_size}
+        while True:
+            page = vmdk_ops.listVMDKPage(None, opts)
+            self.assertNotIn(u'Error', page)
+            self.assertTrue(len(page[u'Volumes']) <= page_size)
+            names += [v[u'Name'] for v in page[u'Volumes']]
+            pages += 1
+            if not page[u'NextPageToken']:
+                return names, pages
+            opts[vmdk_ops.LIST_PAGE_TOKEN] = page[u'NextPageToken']
+
+    def testToken(self):
+        key = ("datastore1", ("vmgroup1",), "vol1.vmdk")
+        self.assertEqual(vmdk_ops.decode_list_token(vmdk_ops.encode_list_token(key)), key)
+        key = ("datastore1", (), "vol1.vmdk")
+        self.assertEqual(vmdk_ops.decode_list_token(vmdk_ops.encode_list_token(key)), key)
+
+    def testBadToken(self):
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('utf-8')
+        for token in ["not a token!", "YWJj", encode({"a": 1, "b": 2, "c": 3}),
+                      encode([1, [], "vol1.vmdk"]), encode(["datastore1", "sub", "vol1.vmdk"]),
+                      encode(["datastore1", [], "vol1.vmdk", "extra"]), 5]:
+            self.assertRaises(vmdk_ops.ValidationError, vmdk_ops.decode_list_token, token)
+            result = vmdk_ops.listVMDKPage(None, {vmdk_ops.LIST_PAGE_TOKEN: token})
+            self.assertIn(u'Error', result)
+
+    def testPageSize(self):
+        for page_size in [0, -1, vmdk_ops.MAX_LIST_PAGE_SIZE + 1, "abc", None, [1], {}]:
+            result = vmdk_ops.listVMDKPage(None, {vmdk_ops.LIST_PAGE_SIZE: page_size})
+            self.assertIn(u'Error', result, page_size)
+        result = vmdk_ops.listVMDKPage(None, {vmdk_ops.LIST_PAGE_SIZE: "1"})
+        self.assertEqual(len(result[u'Volumes']), 1)
+
+    def testPaging(self):
+        all_names = [v[u'Name'] for v in vmdk_ops.listVMDK(None)]
+        for name in self.volNames:
+            self.assertIn(name, [n.split("@")[0] for n in all_names])
+
+        names, pages = self.list_all(1)
+        self.assertEqual(names, all_names)
+        self.assertEqual(pages, len(all_names))
+
+        # a page ending with the last volume has no token
+        names, pages = self.list_all(len(all_names))
+        self.assertEqual((names, pages), (all_names, 1))
+
+        # resuming after the last volume returns an empty last page
+        last_key = None
+        for key, _ in vmdk_utils.iter_volumes(None):
+            last_key = key
+        page = vmdk_ops.listVMDKPage(None, {vmdk_ops.LIST_PAGE_TOKEN: vmdk_ops.encode_list_token(last_key)})
+        self.assertEqual(page, {u'Volumes': [], u'NextPageToken': None})
+
+class VolPathCacheTestCase(unittest.TestCase):
+    """Unit test for the cache of volume folders in vmdk_utils"""
+
+    def setUp(self):
+        self.saved_ttl = vmdk_utils.VOL_PATH_CACHE_TTL
+        vmdk_utils.invalidate_vol_paths()
+
+    def tearDown(self):
+        vmdk_utils.VOL_PATH_CACHE_TTL = self.saved_ttl
+        vmdk_utils.invalidate_vol_paths()
+
+    def testCache(self):
+        vmdk_utils.cache_vol_path("ds1", None, None, "/vmfs/volumes/ds1/dockvols/_DEFAULT")
+        vmdk_utils.cache_vol_path("ds1", "vmgroup1", "uuid1", "/vmfs/volumes/ds1/dockvols/uuid1")
+        self.assertEqual(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "uuid1"),
+                         "/vmfs/volumes/ds1/dockvols/uuid1")
+        # a vmgroup re-created under the same name has another uuid
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "uuid2"))
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds2", "vmgroup1", "uuid1"))
+
+    def testTTL(self):
+        vmdk_utils.VOL_PATH_CACHE_TTL = 0
+        vmdk_utils.cache_vol_path("ds1", "vmgroup1", "uuid1", "/vmfs/volumes/ds1/dockvols/uuid1")
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "uuid1"))
+
+    def testInvalidate(self):
+        for ds in ["ds1", "ds2"]:
+            for tenant in ["vmgroup1", "vmgroup2"]:
+                vmdk_utils.cache_vol_path(ds, tenant, tenant + "-uuid", "/vmfs/volumes/" + ds)
+        vmdk_utils.invalidate_vol_paths(tenant_name="vmgroup1")
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "vmgroup1-uuid"))
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds2", "vmgroup1", "vmgroup1-uuid"))
+        self.assertIsNotNone(vmdk_utils.get_cached_vol_path("ds2", "vmgroup2", "vmgroup2-uuid"))
+
+        vmdk_utils.invalidate_vol_paths(datastore="ds2")
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds2", "vmgroup2", "vmgroup2-uuid"))
+        self.assertIsNotNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup2", "vmgroup2-uuid"))
+
+        vmdk_utils.invalidate_vol_paths()
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup2", "vmgroup2-uuid"))
+
+    def testInvalidateOnReload(self):
+        tenant = auth_snapshot.TenantInfo("uuid1", "vmgroup1", "/vmfs/volumes/ds1", 1)
+        old = auth_snapshot.AuthSnapshot(1, 0, {"uuid1": tenant}, {}, {}, {})
+        vmdk_utils.cache_vol_path("ds1", "vmgroup1", "uuid1", "/vmfs/volumes/ds1/dockvols/uuid1")
+        # only usage changed
+        vmdk_utils.invalidate_vol_paths_on_reload(old, auth_snapshot.AuthSnapshot(2, 0, {"uuid1": tenant},
+                                                                                  {}, {}, {}))
+        self.assertIsNotNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "uuid1"))
+        # vmgroup renamed by the admin CLI
+        renamed = tenant._replace(name="vmgroup2")
+        vmdk_utils.invalidate_vol_paths_on_reload(old, auth_snapshot.AuthSnapshot(3, 0, {"uuid1": renamed},
+                                                                                  {}, {}, {}))
+        self.assertIsNone(vmdk_utils.get_cached_vol_path("ds1", "vmgroup1", "uuid1"))
+
 class ValidationTestCase(unittest.TestCase):
     """ Test validation of -o options on create """
 
@@ -492,6 +746,32 @@ class VmdkAttachDetachTestCase(unittest.TestCase):
                                        vm=vm[0])
             self.assertTrue(ret is None)
 
+    def testAttachDetachBatch(self):
+        logging.info("Start VMDKAttachDetachBatchTest")
+        si = vmdk_ops.get_si()
+        # find test_vm
+        vm = [d for d in si.content.rootFolder.childEntity[0].vmFolder.childEntity
+              if d.config.name == self.vm_name]
+        self.assertNotEqual(None, vm)
+        # attach two disks with a single reconfigure
+        paths = [os.path.join(self.datastore_path, 'VmdkAttachDetachTestVol' + str(id) + '.vmdk')
+                 for id in range(1, 3)]
+        results = vmdk_ops.disk_attach_batch(vmdk_paths=paths, vm=vm[0])
+        logging.info("Returned '%s'", results)
+        self.assertEqual(sorted(results.keys()), sorted(paths))
+        for fullpath in paths:
+            self.assertFalse("Error" in results[fullpath])
+            self.assertNotEqual(None, vmdk_ops.findDeviceByPath(fullpath, vm[0]))
+        # disks were given different slots
+        self.assertNotEqual(results[paths[0]], results[paths[1]])
+
+        # attaching again reports the existing slots
+        self.assertEqual(vmdk_ops.disk_attach_batch(vmdk_paths=paths, vm=vm[0]), results)
+
+        for fullpath in paths:
+            ret = vmdk_ops.disk_detach(vmdk_path=fullpath, vm=vm[0])
+            self.assertTrue(ret is None)
+
 class VmdkAuthorizeTestCase(unittest.TestCase):
     """ Unit test for VMDK Authorization """
 
@@ -625,6 +905,53 @@ class VmdkAuthorizeTestCase(unittest.TestCase):
         error_info = self.auth_mgr.remove_volumes_from_volumes_table(tenant1.id)
         self.assertEqual(error_info, None)
 
+    def test_vmdkop_authorization_plan(self):
+        """ Test authorization with AuthorizationPlan """
+        vms = [(self.vm_uuid, self.vm_name)]
+        privileges = [{'datastore_url': self.datastore_url,
+                       'allow_create': 1,
+                       'max_volume_size': 500,
+                       'usage_quota': 1000},
+                      {'datastore_url': auth_data_const.ALL_DS_URL,
+                       'allow_create': 0,
+                       'max_volume_size': 0,
+                       'usage_quota': 0}]
+        error_info, tenant1 = self.auth_mgr.create_tenant(name='vmdk_auth_plan_test',
+                                                          description='Tenant used to vmdk_auth_plan_test',
+                                                          vms=vms,
+                                                          privileges=privileges)
+        self.assertEqual(error_info, None)
+        error_info = auth.add_volume_to_volumes_table(tenant1.id, self.datastore_url, "VmdkAuthPlanTestVol1", 600)
+        self.assertEqual(error_info, None)
+
+        error_info, plan = auth.get_authorization_plan(vm_uuid=self.vm_uuid,
+                                                       datastore_url=self.datastore_url)
+        self.assertEqual(error_info, None)
+        self.assertEqual(plan.tenant_uuid, tenant1.id)
+        self.assertEqual(plan.tenant_name, 'vmdk_auth_plan_test')
+        self.assertEqual(plan.total_storage_used, 600)
+        self.assertTrue(plan.covers(self.datastore_url))
+
+        opts={u'size': u'300MB', u'fstype': u'ext4'}
+        self.assertEqual(plan.check(auth.CMD_CREATE, opts, "datastore", None, False), None)
+        opts={u'size': u'500MB', u'fstype': u'ext4'}
+        self.assertEqual(plan.check(auth.CMD_CREATE, opts, "datastore", None, False),
+                         "The total volume size exceeds the usage quota")
+
+        # no privilege to the datastore - falls back to "_ALL_DS", which is mount only
+        error_info, plan = auth.get_authorization_plan(vm_uuid=self.vm_uuid,
+                                                       datastore_url="no_such_datastore_url")
+        self.assertEqual(error_info, None)
+        self.assertEqual(plan.check(auth.CMD_ATTACH, {}, "no_such_datastore", None, False), None)
+        self.assertEqual(plan.check(auth.CMD_CREATE, opts, "no_such_datastore", None, False),
+                         "No create privilege")
+
+        # remove the tenant
+        error_info = self.auth_mgr.remove_tenant(tenant1.id, False)
+        self.assertEqual(error_info, None)
+        error_info = self.auth_mgr.remove_volumes_from_volumes_table(tenant1.id)
+        self.assertEqual(error_info, None)
+
 class VmdkTenantTestCase(unittest.TestCase):
     """ Unit test for VMDK ops for multi-tenancy """
     default_tenant_vol1_name = "default_tenant_vol1"
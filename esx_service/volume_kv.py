@@ -113,12 +113,14 @@ def delete(vol_path):
     return kvESX.delete(vol_path)
 
 
-def getAll(vol_path):
+def getAll(vol_path, use_cache=True):
     """
     Return the entire meta-data for the given vol_path.
     Return true if successful, false otherwise
+    Pass use_cache=False to read the meta-data from disk when it may have been
+    changed by another ESX host just now.
     """
-    return kvESX.load(vol_path)
+    return kvESX.load(vol_path, use_cache)
 
 
 def setAll(vol_path, vol_meta, key=None, value=None):
@@ -132,16 +134,27 @@ def setAll(vol_path, vol_meta, key=None, value=None):
     return True
 
 
-# Set a string value for a given key(index)
-def set_kv(vol_path, key, val):
-    vol_meta = kvESX.load(vol_path)
+def update(vol_path, mutator, expect=None, default=None):
+    """
+    Atomically change the meta-data for a given vol_path, with one read and
+    at most one write of the side car.
+    mutator(vol_meta) changes the meta-data dict in place; if it changes nothing,
+    the side car is not written.
+    expect - {key: value} dict; if any of the keys is present with another value,
+    the meta-data is not changed.
+    default - meta-data to pass to mutator if the side car can't be read; if None,
+    update fails in that case.
+    Return true if successful, false otherwise
+    """
+    return kvESX.update(vol_path, mutator, expect, default)
 
-    if not vol_meta:
-        return False
 
-    vol_meta[key] = val
+# Set a string value for a given key(index)
+def set_kv(vol_path, key, val):
+    def set_key(vol_meta):
+        vol_meta[key] = val
 
-    return kvESX.save(vol_path, vol_meta)
+    return kvESX.update(vol_path, set_key)
 
 
 def get_kv(vol_path, key):
@@ -164,18 +177,28 @@ def remove(vol_path, key):
     Remove a key/value pair from the store. Return true on success, false on
     error.
     """
-    vol_meta = kvESX.load(vol_path)
+    def remove_key(vol_meta):
+        vol_meta.pop(key, None)
 
-    if not vol_meta:
-        return False
-
-    if key in vol_meta:
-        del vol_meta[key]
-
-    return kvESX.save(vol_path, vol_meta)
+    return kvESX.update(vol_path, remove_key)
 
 def get_vol_info(vol_path):
    return kvESX.get_info(vol_path)
 
+def get_vol_size(vol_path):
+   return kvESX.get_size(vol_path)
+
 def fixup_kv(src_volpath, dst_volpath):
     return kvESX.fixup_kv(src_volpath, dst_volpath)
+
+def cache_stats():
+    return kvESX.cache_stats()
+
+def io_stats():
+    return kvESX.io_stats()
+
+def size_cache_stats():
+    return kvESX.size_cache_stats()
+
+def start_size_sampler(max_staleness):
+    kvESX.start_size_sampler(max_staleness)